@@ -60,9 +60,23 @@ class App(object):
         }
         self._driver.web.release_app_session(self._bundle_id) #重启app后app_id会发生变化,需要重新获取app_id
         self._app_started = self._device.start_app(self._bundle_id, self._app_params, env, self._trace_template, self._trace_output)
+        self.invalidate_snapshots()
         if not self._app_started: raise Exception('APP-StartError')
         logger.info('[%s] APP - Start - %s - 启动耗时%s秒' % (datetime.datetime.fromtimestamp(time.time()), self._bundle_id, round(time.time() - begin_time, 3)))
     
+    @property
+    def snapshot_epoch(self):
+        '''控件属性快照的版本，与所在设备共享，参考Element.snapshot
+        
+        :rtype: int
+        '''
+        return self._device.snapshot_epoch
+    
+    def invalidate_snapshots(self):
+        '''使该App所在设备上所有控件的属性快照失效，设备和控件的点击、拖拽、输入等操作会自动调用
+        '''
+        self._device.invalidate_snapshots()
+    
     def get_text(self, text):
         '''获取text对应的本地语言文本
         
@@ -158,6 +172,7 @@ class App(object):
         '''
         logger.info('[%s] APP - Release - %s' % (datetime.datetime.fromtimestamp(time.time()), self._bundle_id))
         self._app_started = False
+        self.invalidate_snapshots()
 
 
 class Safari(App):
@@ -19,6 +19,7 @@ from __future__ import absolute_import, print_function, division
 
 import base64
 import datetime
+import functools
 import os
 import pkg_resources
 import subprocess
@@ -30,6 +31,7 @@ import traceback
 import six
 from six import PY3
 from six import PY2
+from six.moves import http_client
 
 from testbase import context
 from testbase.conf import settings
@@ -39,8 +41,12 @@ from testbase.resource import TestResourceManager
 from testbase import logger
 from qt4i.util import EnumDirect, Rectangle
 
+from qt4i.driver.rpc import DriverApiError
 from qt4i.driver.rpc import RPCClientProxy
 from qt4i.driver.util import Process
+from qt4i.driver.util.uiquery import UITreeSnapshot
+from qt4i.driver.util.uitree import UITreeMirror
+from qt4i.driver.util.uitree import truncate_tree
 
 
 QT4i_LOGS_PATH = os.path.abspath('_attachments')
@@ -54,6 +60,18 @@ DEFAULT_AGENT_PORT = 8100
 DEFAULT_ALERT_RULE =  settings.get('QT4I_ALERT_RULES', [{'button_text':'^确定$|^好$|^允许$|^OK$|^Allow$'}])
 
 
+def ui_action(func):
+    '''修饰会改变UI的设备操作，操作后使该设备上控件的属性快照失效
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.invalidate_snapshots()
+    return wrapper
+
+
 class DeviceServer(object):
     '''设备服务器
     '''
@@ -374,6 +392,9 @@ class Device(object):
     '''iOS设备基类（包含基于设备的UI操作接口）
     '''
     Devices = []
+    _blob_supported = True # driver server是否支持二进制通道
+    _tree_diff_supported = True # driver server是否支持增量获取UI树
+    _snapshot_epoch = 0 # 控件属性快照的版本，UI操作后递增使已获取的快照失效
 
     @classmethod
     def release_all(cls):
@@ -449,6 +470,8 @@ class Device(object):
         url = '/'.join([self._base_url, 'device', '%s/' % self._device_udid])
         self._driver = RPCClientProxy(url, self._ws_uri, allow_none=True, encoding=Encoding)
         self._keyboard = Keyboard(self)
+        self._uitree = UITreeMirror()
+        self._ui_snapshot = None
         logger.info('[%s] Device - Connect - %s - %s (%s)' % (datetime.datetime.fromtimestamp(time.time()), self.name, self.udid, self.ios_version))
         # 申请设备成功后，对弹窗进行处理
         rule = settings.get('QT4I_ALERT_DISMISS', DEFAULT_ALERT_RULE)
@@ -524,6 +547,20 @@ class Device(object):
         '''
         return self._keyboard
 
+    @property
+    def snapshot_epoch(self):
+        '''控件属性快照的版本，参考Element.snapshot
+
+        :rtype: int
+        '''
+        return self._snapshot_epoch
+
+    def invalidate_snapshots(self):
+        '''使该设备上所有控件的属性快照失效，设备和控件的点击、拖拽、输入等操作会自动调用
+        '''
+        self._snapshot_epoch += 1
+
+    @ui_action
     def start_app(self, bundle_id, app_params, env, trace_template=None, trace_output=None, retry=5, timeout=55):
         '''启动APP
 
@@ -560,6 +597,7 @@ class Device(object):
                 raise Exception('未找到名为[%s]的App' % app_params['app_name'])
         return self._app_started == True
 
+    @ui_action
     def stop_app(self):
         '''终止APP
 
@@ -617,8 +655,12 @@ class Device(object):
         :rtype: tuple (boolean, str)
         '''
         try:
+            if not image_path:
+                image_path = os.path.join(QT4i_LOGS_PATH, "p%s_%s.png" %(os.getpid(), uuid.uuid1()))
+            if self._fetch_by_blob(self._driver, self._driver.device.capture_screen_handle, image_path):
+                return os.path.isfile(image_path), image_path
             base64_img = None
-            from http.client import IncompleteRead
+            from six.moves.http_client import IncompleteRead
             for _ in range(3):
                 try:
                     base64_img = self._driver.device.capture_screen()
@@ -627,8 +669,6 @@ class Device(object):
                 except IncompleteRead:
                     time.sleep(2)  # 等待两秒后再次尝试
                     continue
-            if not image_path:
-                image_path = os.path.join(QT4i_LOGS_PATH, "p%s_%s.png" %(os.getpid(), uuid.uuid1()))
             with open(os.path.abspath(image_path), "wb") as fd:
                 if PY2:
                     fd.write(base64.decodestring(base64_img))
@@ -639,6 +679,111 @@ class Device(object):
             logger.error('screenshot failed: %s' % traceback.format_exc())
             return False, ""
 
+    def get_recording(self, start_time=None, end_time=None, video_path=None):
+        '''获取截屏服务录制的屏幕视频（MJPEG格式），截屏服务需要以--record参数启动
+
+        :param start_time: 开始时间戳（driver server所在主机的时间），默认为结束时间前30秒
+        :type start_time: float
+        :param end_time: 结束时间戳，默认为当前时间
+        :type end_time: float
+        :param video_path: 视频的存放路径
+        :type video_path: str
+        :returns: str -- 视频的存放路径
+        '''
+        if not video_path:
+            video_path = os.path.join(QT4i_LOGS_PATH, "v%s_%s.mjpeg" % (os.getpid(), uuid.uuid1()))
+        get_token = lambda: self._driver.device.get_recording_handle(start_time, end_time)
+        if not self._fetch_by_blob(self._driver, get_token, video_path):
+            data = self._driver.device.get_recording(start_time, end_time)
+            with open(os.path.abspath(video_path), "wb") as fd:
+                fd.write(base64.b64decode(data))
+        return video_path
+
+    def _fetch_by_blob(self, proxy, get_token, filepath):
+        '''通过driver server的二进制通道下载数据直接写入文件，不经过base64编码
+
+        :param proxy: 登记数据的RPC代理
+        :type proxy: RPCClientProxy
+        :param get_token: 调用RPC方法登记数据并返回token
+        :type get_token: callable
+        :param filepath: 本地文件路径
+        :type filepath: str
+        :returns: boolean -- 是否下载成功，经过代理访问、driver server不支持或传输失败时返回False
+        '''
+        if self._ws_uri or not self._blob_supported: # 经过代理时driver server的HTTP端口不可直接访问
+            return False
+        try:
+            token = get_token()
+        except DriverApiError as e:
+            if 'is not supported by endpoint' in str(e): # 旧版本driver server
+                self._blob_supported = False
+                return False
+            raise
+        try:
+            with open(os.path.abspath(filepath), "wb") as fd:
+                proxy.fetch_blob(token, fd)
+        except (DriverApiError, socket.error, http_client.HTTPException):
+            self._disable_blob()
+            return False
+        return True
+
+    def _disable_blob(self):
+        '''二进制通道传输失败后不再使用，之后的传输都通过base64编码的RPC调用
+        '''
+        logger.warning('blob transfer failed, fall back to RPC: %s' % traceback.format_exc())
+        self._blob_supported = False
+
+    def get_element_tree(self, max_depth=0, root_id=None):
+        '''获取UI树，driver server支持时只传输相对上次结果发生变化的子树
+
+        :param max_depth: 树的深度，默认为0，获取所有子孙控件树
+        :type max_depth: int
+        :param root_id: 作为树根的element的id，默认为None，从顶层开始
+        :type root_id: int
+        :return: 控件树，之后的调用不会修改已返回的结果，但未变化的子树会被共享，不应修改
+        :rtype: dict
+        '''
+        self._check_app_started()
+        if self._tree_diff_supported:
+            key = (root_id, max_depth)
+            get_diff = self._driver.device.get_element_tree_diff
+            try:
+                result = get_diff(self._uitree.get_base_hash(key), max_depth, root_id)
+            except DriverApiError as e:
+                if 'is not supported by endpoint' not in str(e): # 旧版本driver server
+                    raise
+                self._tree_diff_supported = False
+            else:
+                try:
+                    return self._uitree.update(key, result)
+                except ValueError: # 本地UI树与driver server保存的不一致，重新获取完整UI树
+                    return self._uitree.update(key, get_diff(None, max_depth, root_id))
+        if root_id is not None:
+            return self._driver.element.get_element_tree(root_id, max_depth)
+        return truncate_tree(self._driver.device.get_element_tree(), max_depth)
+
+    def take_snapshot(self):
+        '''获取当前UI树并建立查询快照，后续query_snapshot在该快照上查询。快照不会被之后的get_element_tree修改
+
+        :rtype: UITreeSnapshot
+        '''
+        self._ui_snapshot = UITreeSnapshot(self.get_element_tree())
+        return self._ui_snapshot
+
+    def query_snapshot(self, locator, refresh=False):
+        '''在UI树快照上本地查询控件，不与agent交互，适合一次获取UI树后进行多次检查
+
+        :param locator: QPath、XPath或name，参考qt4i.driver.util.uiquery
+        :type locator: QPath|str
+        :param refresh: 是否先重新获取UI树，尚未获取过快照时总是获取
+        :type refresh: boolean
+        :return: 匹配的控件树节点，包含classname、label、name、value、visible、enabled和rect
+        :rtype: list
+        '''
+        if refresh or self._ui_snapshot is None:
+            self.take_snapshot()
+        return self._ui_snapshot.query(locator)
+
     def print_uitree(self, need_back = False):
         '''打印界面树
 
@@ -648,7 +793,7 @@ class Device(object):
         :rtype: dict or None
         '''
         self._check_app_started()
-        _ui_tree = self._driver.device.get_element_tree()
+        _ui_tree = self.get_element_tree()
         def _print(_tree, _spaces='', _indent='|---'):
             _line = _spaces + '{  ' + ',   '.join([
                 'classname: "%s"' % _tree['classname'],
@@ -664,6 +809,7 @@ class Device(object):
         if need_back:
             return _ui_tree
 
+    @ui_action
     def click(self, x=0.5, y=0.5):
         '''点击屏幕
 
@@ -675,6 +821,7 @@ class Device(object):
         self._check_app_started()
         self._driver.device.click(x, y)
 
+    @ui_action
     def click2(self, element):
         '''基于控件坐标点击屏幕（用于直接点击控件无效的场景,尽量少用）
 
@@ -688,6 +835,7 @@ class Device(object):
         y = (element_rect.top + element_rect.bottom) / (2.0 * device_rect.height)
         self._driver.device.click(x, y)
 
+    @ui_action
     def long_click(self, x, y, duration=3):
         '''长按屏幕
 
@@ -701,6 +849,7 @@ class Device(object):
         self._check_app_started()
         self._driver.device.long_click(x, y, duration)
 
+    @ui_action
     def double_click(self, x, y):
         '''双击屏幕
 
@@ -730,6 +879,7 @@ class Device(object):
         self._check_app_started()
         raise NotImplementedError
 
+    @ui_action
     def drag(self, from_x=0.9, from_y=0.5, to_x=0.1, to_y=0.5, duration=0.5):
         '''回避屏幕边缘，全屏拖拽（默认在屏幕中央从右向左拖拽）
 
@@ -747,6 +897,7 @@ class Device(object):
         self._check_app_started()
         self._driver.device.drag(from_x, from_y, to_x, to_y, duration)
 
+    @ui_action
     def drag2(self, direct=EnumDirect.Left):
         '''回避屏幕边缘，全屏在屏幕中央拖拽
 
@@ -759,6 +910,7 @@ class Device(object):
         if direct == EnumDirect.Up    : self._driver.device.drag(0.5, 0.5, 0.5, 0.1, 0.5)
         if direct == EnumDirect.Down  : self._driver.device.drag(0.5, 0.5, 0.5, 0.9, 0.5)
 
+    @ui_action
     def flick(self, from_x=0.9, from_y=0.5, to_x=0.1, to_y=0.5):
         '''回避屏幕边缘，全屏滑动/拂去（默认从右向左滑动/拂去）
         该接口比drag的滑动速度快，如果滚动距离大，建议用此接口
@@ -775,6 +927,7 @@ class Device(object):
         self._check_app_started()
         self._driver.device.drag(from_x, from_y, to_x, to_y, 0)
 
+    @ui_action
     def flick2(self, direct=EnumDirect.Left):
         '''回避屏幕边缘，全屏在屏幕中央滑动/拂去
 
@@ -787,6 +940,7 @@ class Device(object):
         if direct == EnumDirect.Up    : self._driver.device.drag(0.5, 0.5, 0.5, 0.1, 0)
         if direct == EnumDirect.Down  : self._driver.device.drag(0.5, 0.5, 0.5, 0.9, 0)
 
+    @ui_action
     def flick3(self, from_x=0.5, from_y=0.8, to_x=0.5, to_y=0.2, repeat=1, interval=0.5, velocity=1000):
         '''全屏连续滑动（默认从下向滑动）
         该接口比flick2的滑动速度快，适用于性能测试
@@ -809,6 +963,7 @@ class Device(object):
         self._check_app_started()
         self._driver.device.drag(from_x, from_y, to_x, to_y, 0, repeat, interval, velocity)
 
+    @ui_action
     def deactivate_app_for_duration(self, seconds=3):
         '''将App置于后台一定时间
 
@@ -878,6 +1033,9 @@ class Device(object):
             files = self._driver.device.pull_file(bundle_id, remotepath, '/tmp', is_dir, is_delete)
             for f in files:
                 filepath = os.path.join(localpath, os.path.basename(f))
+                filepaths.append(filepath)
+                if self._fetch_by_blob(self._host, lambda: self._host.pull_file_handle(f), filepath):
+                    continue
                 with open(filepath, "wb") as fd:
                     data = self._host.pull_file_data(f, 0)
                     index = 1
@@ -888,7 +1046,6 @@ class Device(object):
                             fd.write(base64.decodebytes(data.encode('utf-8')))
                         data = self._host.pull_file_data(f, index)
                         index += 1
-                filepaths.append(filepath)
         else:
             filepaths = self._driver.device.pull_file(bundle_id, remotepath, localpath, is_dir, is_delete)
         return filepaths
@@ -910,15 +1067,43 @@ class Device(object):
             return self._driver.device.download_file_and_push(bundle_id, localpath, remotepath)
         else:
             if self._device_resource.host != DEFAULT_ADDR:
+                filepath = os.path.join('/tmp', os.path.basename(localpath))
                 with open(localpath, "rb") as fd:
-                    data = base64.b64encode(fd.read())
-                    if PY3:
-                        data = data.decode('ascii')
-                    filepath = os.path.join('/tmp', os.path.basename(localpath))
-                    self._host.push_file_data(data, filepath)
-                    localpath = filepath
+                    if not self._push_by_blob(fd, filepath):
+                        data = base64.b64encode(fd.read())
+                        if PY3:
+                            data = data.decode('ascii')
+                        self._host.push_file_data(data, filepath)
+                localpath = filepath
             return self._driver.device.push_file(bundle_id, localpath, remotepath)
 
+    def _push_by_blob(self, fd, filepath):
+        '''通过driver server的二进制通道上传文件，不经过base64编码
+
+        :param fd: 以二进制方式打开的本地文件对象
+        :type fd: file
+        :param filepath: driver server上的保存路径
+        :type filepath: str
+        :returns: boolean -- 是否上传成功，经过代理访问、driver server不支持或传输失败时返回False
+        '''
+        if self._ws_uri or not self._blob_supported:
+            return False
+        try:
+            token = self._host.push_file_handle(filepath)
+        except DriverApiError as e:
+            if 'is not supported by endpoint' in str(e):
+                self._blob_supported = False
+                return False
+            raise
+        offset = fd.tell()
+        try:
+            self._host.send_blob(token, fd)
+        except (DriverApiError, socket.error, http_client.HTTPException):
+            self._disable_blob()
+            fd.seek(offset) # 重新从头读取文件，通过RPC上传
+            return False
+        return True
+
     def list_files(self, bundle_id, file_path):
         '''列出手机上app中的文件或者目录
 
@@ -1004,11 +1189,13 @@ class Device(object):
         '''
         return self._driver.device.get_app_list(app_type)
 
+    @ui_action
     def lock(self):
         '''锁定设备（灭屏）
         '''
         self._driver.device.lock()
 
+    @ui_action
     def unlock(self):
         '''解锁设备
         '''
@@ -1022,6 +1209,7 @@ class Device(object):
         '''
         self._driver.device.volume(cmd)
 
+    @ui_action
     def _screen_direction(self, direct):
         '''设置屏幕方向
 
@@ -1030,6 +1218,7 @@ class Device(object):
         '''
         self._driver.device.screen_direction(direct)
 
+    @ui_action
     def _siri(self, cmd):
         '''siri交互
 
@@ -1038,6 +1227,7 @@ class Device(object):
         '''
         self._driver.device.siri(cmd)
 
+    @ui_action
     def _dismiss_alert(self, rule):
         '''弹窗处理
 
@@ -1046,6 +1236,7 @@ class Device(object):
         '''
         self._driver.device.dismiss_alert(rule)
 
+    @ui_action
     def switch_network(self, network_type, nlc_type):
         '''实现网络切换
 
@@ -1178,4 +1369,7 @@ class Keyboard(object):
         :param keys: 要输入的字符串
         :type keys: str
         '''
-        self._driver.device.send_keys(keys)
+        try:
+            self._driver.device.send_keys(keys)
+        finally:
+            self._device.invalidate_snapshots()
@@ -0,0 +1,449 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''基于asyncio的RPC Server（仅支持Python 3）
+'''
+
+import asyncio
+import base64
+import gzip
+import hashlib
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from qt4i.driver.rpc import BLOB_PATH_PREFIX
+from qt4i.driver.rpc import DEFAULT_MAX_WORKERS
+from qt4i.driver.rpc import Fault
+from qt4i.driver.rpc import JSONRPCDispatcher
+from qt4i.driver.rpc import METRICS_CONTENT_TYPE
+from qt4i.driver.rpc import METRICS_PATH
+from qt4i.driver.rpc import RequestScheduler
+from qt4i.driver.rpc import STREAM_CHUNK_SIZE
+from qt4i.driver.rpc import STREAM_HEADER
+from qt4i.driver.rpc import WS_MAGIC_KEY
+from qt4i.driver.rpc import WS_MAX_CONCURRENT_REQUESTS
+from qt4i.driver.rpc import WS_SUBPROTOCOL
+from qt4i.driver.rpc import WebSocketStream
+from qt4i.driver.rpc import json_codec
+from qt4i.driver.rpc import msgpack_codec
+from qt4i.driver.rpc import _iter_json_chunks
+from qt4i.driver.rpc import _ws_frame
+from qt4i.driver.rpc import _ws_unmask
+from qt4i.driver.tools import logger
+
+
+class AsyncJSONRPCServer(JSONRPCDispatcher):
+    """asyncio RPC Server，连接由事件循环处理，不再为每个请求创建线程；
+    请求的解析和序列化在有界线程池中执行，超出线程数的请求排队等待；
+    设备请求与SimpleJSONRPCServer一样由RequestScheduler按设备FIFO执行，在设备队列中等待时不占用线程池，
+    某个设备的请求积压不影响其他设备和host的请求。
+    支持msgpack编码、chunked流式响应和多路复用的WebSocket通道
+    """
+    encode_threshold = 1400 # 与SimpleXMLRPCRequestHandler一致，超过该长度的响应进行gzip压缩
+    max_chunk_size = 10*1024*1024
+
+    def __init__(self, urls, addr, max_workers=DEFAULT_MAX_WORKERS):
+        """Constructor
+
+        :param urls: list of URL pattern and RPC end point class
+        :param addr: listening address
+        :param max_workers: 执行end point方法的线程数上限
+        :type urls: list
+        :type addr: tuple
+        :type max_workers: int
+        """
+        JSONRPCDispatcher.__init__(self, urls)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rpc-worker')
+        self._scheduler = RequestScheduler(max_workers)
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, addr[0], addr[1]))
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+
+    def serve_forever(self):
+        '''运行事件循环直到调用shutdown
+        '''
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def shutdown(self):
+        '''停止事件循环，可在其他线程中调用
+        '''
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def server_close(self):
+        '''关闭监听端口和线程池
+        '''
+        self._server.close()
+        if not self._loop.is_running():
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+        self._executor.shutdown(wait=False)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = await self._read_headers(reader)
+                if len(parts) != 3:
+                    self._write_response(writer, 400, b'', close=True)
+                    break
+                command, path, version = parts
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                if command == 'GET' and path == METRICS_PATH:
+                    body = self.metrics.to_prometheus().encode('utf-8')
+                    self._write_response(writer, 200, body, close=not keep_alive, content_type=METRICS_CONTENT_TYPE)
+                    await writer.drain()
+                    if not keep_alive:
+                        break
+                    continue
+                if command == 'GET' and headers.get('upgrade', '').lower() == 'websocket':
+                    await self._handle_websocket(path, headers, reader, writer)
+                    break
+                if path.startswith(BLOB_PATH_PREFIX) and command in ('GET', 'PUT', 'POST'):
+                    if not await self._handle_blob(command, path, headers, reader, writer, keep_alive):
+                        break
+                    continue
+                if command != 'POST':
+                    self._write_response(writer, 501, b'', close=True)
+                    break
+                data = await reader.readexactly(int(headers.get('content-length', 0)))
+                codec = self._accept_codec(headers)
+                stream = codec is json_codec and version == 'HTTP/1.1' \
+                    and headers.get(STREAM_HEADER.lower()) == 'chunked'
+                status, response, chunks = await self._dispatch(data, path, codec, stream)
+                accept_gzip = 'gzip' in headers.get('accept-encoding', '')
+                if chunks is not None:
+                    if not await self._send_streamed(writer, response, chunks, accept_gzip, keep_alive):
+                        break
+                    continue
+                gzipped = False
+                if len(response) > self.encode_threshold and accept_gzip:
+                    response = gzip.compress(response)
+                    gzipped = True
+                content_type = codec.content_type if status == 200 else json_codec.content_type
+                self._write_response(writer, status, response, close=not keep_alive, gzipped=gzipped,
+                                     content_type=content_type)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.get_logger().exception('AsyncJSONRPCServer')
+        finally:
+            writer.close()
+
+    async def _handle_blob(self, command, path, headers, reader, writer, keep_alive):
+        '''二进制通道，GET下载数据，PUT/POST上传文件，与SimpleJSONRPCRequestHandler共用BlobStore
+
+        :returns: boolean -- 连接是否可以继续使用
+        '''
+        blob = self.blobs.take(path[len(BLOB_PATH_PREFIX):], command != 'GET')
+        if blob is None:
+            # 未读取的请求体不能留在连接上
+            self._write_response(writer, 404, b'blob does not exist or has expired', close=True, content_type='text/plain')
+            await writer.drain()
+            return False
+        try:
+            if blob.upload:
+                await self._receive_blob(blob, int(headers.get('content-length', 0)), reader)
+                self._write_response(writer, 200, b'', close=not keep_alive, content_type='application/octet-stream')
+            elif blob.data is not None:
+                self._write_response(writer, 200, blob.data, close=not keep_alive, content_type='application/octet-stream')
+            else:
+                await self._send_blob_file(blob.path, writer, keep_alive)
+            await writer.drain()
+        finally:
+            blob.discard()
+        return keep_alive
+
+    async def _receive_blob(self, blob, size, reader):
+        with open(blob.path, 'wb' if blob.override else 'ab') as fd:
+            while size:
+                data = await reader.read(min(size, STREAM_CHUNK_SIZE))
+                if not data:
+                    raise asyncio.IncompleteReadError(data, size)
+                await self._loop.run_in_executor(None, fd.write, data) # 文件读写不占用RPC线程池
+                size -= len(data)
+
+    async def _send_blob_file(self, path, writer, keep_alive):
+        with open(path, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            self._write_response(writer, 200, b'', close=not keep_alive,
+                                 content_type='application/octet-stream', content_length=size)
+            while True:
+                data = await self._loop.run_in_executor(None, fd.read, STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+
+    async def _read_headers(self, reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    def _accept_codec(self, headers):
+        '''按请求的Accept头选择响应的编码，客户端支持时使用msgpack
+        '''
+        if msgpack_codec and msgpack_codec.content_type in headers.get('accept', ''):
+            return msgpack_codec
+        return json_codec
+
+    def _parse_and_prepare(self, data, path, websocket=False):
+        '''在线程池中解析请求并完成路由，不执行end point方法
+
+        :param websocket: 是否为WebSocket消息，消息中的path为请求的URL路径
+        :type websocket: boolean
+        :returns: tuple -- (准备结果, 流量统计)，准备结果为错误响应、_PreparedCall或它们的列表
+        '''
+        self._begin_transfer(len(data))
+        try:
+            request = json_codec.loads(data)
+        except ValueError:
+            prepared = Fault(-32700, 'JSON parsing error').to_dict()
+        else:
+            if websocket:
+                for it in (request if isinstance(request, list) else [request]):
+                    if isinstance(it, dict):
+                        path = it.pop('path', path)
+            if not isinstance(request, list):
+                prepared = self._prepare_call(request, path)
+            elif request:
+                prepared = [self._prepare_call(it, path) for it in request]
+            else:
+                prepared = Fault(-32600, 'Empty batch request').to_dict()
+        transfer = (self._transfer.calls, self._transfer.bytes_in)
+        self._transfer.calls = None
+        return prepared, transfer
+
+    async def _execute(self, call):
+        '''执行end point方法，设备请求在RequestScheduler的队列中等待时不占用线程池
+
+        :returns: tuple -- (返回值, 异常)
+        '''
+        call.start_time = time.time()
+        args = (call.method, call.params)
+        try:
+            if call.serial:
+                result = await self._wait_task(self._scheduler.submit(call.queue_key, call.endpoint._dispatch, args))
+            else:
+                # host请求和回调类请求不排队，参考JSONRPCDispatcher._invoke
+                result = await self._loop.run_in_executor(
+                    self._executor, self._scheduler.run_inline, call.device, call.endpoint._dispatch, args)
+            error = None
+        except Exception as e:
+            result, error = None, e
+        call.end_time = time.time()
+        return result, error
+
+    def _wait_task(self, task):
+        '''返回在RequestScheduler的工作线程执行完task后完成的future
+        '''
+        future = self._loop.create_future()
+        def set_result(task):
+            if future.cancelled():
+                return
+            try:
+                future.set_result(task.result())
+            except Exception as e:
+                future.set_exception(e)
+        task.add_done_callback(lambda task: self._loop.call_soon_threadsafe(set_result, task))
+        return future
+
+    def _finish_and_dumps(self, prepared, outcomes, transfer, codec, stream):
+        '''在线程池中生成响应并序列化
+
+        :returns: tuple -- (响应数据, 剩余分块的生成器, 流量统计)，不需要分块发送时后两项为None
+        '''
+        self._transfer.calls, self._transfer.bytes_in = transfer
+        responses = []
+        for call, outcome in zip(prepared if isinstance(prepared, list) else [prepared], outcomes):
+            if outcome is None:
+                responses.append(call)
+            elif outcome[1] is not None:
+                responses.append(self._call_failed(call, outcome[1]))
+            else:
+                responses.append(self._call_done(call, outcome[0]))
+        response = responses if isinstance(prepared, list) else responses[0]
+        if not stream:
+            return self.dumps_response(response, codec), None, None
+        chunks = _iter_json_chunks(response)
+        buffered = []
+        try:
+            for chunk in chunks:
+                buffered.append(chunk)
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    # 剩余分块在其他线程中生成，流量统计在发送完成后记录
+                    transfer = (self._transfer.calls, self._transfer.bytes_in)
+                    self._transfer.calls = None
+                    return b''.join(buffered), chunks, transfer
+        except (TypeError, ValueError):
+            return self.dumps_response(response), None, None
+        body = b''.join(buffered)
+        self._end_transfer(len(body))
+        return body, None, None
+
+    async def _dispatch(self, data, path, codec=json_codec, stream=False, websocket=False):
+        try:
+            prepared, transfer = await self._loop.run_in_executor(
+                self._executor, self._parse_and_prepare, data, path, websocket)
+            outcomes = []
+            for call in (prepared if isinstance(prepared, list) else [prepared]): # 批量请求按顺序执行
+                outcomes.append(None if isinstance(call, dict) else await self._execute(call))
+            response, chunks, transfer = await self._loop.run_in_executor(
+                self._executor, self._finish_and_dumps, prepared, outcomes, transfer, codec, stream)
+            status = 200
+        except Exception:
+            response, chunks, transfer = Fault().response(), None, None
+            status = 500
+            logger.get_logger().exception("ProtocolError:%s" % response)
+        if response is None:
+            response = b''
+        if isinstance(response, str):
+            response = response.encode('utf-8')
+        if chunks is not None:
+            chunks = (chunks, transfer)
+        return status, response, chunks
+
+    async def _handle_websocket(self, path, headers, reader, writer):
+        '''WebSocket长连接，与SimpleJSONRPCRequestHandler.handle_websocket的协议相同，
+        每条消息为携带path的JSON-RPC请求，并发执行并按完成顺序返回
+        '''
+        key = headers.get('sec-websocket-key')
+        subprotocols = [it.strip() for it in headers.get('sec-websocket-protocol', '').split(',')]
+        if not key or WS_SUBPROTOCOL not in subprotocols:
+            self._write_response(writer, 400, b'', close=True)
+            await writer.drain()
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC_KEY).encode('utf-8')).digest()).decode('ascii')
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: %s\r\n'
+                      'Sec-WebSocket-Protocol: %s\r\n\r\n' % (accept, WS_SUBPROTOCOL)).encode('latin-1'))
+        await writer.drain()
+        slots = asyncio.Semaphore(WS_MAX_CONCURRENT_REQUESTS)
+        write_lock = asyncio.Lock()
+        while True:
+            message = await self._ws_recv_message(reader, writer)
+            if message is None:
+                return
+            await slots.acquire() # 在途请求达到上限时不再读取新消息
+            self._loop.create_task(self._ws_dispatch(path, message, writer, slots, write_lock))
+
+    async def _ws_dispatch(self, path, message, writer, slots, write_lock):
+        try:
+            _, response, _ = await self._dispatch(message, path, websocket=True)
+            async with write_lock:
+                writer.write(_ws_frame(WebSocketStream.OP_TEXT, response))
+                await writer.drain()
+        except ConnectionError:
+            pass # 连接已断开，客户端会让等待中的调用失败
+        finally:
+            slots.release()
+
+    async def _ws_recv_message(self, reader, writer):
+        '''读取一条完整的消息，连接关闭时返回None
+        '''
+        fragments = []
+        while True:
+            b0, b1 = await reader.readexactly(2)
+            fin = b0 & 0x80
+            opcode = b0 & 0x0f
+            length = b1 & 0x7f
+            if length == 126:
+                length = struct.unpack('>H', await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', await reader.readexactly(8))[0]
+            mask = await reader.readexactly(4) if b1 & 0x80 else None
+            payload = await reader.readexactly(length) if length else b''
+            if mask:
+                payload = _ws_unmask(payload, mask)
+            if opcode == WebSocketStream.OP_CLOSE:
+                writer.write(_ws_frame(WebSocketStream.OP_CLOSE, payload[:2]))
+                return None
+            elif opcode == WebSocketStream.OP_PING:
+                writer.write(_ws_frame(WebSocketStream.OP_PONG, payload))
+            elif opcode != WebSocketStream.OP_PONG:
+                fragments.append(payload)
+                if fin:
+                    return b''.join(fragments)
+
+    async def _send_streamed(self, writer, first_chunk, chunks, gzipped, keep_alive):
+        '''使用chunked编码发送超过一个分块的响应，剩余分块在线程池中逐块序列化
+
+        :returns: boolean -- 连接是否可以继续使用
+        '''
+        chunks, (calls, bytes_in) = chunks
+        headers = ['HTTP/1.1 200 OK',
+                   'Content-Type: %s' % json_codec.content_type,
+                   'Transfer-Encoding: chunked',
+                   'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+        compressor = None
+        if gzipped:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            headers.append('Content-Encoding: gzip')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+        bytes_out = 0
+        chunk = first_chunk
+        try:
+            while chunk is not None:
+                bytes_out += len(chunk)
+                self._write_chunk(writer, compressor.compress(chunk) if compressor else chunk)
+                await writer.drain()
+                chunk = await self._loop.run_in_executor(self._executor, next, chunks, None)
+        except (TypeError, ValueError):
+            # 已经开始发送，只能断开连接让客户端报错
+            logger.get_logger().exception("ProtocolError: failed to serialize response")
+            return False
+        if compressor:
+            self._write_chunk(writer, compressor.flush())
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        self._transfer.calls, self._transfer.bytes_in = calls, bytes_in
+        self._end_transfer(bytes_out)
+        return keep_alive
+
+    def _write_chunk(self, writer, data):
+        if data: # 空分块表示响应结束
+            writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
+    def _write_response(self, writer, status, body, close=False, gzipped=False, content_type='application/json-rpc',
+                        content_length=None):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error', 501: 'Not Implemented'}
+        if content_length is None:
+            content_length = len(body)
+        headers = ['HTTP/1.1 %d %s' % (status, reasons[status]),
+                   'Content-Type: %s' % content_type,
+                   'Content-Length: %d' % content_length,
+                   'Connection: %s' % ('close' if close else 'keep-alive')]
+        if gzipped:
+            headers.append('Content-Encoding: gzip')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
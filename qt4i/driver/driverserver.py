@@ -25,6 +25,7 @@ import sys
 import time
 from six import string_types
     
+from qt4i.driver.rpc import DEFAULT_MAX_WORKERS
 from qt4i.driver.rpc import SimpleJSONRPCServer
 from qt4i.driver.tools import logger as logging 
 from qt4i.driver.util import Process
@@ -67,6 +68,11 @@ main_parser.add_argument('--agent_port', '-a', metavar='AGENTPORT', dest='agent_
                          help='listening port of xctest agent, port %s is used by default' % DEFAULT_AGENT_PORT)
 main_parser.add_argument('--web_port', '-w', metavar='WEBPORT', dest='web_port', default=None,
                          help='listening port of simulator for webview testing')
+main_parser.add_argument('--server', '-s', metavar='SERVER', dest='server_type', default='thread', choices=['thread', 'asyncio'],
+                         help='implementation of driver server(thread or asyncio, asyncio requires python3), both serve JSON-RPC over HTTP '
+                              'and the WebSocket channel, "thread" is used by default')
+main_parser.add_argument('--workers', metavar='WORKERS', dest='max_workers', type=int, default=DEFAULT_MAX_WORKERS,
+                         help='max number of worker threads executing requests, %s is used by default' % DEFAULT_MAX_WORKERS)
 main_parser.add_argument('--register', '-r', dest='endpoint_clss', default=None,
                          help='the endpoint classes registered to driverserver, for example, "perflib.ios.fps.FPSMonitor,perflib.ios.leaks.LeaksMonitor"')
      
@@ -228,11 +234,14 @@ class Daemon(object):
 
 class DriverManager(Daemon):
     
-    def __init__(self, pidfile, urls, address, port, udid, agent_port, web_port):
+    def __init__(self, pidfile, urls, address, port, udid, agent_port, web_port, server_type='thread',
+                 max_workers=DEFAULT_MAX_WORKERS):
         '''构造（原则：Driver的配置只在此处配置）
         '''
         Daemon.__init__(self, pidfile)
         self._urls = urls
+        self._server_type = server_type
+        self._max_workers = max_workers
         self._driver_address = address
         self._driver_port = port
         self._driver_url = 'http://%s:%d' % (self._driver_address, self._driver_port)
@@ -284,8 +293,14 @@ class DriverManager(Daemon):
             agent_manager = XCUITestAgentManager()
             agent_manager.start_agent(device_id=self._udid, server_port=self._agent_port, retry=1)
         
-        server = SimpleJSONRPCServer(urls=urls, addr=(self._driver_address, self._driver_port))
-        logger.info('DriverServer(%s:%s) - started' % (self._driver_address, self._driver_port))
+        if self._server_type == 'asyncio':
+            from qt4i.driver.aiorpc import AsyncJSONRPCServer
+            server = AsyncJSONRPCServer(urls=self._urls, addr=(self._driver_address, self._driver_port),
+                                        max_workers=self._max_workers)
+        else:
+            server = SimpleJSONRPCServer(urls=self._urls, addr=(self._driver_address, self._driver_port),
+                                         max_workers=self._max_workers)
+        logger.info('DriverServer(%s:%s) - started (%s)' % (self._driver_address, self._driver_port, self._server_type))
         server.serve_forever()
         
     def cleanup(self):
@@ -376,7 +391,8 @@ if __name__ == '__main__':
                 cls_name = endpoint_cls.__name__
                 urls.append(("^device/(?P<device_id>[\w\-]+)/$", "^%s\..*" % cls_name.lower(), endpoint_cls))
 
-    dm = DriverManager(args.pidfile, urls, args.host, int(args.port), args.udid, int(args.agent_port), args.web_port)
+    dm = DriverManager(args.pidfile, urls, args.host, int(args.port), args.udid, int(args.agent_port), args.web_port,
+                       args.server_type, args.max_workers)
     if args.func == 'start':
         dm.start()
           
@@ -23,6 +23,7 @@ import six
 from qt4i.driver.rpc import rpc_method
 from qt4i.driver.rpc import RPCEndpoint
 from qt4i.driver.tools.dt import DT
+from qt4i.driver.tools import screencapture
 from qt4i.driver.xctest.agent import XCUITestAgentManager
 
 BUFFER_SIZE = 1024*1024*100
@@ -77,6 +78,28 @@ class RPCServerHost(RPCEndpoint):
 
         return os.path.isfile(file_path)
 
+    @rpc_method
+    def pull_file_handle(self, filepath):
+        '''登记待下载的文件，客户端通过二进制通道下载，参考RPCClientProxy.fetch_blob
+
+        :param filepath: file path of rpc server
+        :type filepath: str
+        :returns: str -- token
+        '''
+        return self.rpc_server.blobs.add_file(filepath)
+
+    @rpc_method
+    def push_file_handle(self, file_path, override=True):
+        '''登记上传文件的保存路径，客户端通过二进制通道上传，参考RPCClientProxy.send_blob
+
+        :param file_path: file path of rpc server
+        :type file_path: str
+        :param override: 是否覆盖已存在的文件
+        :type override: boolean
+        :returns: str -- token
+        '''
+        return self.rpc_server.blobs.add_upload(file_path, override)
+
     @rpc_method
     def list_devices(self):
         '''list all devices of rpc server host
@@ -129,9 +152,62 @@ class RPCServerHost(RPCEndpoint):
         '''
         return True
 
+    @rpc_method
+    def get_server_stats(self):
+        '''获取driver server的请求调度统计
+
+        :returns: dict -- 包括工作线程数、繁忙线程数，以及每个设备的队列深度、等待时间和执行时间(毫秒)
+        '''
+        return self.rpc_server.get_server_stats()
+
+    @rpc_method
+    def get_metrics(self):
+        '''获取JSON-RPC请求和agent指令的统计，Prometheus格式的数据可以通过GET /metrics获取
+
+        :returns: dict -- {层(rpc或agent): {设备udid: {方法名: {count, errors, avg_ms, max_ms, p50_ms, p95_ms, p99_ms, bytes_in, bytes_out}}}}
+        '''
+        return self.rpc_server.get_metrics()
+
+    @rpc_method
+    def get_screen_stats(self, port=screencapture.DEFAULT_PORT):
+        '''获取本机截屏服务的实时统计，截屏服务结束前也可以获取
+
+        :param port: 截屏服务的监听端口
+        :type port: int
+        :returns: dict -- {'clients': [每个推流客户端的profile、delivered、dropped、fps、lag_ms、max_lag_ms], 'suppressed_frames': 未发布的帧数}
+        '''
+        return screencapture.get_screen_stats(port)
+
+    @rpc_method
+    def start_agents(self, udids, max_workers=None, wait=True):
+        '''并行启动多台设备的Agent，只支持设备主机使用
+        
+        :param udids: 设备udid列表
+        :type udids: list
+        :param max_workers: 最大并发数，默认为CPU核数的一半，可以通过QT4I_AGENT_START_CONCURRENCY配置
+        :type max_workers: int
+        :param wait: 是否等待全部启动完成，为False时立即返回，通过get_agents_progress查询进度
+        :type wait: boolean
+        :returns: dict -- {udid: {'state': pending|starting|started|failed, 'elapsed_ms': 启动耗时, 'error': 失败原因}}
+        '''
+        def on_finished(udid, progress):
+            self.rpc_server.invalidate_endpoints(udid)
+        return self.agent_manager.start_agents(udids, max_workers, on_finished, wait)
+
+    @rpc_method
+    def get_agents_progress(self, udids=None):
+        '''获取start_agents的启动进度
+        
+        :param udids: 设备udid列表，默认为全部
+        :type udids: list
+        :returns: dict -- 与start_agents的返回值相同
+        '''
+        return self.agent_manager.get_start_progress(udids)
+
     @rpc_method
     def stop_all_agents(self):
         '''
         stop all agents
         '''
         XCUITestAgentManager.stop_all_agents()
+        self.rpc_server.invalidate_endpoints()
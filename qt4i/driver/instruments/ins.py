@@ -316,6 +316,7 @@ class InstrumentsCallBacker(RPCEndpoint):
     '''
 
     rpc_name_prefix = "ins."
+    rpc_serial = False # 回调在device请求执行期间到达，不能排在其后
     CommandTimeout = 90 
        
     def __init__(self, rpc_server, device_id):
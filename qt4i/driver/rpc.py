@@ -17,15 +17,29 @@
 
 from __future__ import absolute_import, print_function
 
+import base64
+import binascii
+import collections
+import errno
+import hashlib
+import itertools
 import json
+import os
 import random
 import re
+import socket
 import string
+import struct
+import sys
+import threading
+import time
+import zlib
 import six
 from six.moves.socketserver import ThreadingMixIn
 from six.moves.xmlrpc_server import SimpleXMLRPCServer
 from six.moves.xmlrpc_server import SimpleXMLRPCRequestHandler
 import six.moves.xmlrpc_client as xmlrpc_client
+import six.moves.http_client as http_client
 from six.moves.http_client import HTTPResponse
 from six import StringIO
 from six import PY2
@@ -38,6 +52,9 @@ else:
     from urllib.parse import splithost
 
 from qt4i.driver.tools import logger
+from qt4i.driver.tools.metrics import get_metrics_registry
+from qt4i.driver.util import get_json_codec
+from qt4i.driver.util import get_msgpack_codec
 
 
 try:
@@ -46,6 +63,21 @@ except ImportError:
     fcntl = None
 
 IDCHARS = string.ascii_lowercase+string.digits
+json_codec = get_json_codec()
+msgpack_codec = get_msgpack_codec() # 未安装msgpack时为None
+DEFAULT_POOL_SIZE = 8 # 每个driver server保留的空闲连接数上限
+DEFAULT_POOL_IDLE_TIMEOUT = 60 # 空闲连接的回收时间(秒)
+DEFAULT_MAX_WORKERS = 32 # 执行end point方法的工作线程数上限
+DEFAULT_MAX_CONNECTIONS = 128 # SimpleJSONRPCServer同时处理的连接数上限，每个连接占用一个线程
+BLOB_PATH_PREFIX = '/blob/' # 二进制通道的URL前缀，后接token
+BLOB_EXPIRE_TIME = 300 # 二进制数据未被取走的过期时间(秒)
+STREAM_HEADER = 'X-JSONRPC-Stream' # 客户端支持chunked流式响应的请求头
+STREAM_CHUNK_SIZE = 64*1024 # 流式响应和解码的分块大小
+WS_SUBPROTOCOL = 'qt4i-jsonrpc' # 多路复用WebSocket通道的子协议
+WS_MAX_CONCURRENT_REQUESTS = 16 # 单个WebSocket连接同时执行的请求数上限，超出后暂停读取新消息
+WS_MAGIC_KEY = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+METRICS_PATH = '/metrics' # Prometheus文本格式的统计数据
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
 
 
 def random_id(length=8):
@@ -79,18 +111,27 @@ class RPCEndpoint(object):
     """RPC end point, subclass to define a RPC end point
     """
     rpc_name_prefix = ""
+    rpc_serial = True # 同一设备的请求是否由RequestScheduler串行执行
+    _rpc_methods = None # 各end point类的方法查找缓存，key为RPC方法名
+
+    @classmethod
+    def _lookup_rpc_method(cls, method):
+        if cls.__dict__.get('_rpc_methods') is None:
+            cls._rpc_methods = {}
+        m = cls._rpc_methods.get(method)
+        if m is None:
+            if not method.startswith(cls.rpc_name_prefix):
+                raise Exception('method "%s" is not supported by endpoint "%s"' % (method, cls.__name__))
+            m = getattr(cls, method[len(cls.rpc_name_prefix):], None)
+            if m is None:
+                raise Exception('method "%s" is not supported by endpoint "%s"' % (method, cls.__name__))
+            if not isinstance(m, _RPCMethod):
+                raise Exception('method "%s" is not exposed by endpoint "%s"' % (method, cls.__name__))
+            cls._rpc_methods[method] = m
+        return m
 
     def _dispatch(self, method, params):
-        if not method.startswith(self.rpc_name_prefix):
-            raise Exception('method "%s" is not supported by endpoint "%s"' % (method, type(self).__name__))
-        try:
-            m = getattr(self, method[len(self.rpc_name_prefix):])
-        except AttributeError:
-            raise Exception('method "%s" is not supported by endpoint "%s"' % (method, type(self).__name__))
-        else:
-            if not isinstance(m, _RPCMethod):
-                raise Exception('method "%s" is not exposed by endpoint "%s"' % (method, type(self).__name__))
-            return m(*params)
+        return self._lookup_rpc_method(method).method(self, *params)
 
     def create_json_command(self, method, *params):
         '''serialize function to JSON Object
@@ -112,7 +153,8 @@ class RPCClientProxy(object):
     '''
 
     def __init__(self, uri, ws_uri=None,transport=None, encoding=None, verbose=0,
-                 allow_none=0, use_datetime=0, context=None):
+                 allow_none=0, use_datetime=0, context=None, keep_alive=True,
+                 pool_size=DEFAULT_POOL_SIZE, pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
         # establish a "logical" server connection
         if PY2 and isinstance(uri, six.text_type):
             uri = uri.encode('ISO-8859-1')
@@ -124,12 +166,17 @@ class RPCClientProxy(object):
         if not self.__handler:
             self.__handler = "/RPC2"
         self.__ws_uri = ws_uri
+        self.__protocol = protocol
+        self.__context = context
 
         if transport is None:
+            pool = None
+            if keep_alive:
+                pool = ConnectionPool.get_pool(protocol, self.__host, context, pool_size, pool_idle_timeout)
             if protocol == "https":
-                transport = SafeTransport(use_datetime=use_datetime, context=context)
+                transport = SafeTransport(use_datetime=use_datetime, context=context, pool=pool)
             else:
-                transport = Transport(use_datetime=use_datetime)
+                transport = Transport(use_datetime=use_datetime, pool=pool)
         self.__transport = transport
 
         self.__encoding = encoding
@@ -152,6 +199,8 @@ class RPCClientProxy(object):
 
     def _ws_request(self, request):
         import websocket
+        if not isinstance(request, six.binary_type):
+            request = request.encode("UTF-8")
         self.__ws = websocket.WebSocket()
         self.__ws.connect(self.__ws_uri)
         header = "POST {abs_path} HTTP/1.1\r\n" \
@@ -167,24 +216,35 @@ class RPCClientProxy(object):
 
     def __request(self, methodname, params):
         # call a method on the remote server
+        response = self.__send(self.__build_request(methodname, params))
+        if not isinstance(response, dict):
+            raise TypeError('Response is not dict')
+        return self.__parse_result(response)
+
+    def __build_request(self, methodname, params):
         request = {"jsonrpc": "2.0"}
         if len(params) > 0:
             request["params"] = params
         request["id"] = random_id()
         request["method"] = methodname
-        request = json.dumps(request)
+        return request
+
+    def __send(self, request):
         if self.__ws_uri:
-            response = self._ws_request(request)
+            response = WebSocketChannel.get_channel(self.__ws_uri).request(self.__handler, request)
+            if response is None:
+                response = self._ws_request(json_codec.dumpb(request))
         else:
+            # transport按响应的Content-Type完成解码
             response = self.__transport.request(
                 self.__host,
                 self.__handler,
-                request,
+                json_codec.dumpb(request),
                 verbose=self.__verbose
                 )
-        response = json.loads(response)
-        if not isinstance(response, dict):
-            raise TypeError('Response is not dict')
+        return response
+
+    def __parse_result(self, response):
         if 'error' in response.keys() and response['error'] is not None:
             if 'extra' in response['error']:
                 raise DriverApiError(response['error']['message'], response['error']['extra'])
@@ -192,6 +252,8 @@ class RPCClientProxy(object):
                 raise DriverApiError(response['error']['message'])
         else:
             response = response['result'][0]
+            if not PY2: # Python 3的字符串已经是unicode，不需要逐层转换
+                return response
             if isinstance(response, dict):
                 return self.encode_dict(response, "UTF-8")
             elif isinstance(response, list):
@@ -200,6 +262,97 @@ class RPCClientProxy(object):
                 return response.encode("UTF-8")
             return response
 
+    def __batch_request(self, calls):
+        requests = [self.__build_request(methodname, params) for methodname, params, _ in calls]
+        responses = self.__send(requests)
+        if not isinstance(responses, list):
+            # 整个批量请求被拒绝（例如JSON解析失败），所有调用均失败
+            if isinstance(responses, dict) and responses.get('error'):
+                error = DriverApiError(responses['error']['message'])
+            else:
+                error = TypeError('Response is not list')
+            for _, _, future in calls:
+                future.set_exception(error)
+            return
+        responses = dict((it.get('id'), it) for it in responses if isinstance(it, dict))
+        for request, (_, _, future) in zip(requests, calls):
+            response = responses.get(request["id"])
+            if response is None:
+                future.set_exception(DriverApiError('no response for request "%s"' % request["id"]))
+                continue
+            try:
+                future.set_result(self.__parse_result(response))
+            except DriverApiError as e:
+                future.set_exception(e)
+
+    def __blob_request(self, method, token, body=None, size=None):
+        conn = ConnectionPool(self.__protocol, self.__host, self.__context).new_connection()
+        conn.putrequest(method, BLOB_PATH_PREFIX + token)
+        if body is not None:
+            conn.putheader("Content-Type", "application/octet-stream")
+            conn.putheader("Content-Length", str(size))
+        conn.endheaders()
+        if body is not None:
+            while True:
+                data = body.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                conn.send(data)
+        resp = conn.getresponse()
+        if resp.status != 200:
+            resp.read()
+            conn.close()
+            raise DriverApiError('blob "%s" is not available: %s %s' % (token, resp.status, resp.reason))
+        return conn, resp
+
+    def fetch_blob(self, token, fd):
+        '''通过二进制通道下载RPC方法登记的数据，直接写入文件
+
+        :param token: RPC方法返回的token
+        :type token: str
+        :param fd: 以二进制方式打开的文件对象
+        :type fd: file
+        :returns: int -- 写入的字节数
+        '''
+        conn, resp = self.__blob_request("GET", token)
+        try:
+            size = 0
+            while True:
+                data = resp.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                fd.write(data)
+                size += len(data)
+            return size
+        finally:
+            conn.close()
+
+    def send_blob(self, token, fd):
+        '''通过二进制通道上传文件到RPC方法登记的路径
+
+        :param token: RPC方法返回的token
+        :type token: str
+        :param fd: 以二进制方式打开的文件对象
+        :type fd: file
+        '''
+        size = os.fstat(fd.fileno()).st_size - fd.tell()
+        conn, resp = self.__blob_request("PUT", token, fd, size)
+        resp.read()
+        conn.close()
+
+    def batch(self):
+        '''创建批量调用，with语句块内的调用将在退出时通过一次请求发送，
+        返回值为RPCFuture，批量请求发送后通过result()获取结果，例如：
+
+            with driver.batch() as batch:
+                label = batch.element.get_element_attr(element_id, 'label')
+                rect = batch.element.get_rect(element_id)
+            print(label.result(), rect.result())
+
+        :returns: RPCBatch
+        '''
+        return RPCBatch(self.__batch_request)
+
     def __repr__(self):
         return (
             "<ServerProxy for %s%s>" %
@@ -262,6 +415,79 @@ class RPCClientProxy(object):
         return content
 
 
+class RPCFuture(object):
+    '''批量调用中单个调用的结果
+    '''
+
+    def __init__(self, methodname):
+        self.methodname = methodname
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done = True
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
+    def done(self):
+        return self._done
+
+    def exception(self):
+        '''获取调用的异常，调用成功则返回None
+        '''
+        if not self._done:
+            raise RuntimeError('batch request of "%s" has not been sent' % self.methodname)
+        return self._exception
+
+    def result(self):
+        '''获取调用的返回值，调用失败则抛出对应的异常
+        '''
+        if self.exception() is not None:
+            raise self._exception
+        return self._result
+
+    def __repr__(self):
+        return '<RPCFuture %s done=%s>' % (self.methodname, self._done)
+
+
+class RPCBatch(object):
+    '''批量调用，收集调用后按顺序在一次请求中发送
+    '''
+
+    def __init__(self, send_method):
+        self.__send = send_method
+        self.__calls = []
+
+    def __add(self, methodname, params):
+        future = RPCFuture(methodname)
+        self.__calls.append((methodname, params, future))
+        return future
+
+    def __getattr__(self, name):
+        return xmlrpc_client._Method(self.__add, name)
+
+    def __len__(self):
+        return len(self.__calls)
+
+    def execute(self):
+        '''发送已收集的调用
+        '''
+        calls, self.__calls = self.__calls, []
+        if calls:
+            self.__send(calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+
+
 class DriverApiError(Exception):
     '''Driver API Error
     '''
@@ -290,21 +516,396 @@ class Fault(object):
         else:
             return {"code": self.faultCode, "message": self.faultString, "extra":self.extra}
 
+    def to_dict(self):
+        return {"jsonrpc": "2.0", "error":self.error(), "id":self.rpcid}
+
     def response(self):
-        return json.dumps({"jsonrpc": "2.0", "error":self.error(), "id":self.rpcid})
+        return json.dumps(self.to_dict())
 
     def __repr__(self):
         return '<Fault %s: %s>' % (self.faultCode, self.faultString)
 
 
+class ConnectionPool(object):
+    '''HTTP/1.1 keep-alive连接池，同一driver server的所有RPCClientProxy共享一个连接池
+    '''
+    _pools = {}  # key为(protocol, host, context, max_size, idle_timeout)
+    _pools_lock = threading.Lock()
+
+    def __init__(self, protocol, host, context=None, max_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        self._protocol = protocol
+        self._host = host
+        self._context = context
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = collections.deque()  # [(connection, last_used_time), ...]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls, protocol, host, context=None, max_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        '''获取指定driver server的连接池，不存在则创建；参数都相同的RPCClientProxy共享一个连接池
+
+        :param protocol: http或https
+        :type protocol: str
+        :param host: driver server地址，例如：127.0.0.1:12306
+        :type host: str
+        :param context: https使用的SSL上下文
+        :type context: ssl.SSLContext
+        :param max_size: 空闲连接数上限
+        :type max_size: int
+        :param idle_timeout: 空闲连接的回收时间（秒）
+        :type idle_timeout: float
+        :returns: ConnectionPool
+        '''
+        # 连接池持有context的引用，id在连接池存在期间不会被复用
+        key = (protocol, host, id(context) if context is not None else None, max_size, idle_timeout)
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = cls(protocol, host, context, max_size, idle_timeout)
+            return cls._pools[key]
+
+    @classmethod
+    def clear_all(cls):
+        '''关闭全部连接池中的空闲连接
+        '''
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+        for pool in pools:
+            pool.clear()
+
+    def new_connection(self):
+        '''创建新连接（不放入连接池）
+        '''
+        if self._protocol == "https":
+            if self._context is not None:
+                return http_client.HTTPSConnection(self._host, context=self._context)
+            return http_client.HTTPSConnection(self._host)
+        return http_client.HTTPConnection(self._host)
+
+    def acquire(self):
+        '''取出一个连接，优先复用最近归还的空闲连接
+
+        :returns: tuple (connection, reused)
+        '''
+        now = time.time()
+        with self._lock:
+            while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+                self._idle.popleft()[0].close()
+            if self._idle:
+                return self._idle.pop()[0], True
+        return self.new_connection(), False
+
+    def release(self, conn):
+        '''归还连接，超出连接池容量则关闭
+        '''
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        '''关闭异常的连接
+        '''
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def clear(self):
+        '''关闭所有空闲连接
+        '''
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+
+class _PendingCall(object):
+    '''WebSocket通道上等待响应的调用
+    '''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+    def set_response(self, response):
+        self.response = response
+        self.event.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.event.set()
+
+
+class _ChannelConnection(object):
+    '''WebSocket通道的一次连接及其上在途的调用
+    '''
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.pending = {}
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+
+    def fail_all(self, error):
+        with self.pending_lock:
+            calls = list(self.pending.values())
+            self.pending.clear()
+        for call in calls:
+            call.set_error(error)
+
+
+class WebSocketChannel(object):
+    '''多路复用的WebSocket长连接，同一ws_uri的所有RPCClientProxy共享一个通道，
+    请求通过id关联响应，支持多个调用并发在途，连接断开后在下次调用时自动重连
+    '''
+    _channels = {}  # key为ws_uri
+    _channels_lock = threading.Lock()
+
+    def __init__(self, ws_uri):
+        self._ws_uri = ws_uri
+        self._conn = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.supported = None # 对端是否支持多路复用子协议，None表示尚未协商
+
+    @classmethod
+    def get_channel(cls, ws_uri):
+        '''获取指定ws_uri的通道，不存在则创建
+
+        :param ws_uri: WebSocket地址
+        :type ws_uri: str
+        :returns: WebSocketChannel
+        '''
+        with cls._channels_lock:
+            if ws_uri not in cls._channels:
+                cls._channels[ws_uri] = cls(ws_uri)
+            return cls._channels[ws_uri]
+
+    @classmethod
+    def close_all(cls):
+        '''关闭全部通道
+        '''
+        with cls._channels_lock:
+            channels = list(cls._channels.values())
+        for channel in channels:
+            channel.close()
+
+    def _connect(self):
+        import websocket
+        ws = websocket.WebSocket(enable_multithread=True)
+        try:
+            ws.connect(self._ws_uri, subprotocols=[WS_SUBPROTOCOL])
+        except websocket.WebSocketException:
+            if self.supported is None:
+                # 对端（例如旧版本的代理）未协商子协议，退回每次调用单独连接的方式
+                self.supported = False
+                return None
+            raise
+        if ws.getsubprotocol() != WS_SUBPROTOCOL:
+            ws.close()
+            if self.supported is None:
+                self.supported = False
+                return None
+            raise IOError('WebSocket subprotocol "%s" is not supported by %s' % (WS_SUBPROTOCOL, self._ws_uri))
+        self.supported = True
+        conn = _ChannelConnection(ws)
+        t = threading.Thread(target=self._read_loop, args=(conn,), name='WebSocketChannel')
+        t.daemon = True
+        t.start()
+        return conn
+
+    def _get_connection(self):
+        with self._lock:
+            if self._conn is None and self.supported is not False:
+                self._conn = self._connect()
+            return self._conn
+
+    def _read_loop(self, conn):
+        error = None
+        try:
+            while True:
+                message = conn.ws.recv()
+                if not message:
+                    break
+                response = json_codec.loads(message)
+                rpcid = response[0].get('id') if isinstance(response, list) else response.get('id')
+                with conn.pending_lock:
+                    call = conn.pending.pop(rpcid, None)
+                if call is not None:
+                    call.set_response(response)
+        except Exception as e:
+            error = e
+        self._on_broken(conn, IOError('WebSocket channel to %s closed: %s' % (self._ws_uri, error)))
+
+    def _on_broken(self, conn, error):
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+        try:
+            conn.ws.close()
+        except Exception:
+            pass
+        conn.fail_all(error)
+
+    def request(self, handler, request, timeout=None):
+        '''发送JSON-RPC请求并等待响应
+
+        :param handler: 请求的URL路径，例如：/device/<udid>/
+        :type handler: str
+        :param request: JSON-RPC请求或批量请求，id将被替换为通道内唯一的id
+        :type request: dict or list
+        :param timeout: 等待响应的超时值（秒），默认与HTTP传输相同，使用socket的默认超时
+        :type timeout: float
+        :returns: dict or list -- JSON-RPC响应，对端不支持多路复用时返回None
+        :raises: socket.timeout
+        '''
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        call = _PendingCall()
+        for attempt in range(2):
+            conn = self._get_connection()
+            if conn is None:
+                return None
+            # 批量请求的响应与其第一个请求关联
+            for it in (request if isinstance(request, list) else [request]):
+                it["id"] = str(next(self._ids))
+                it["path"] = handler
+            rpcid = request[0]["id"] if isinstance(request, list) else request["id"]
+            data = json_codec.dumps(request)
+            with conn.pending_lock:
+                conn.pending[rpcid] = call
+            try:
+                with conn.send_lock:
+                    conn.ws.send(data)
+                break
+            except Exception as e:
+                with conn.pending_lock:
+                    conn.pending.pop(rpcid, None)
+                self._on_broken(conn, e)
+                # 请求未发出，使用新连接重试一次
+                if attempt:
+                    raise
+        if not call.event.wait(timeout):
+            with conn.pending_lock:
+                conn.pending.pop(rpcid, None) # 之后到达的响应被丢弃，通道上的其他调用不受影响
+            raise socket.timeout('WebSocket request to %s%s timed out' % (self._ws_uri, handler))
+        if call.error is not None:
+            raise call.error
+        return call.response
+
+    def close(self):
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            self._on_broken(conn, IOError('WebSocket channel to %s closed' % self._ws_uri))
+
+
+class _StaleConnection(Exception):
+    '''复用的空闲连接已被服务端关闭，请求未被处理，可以使用新连接重试
+    '''
+
+
+def _is_stale_connection_error(error):
+    '''请求在收到任何响应数据前失败，且是服务端关闭连接导致的
+
+    超时不属于这种情况：请求可能已在服务端执行，重试会导致非幂等的操作执行两次
+    '''
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, http_client.BadStatusLine): # 包括RemoteDisconnected
+        return True
+    return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
 class TransportMixIn(object):
     '''XMLRPC Transport extended API
     '''
     user_agent = "jsonrpclib/0.1"
     _connection = (None, None)
     _extra_headers = []
+    _pool = None
+
+    def request(self, host, handler, request_body, verbose=False):
+        if self._pool is None:
+            return xmlrpc_client.Transport.request(self, host, handler, request_body, verbose)
+        conn, reused = self._pool.acquire()
+        try:
+            return self._pooled_request(conn, host, handler, request_body, verbose, reused)
+        except _StaleConnection:
+            self._pool.discard(conn)
+        except:
+            self._pool.discard(conn)
+            raise
+        # 复用的连接已被服务端关闭（例如driver server重启），清空连接池后使用新连接重试一次
+        self._pool.clear()
+        conn = self._pool.new_connection()
+        try:
+            return self._pooled_request(conn, host, handler, request_body, verbose, False)
+        except:
+            self._pool.discard(conn)
+            raise
+
+    def _pooled_request(self, conn, host, handler, request_body, verbose, reused):
+        if verbose:
+            conn.set_debuglevel(1)
+        try:
+            conn.putrequest("POST", handler, skip_accept_encoding=True)
+            conn.putheader("User-Agent", self.user_agent)
+            conn.putheader("Accept-Encoding", "gzip")
+            conn.putheader("Connection", "keep-alive")
+            self.send_content(conn, request_body)
+            resp = conn.getresponse()
+        except (socket.error, http_client.HTTPException) as e:
+            # 只有复用的连接在收到响应前被关闭时才重试，其他错误直接抛出
+            if reused and _is_stale_connection_error(e):
+                raise _StaleConnection()
+            raise
+        if resp.status != 200:
+            resp.read()
+            raise xmlrpc_client.ProtocolError(host + handler, resp.status, resp.reason, dict(resp.getheaders()))
+        self.verbose = verbose
+        result = self.parse_response(resp)
+        if resp.will_close:
+            self._pool.discard(conn)
+        else:
+            self._pool.release(conn)
+        return result
+
+    def parse_response(self, response):
+        '''按分块读取响应并增量解压，避免整个压缩包体再复制一份，再按Content-Type解码
+
+        :returns: dict or list
+        '''
+        decompressor = None
+        if response.getheader("Content-Encoding", "") == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+        while True:
+            data = response.read(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            if decompressor:
+                data = decompressor.decompress(data)
+            chunks.append(data)
+        if decompressor:
+            chunks.append(decompressor.flush())
+        data = b''.join(chunks)
+        if msgpack_codec and response.getheader("Content-Type", "") == msgpack_codec.content_type:
+            return msgpack_codec.loads(data)
+        return json_codec.loads(data)
 
     def send_content(self, connection, request_body):
+        connection.putheader(STREAM_HEADER, "chunked")
+        if msgpack_codec:
+            connection.putheader("Accept", "%s, %s" % (msgpack_codec.content_type, json_codec.content_type))
         connection.putheader("Content-Type", "application/json-rpc")
         connection.putheader("Content-Length", str(len(request_body)))
         connection.endheaders()
@@ -348,27 +949,71 @@ class JSONTarget(object):
 
 class Transport(TransportMixIn, xmlrpc_client.Transport):
 
-    def __init__(self, use_datetime):
+    def __init__(self, use_datetime, pool=None):
         TransportMixIn.__init__(self)
         xmlrpc_client.Transport.__init__(self, use_datetime)
+        self._pool = pool
 
 
 class SafeTransport(TransportMixIn, xmlrpc_client.SafeTransport):
 
-    def __init__(self, use_datetime, context):
+    def __init__(self, use_datetime, context, pool=None):
         TransportMixIn.__init__(self)
         xmlrpc_client.SafeTransport.__init__(self, use_datetime, context)
+        self._pool = pool
+
+
+def _iter_json_strings(obj, chunk_size):
+    result = obj.get('result') if isinstance(obj, dict) else None
+    if result and isinstance(result[0], six.string_types) and len(result[0]) > chunk_size:
+        # 结果为长字符串（例如截图、文件的base64数据）时分段转义，避免整体复制
+        others = dict((k, v) for k, v in obj.items() if k != 'result')
+        yield json.dumps(others)[:-1] + ', "result": ["'
+        value = result[0]
+        for i in range(0, len(value), chunk_size):
+            yield json.dumps(value[i:i+chunk_size])[1:-1]
+        yield '"]}'
+    else:
+        for s in json.JSONEncoder().iterencode(obj):
+            yield s
+
+
+def _iter_json_chunks(obj, chunk_size=STREAM_CHUNK_SIZE):
+    '''增量序列化JSON-RPC响应，生成不小于chunk_size的bytes分块（最后一块除外）
+
+    :param obj: JSON-RPC响应
+    :type obj: dict or list
+    :param chunk_size: 分块大小
+    :type chunk_size: int
+    '''
+    pieces = []
+    size = 0
+    for s in _iter_json_strings(obj, chunk_size):
+        if not isinstance(s, six.binary_type):
+            s = s.encode('utf-8')
+        pieces.append(s)
+        size += len(s)
+        if size >= chunk_size:
+            yield b''.join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield b''.join(pieces)
 
 
 class SimpleJSONRPCRequestHandler(SimpleXMLRPCRequestHandler):
     '''JSON-RPC请求处理器
     '''
+    protocol_version = "HTTP/1.1" # 支持客户端连接池的keep-alive
     def is_rpc_path_valid(self):
         return True
 
     def do_POST(self):
         '''处理HTTP的POST请求
         '''
+        if self.path.startswith(BLOB_PATH_PREFIX):
+            self._handle_blob()
+            return
         if not self.is_rpc_path_valid():
             self.report_404()
             return
@@ -384,17 +1029,34 @@ class SimpleJSONRPCRequestHandler(SimpleXMLRPCRequestHandler):
                 data = ''.join(L)
             else:
                 data = b''.join(L)
-            response = self.server._marshaled_dispatch(
-                    data, getattr(self, '_dispatch', None), self.path
-                )
-            self.send_response(200)
+            response = self.server._parse_and_dispatch(data, self.path)
         except Exception:
             response = Fault().response()
             self.send_response(500, response)
             logger.get_logger().exception("ProtocolError:%s" % response)
+            self._send_body(response)
+            return
+        codec = self._accept_codec()
+        if codec is json_codec and self.request_version == 'HTTP/1.1' \
+                and self.headers.get(STREAM_HEADER) == 'chunked':
+            self._send_streamed(response)
+        else:
+            self.send_response(200)
+            self._send_body(self.server.dumps_response(response, codec), codec.content_type)
+
+    def _accept_codec(self):
+        '''按请求的Accept头选择响应的编码，客户端支持时使用msgpack
+
+        :returns: JSONCodec
+        '''
+        if msgpack_codec and msgpack_codec.content_type in self.headers.get("Accept", ""):
+            return msgpack_codec
+        return json_codec
+
+    def _send_body(self, response, content_type="application/json-rpc"):
         if response is None:
             response = ''
-        self.send_header("Content-Type", "application/json-rpc")
+        self.send_header("Content-Type", content_type)
         if self.encode_threshold is not None:
             if len(response) > self.encode_threshold:
                     q = self.accept_encodings().get("gzip", 0)
@@ -412,9 +1074,562 @@ class SimpleJSONRPCRequestHandler(SimpleXMLRPCRequestHandler):
             response = response.encode('utf-8')
         self.wfile.write(response)
 
+    def _send_streamed(self, response):
+        '''增量序列化响应，超过一个分块的响应使用chunked编码边序列化边压缩边发送，
+        内存占用与分块大小成正比
+        '''
+        chunks = _iter_json_chunks(response)
+        buffered = []
+        try:
+            for chunk in chunks:
+                buffered.append(chunk)
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    break
+            else:
+                # 响应不超过一个分块，按普通响应发送
+                body = b''.join(buffered)
+                self.server._end_transfer(len(body))
+                self.send_response(200)
+                self._send_body(body)
+                return
+        except (TypeError, ValueError):
+            self.send_response(200)
+            self._send_body(self.server.dumps_response(response))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json-rpc")
+        self.send_header("Transfer-Encoding", "chunked")
+        compressor = None
+        if self.accept_encodings().get("gzip", 0):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        bytes_out = 0
+        try:
+            for chunk in itertools.chain(buffered, chunks):
+                bytes_out += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                self._write_chunk(chunk)
+            if compressor:
+                self._write_chunk(compressor.flush())
+            self.wfile.write(b'0\r\n\r\n')
+            self.server._end_transfer(bytes_out)
+        except (TypeError, ValueError):
+            # 已经开始发送，只能断开连接让客户端报错
+            logger.get_logger().exception("ProtocolError: failed to serialize response")
+            self.close_connection = True
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write(('%X\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+
+    def do_PUT(self):
+        '''处理二进制通道的上传请求
+        '''
+        if self.path.startswith(BLOB_PATH_PREFIX):
+            self._handle_blob()
+        else:
+            self.send_error(501, "Unsupported method (%r)" % self.command)
+
+    def _handle_blob(self):
+        '''二进制通道，GET下载数据，PUT/POST上传文件
+        '''
+        blob = self.server.blobs.take(self.path[len(BLOB_PATH_PREFIX):], self.command != 'GET')
+        if blob is None:
+            self.close_connection = True # 未读取的请求体不能留在连接上
+            self.send_error(404, "blob does not exist or has expired")
+            return
+        try:
+            if blob.upload:
+                self._receive_blob(blob)
+            else:
+                self._send_blob(blob)
+        finally:
+            blob.discard()
+
+    def _send_blob(self, blob):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        if blob.data is not None:
+            self.send_header("Content-Length", str(len(blob.data)))
+            self.end_headers()
+            self.wfile.write(blob.data)
+            return
+        self.send_header("Content-Length", str(os.path.getsize(blob.path)))
+        self.end_headers()
+        with open(blob.path, "rb") as fd:
+            while True:
+                data = fd.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                self.wfile.write(data)
+
+    def _receive_blob(self, blob):
+        size_remaining = int(self.headers["content-length"])
+        with open(blob.path, "wb" if blob.override else "ab") as fd:
+            while size_remaining:
+                data = self.rfile.read(min(size_remaining, STREAM_CHUNK_SIZE))
+                if not data:
+                    raise EOFError('connection closed while receiving blob')
+                fd.write(data)
+                size_remaining -= len(data)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        '''处理二进制通道的下载、统计数据的查询和WebSocket升级请求，其他GET请求不支持
+        '''
+        if self.path.startswith(BLOB_PATH_PREFIX):
+            self._handle_blob()
+            return
+        if self.path == METRICS_PATH:
+            self.send_response(200)
+            self._send_body(self.server.metrics.to_prometheus(), METRICS_CONTENT_TYPE)
+            return
+        if self.headers.get('Upgrade', '').lower() != 'websocket':
+            self.send_error(501, "Unsupported method (%r)" % self.command)
+            return
+        key = self.headers.get('Sec-WebSocket-Key')
+        subprotocols = [it.strip() for it in self.headers.get('Sec-WebSocket-Protocol', '').split(',')]
+        if not key or WS_SUBPROTOCOL not in subprotocols:
+            self.send_error(400, "Unsupported WebSocket subprotocol")
+            return
+        accept = hashlib.sha1((key + WS_MAGIC_KEY).encode('utf-8')).digest()
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', base64.b64encode(accept).decode('ascii'))
+        self.send_header('Sec-WebSocket-Protocol', WS_SUBPROTOCOL)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        self.handle_websocket(WebSocketStream(self.rfile, self.wfile))
+
+    def handle_websocket(self, stream):
+        '''WebSocket长连接的消息循环，每条消息为携带path的JSON-RPC请求，
+        由固定数量的工作线程并发执行，设备请求仍经过RequestScheduler按设备排队，
+        响应按完成顺序返回并由客户端根据id关联
+        '''
+        messages = six.moves.queue.Queue(WS_MAX_CONCURRENT_REQUESTS)
+        workers = []
+        try:
+            while True:
+                try:
+                    message = stream.recv_message()
+                except (EOFError, socket.error):
+                    return
+                if message is None:
+                    return
+                if len(workers) < WS_MAX_CONCURRENT_REQUESTS:
+                    t = threading.Thread(target=self._ws_work, args=(stream, messages))
+                    t.daemon = True
+                    t.start()
+                    workers.append(t)
+                messages.put(message) # 工作线程都忙时阻塞，不再读取新消息
+        finally:
+            for _ in workers:
+                messages.put(None)
+
+    def _ws_work(self, stream, messages):
+        while True:
+            message = messages.get()
+            if message is None:
+                return
+            self._ws_dispatch(stream, message)
+
+    def _ws_dispatch(self, stream, message):
+        self.server._begin_transfer(len(message))
+        try:
+            request = json_codec.loads(message)
+        except ValueError:
+            response = Fault(-32700, 'JSON parsing error').response()
+        else:
+            path = self.path
+            for it in (request if isinstance(request, list) else [request]):
+                if isinstance(it, dict):
+                    path = it.pop('path', path)
+            try:
+                if isinstance(request, list):
+                    response = self.server._dispatch_batch(request, path)
+                else:
+                    response = self.server._dispatch_request(request, path)
+            except Exception:
+                response = Fault().response()
+                logger.get_logger().exception("ProtocolError:%s" % response)
+        try:
+            stream.send_message(response)
+        except socket.error:
+            pass # 连接已断开，客户端会让等待中的调用失败
+
+
+class WebSocketStream(object):
+    '''服务端WebSocket帧的读写（RFC6455）
+    '''
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    def __init__(self, rfile, wfile):
+        self._rfile = rfile
+        self._wfile = wfile
+        self._write_lock = threading.Lock()
+
+    def _read_exactly(self, size):
+        data = self._rfile.read(size)
+        if data is None or len(data) < size:
+            raise EOFError('websocket connection closed')
+        return data
+
+    def _read_frame(self):
+        b0, b1 = bytearray(self._read_exactly(2))
+        fin = b0 & 0x80
+        opcode = b0 & 0x0f
+        length = b1 & 0x7f
+        if length == 126:
+            length = struct.unpack('>H', self._read_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', self._read_exactly(8))[0]
+        mask = self._read_exactly(4) if b1 & 0x80 else None
+        payload = self._read_exactly(length) if length else b''
+        if mask:
+            payload = _ws_unmask(payload, mask)
+        return fin, opcode, payload
+
+    def recv_message(self):
+        '''读取一条完整的消息，连接关闭时返回None
+
+        :returns: bytes or None
+        '''
+        fragments = []
+        while True:
+            fin, opcode, payload = self._read_frame()
+            if opcode == self.OP_CLOSE:
+                self.send_frame(self.OP_CLOSE, payload[:2])
+                return None
+            elif opcode == self.OP_PING:
+                self.send_frame(self.OP_PONG, payload)
+            elif opcode == self.OP_PONG:
+                pass
+            else:
+                fragments.append(payload)
+                if fin:
+                    return b''.join(fragments)
+
+    def send_frame(self, opcode, payload):
+        '''发送一个不分片的帧，可多线程调用
+        '''
+        frame = _ws_frame(opcode, payload)
+        with self._write_lock:
+            self._wfile.write(frame)
+            self._wfile.flush()
+
+    def send_message(self, message):
+        if not isinstance(message, six.binary_type):
+            message = message.encode('utf-8')
+        self.send_frame(self.OP_TEXT, message)
+
+
+def _ws_frame(opcode, payload):
+    '''构造一个不分片、不加掩码的服务端帧
+    '''
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def _ws_unmask(payload, mask):
+    '''按RFC6455对客户端帧的负载去掩码
+    '''
+    if PY2:
+        data = bytearray(payload)
+        mask = bytearray(mask)
+        for i in range(len(data)):
+            data[i] ^= mask[i % 4]
+        return bytes(data)
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
+class _Blob(object):
+    '''二进制通道中等待传输的数据
+    '''
+
+    def __init__(self, data=None, path=None, upload=False, override=True, delete=False):
+        self.data = data
+        self.path = path
+        self.upload = upload
+        self.override = override
+        self.delete = delete
+        self.expire_time = time.time() + BLOB_EXPIRE_TIME
+
+    def discard(self):
+        if self.delete and self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BlobStore(object):
+    '''二进制通道，RPC方法登记数据或文件并返回token，客户端通过/blob/<token>
+    以application/octet-stream直接下载或上传原始字节，每个token只能使用一次
+    '''
+
+    def __init__(self):
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    def _add(self, blob):
+        token = binascii.hexlify(os.urandom(16)).decode('ascii') # token即访问凭证，使用密码学安全的随机数
+        self.purge_expired()
+        with self._lock:
+            self._blobs[token] = blob
+        return token
+
+    def purge_expired(self):
+        '''清除超过BLOB_EXPIRE_TIME未使用的token，需要时删除登记的文件
+        '''
+        now = time.time()
+        with self._lock:
+            expired = [self._blobs.pop(k) for k, v in list(self._blobs.items()) if v.expire_time < now]
+        for blob in expired:
+            blob.discard()
+
+    def add_data(self, data):
+        '''登记待下载的数据
+
+        :param data: 二进制数据
+        :type data: bytes
+        :returns: str -- token
+        '''
+        return self._add(_Blob(data=data))
+
+    def add_file(self, path, delete=False):
+        '''登记待下载的文件
+
+        :param path: 文件路径
+        :type path: str
+        :param delete: 下载完成或过期后是否删除文件
+        :type delete: boolean
+        :returns: str -- token
+        '''
+        if not os.path.isfile(path):
+            raise Exception('file(%s) does not exist' % path)
+        return self._add(_Blob(path=path, delete=delete))
+
+    def add_upload(self, path, override=True):
+        '''登记上传文件的保存路径
+
+        :param path: 文件路径
+        :type path: str
+        :param override: 是否覆盖已存在的文件，否则追加
+        :type override: boolean
+        :returns: str -- token
+        '''
+        return self._add(_Blob(path=path, upload=True, override=override))
+
+    def pop(self, token):
+        with self._lock:
+            return self._blobs.pop(token, None)
+
+    def take(self, token, upload):
+        '''取出待传输的数据，token只能使用一次
+
+        :param token: token
+        :type token: str
+        :param upload: 是否为上传请求
+        :type upload: boolean
+        :returns: _Blob -- token不存在、已过期或传输方向不符时返回None
+        '''
+        self.purge_expired()
+        blob = self.pop(token)
+        if blob is None or blob.upload != upload:
+            return None
+        return blob
+
+
+class _ScheduledTask(object):
+    '''RequestScheduler中排队执行的请求
+    '''
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            self._result = self.func(*self.args)
+        except:
+            self._exc_info = sys.exc_info()
+        self.end_time = time.time()
+        with self._callbacks_lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.get_logger().exception('RequestScheduler callback error')
+
+    def add_done_callback(self, callback):
+        '''执行完成后在工作线程中调用callback(task)，已完成时立即调用
+        '''
+        with self._callbacks_lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self):
+        '''等待执行完成并返回结果，执行失败则抛出原异常
+        '''
+        self._event.wait()
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        return self._result
 
-class SimpleJSONRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
-    """RPC Server
+
+class _QueueStats(object):
+    '''单个设备队列的统计
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.max_service = 0.0
+
+    def record(self, task):
+        wait = task.start_time - task.submit_time
+        service = task.end_time - task.start_time
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_service += service
+        self.max_service = max(self.max_service, service)
+
+    def to_dict(self):
+        count = self.requests or 1
+        return {"requests": self.requests,
+                "queue_depth": self.depth,
+                "max_queue_depth": self.max_depth,
+                "avg_wait_ms": self.total_wait * 1000 / count,
+                "max_wait_ms": self.max_wait * 1000,
+                "avg_service_ms": self.total_service * 1000 / count,
+                "max_service_ms": self.max_service * 1000}
+
+
+class RequestScheduler(object):
+    '''固定大小的工作线程池，同一设备的请求按FIFO顺序串行执行，不同设备的请求并行执行
+    '''
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._queues = {}  # 等待执行的请求，key为设备udid
+        self._ready = six.moves.queue.Queue()  # 可以执行下一个请求的设备
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        self._busy = 0
+
+    def _start_workers(self):
+        for i in range(self.max_workers):
+            t = threading.Thread(target=self._work, name='RequestScheduler-%d' % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def _get_stats(self, key):
+        if key not in self._stats:
+            self._stats[key] = _QueueStats()
+        return self._stats[key]
+
+    def submit(self, key, func, args=()):
+        '''提交请求到设备队列
+
+        :param key: 设备udid
+        :type key: str
+        :param func: 执行请求的函数
+        :type func: callable
+        :param args: 函数参数
+        :type args: tuple
+        :returns: _ScheduledTask -- 调用result()等待执行结果
+        '''
+        task = _ScheduledTask(func, args)
+        with self._lock:
+            if not self._workers:
+                self._start_workers()
+            stats = self._get_stats(key)
+            stats.depth += 1
+            stats.max_depth = max(stats.max_depth, stats.depth)
+            if key in self._queues:
+                self._queues[key].append(task)
+            else:
+                self._queues[key] = collections.deque([task])
+                self._ready.put(key)
+        return task
+
+    def run_inline(self, key, func, args=()):
+        '''在当前线程直接执行不需要排队的请求，只记录统计
+        '''
+        task = _ScheduledTask(func, args)
+        task.run()
+        with self._lock:
+            self._get_stats(key).record(task)
+        return task.result()
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                task = self._queues[key][0]
+                self._get_stats(key).depth -= 1
+                self._busy += 1
+            task.run()
+            with self._lock:
+                self._busy -= 1
+                self._get_stats(key).record(task)
+                queue = self._queues[key]
+                queue.popleft()
+                if queue:
+                    self._ready.put(key) # 重新排到末尾，避免单个设备占满工作线程
+                else:
+                    del self._queues[key]
+
+    def get_stats(self):
+        '''获取线程池和各设备队列的统计
+
+        :returns: dict
+        '''
+        with self._lock:
+            return {"max_workers": self.max_workers,
+                    "busy_workers": self._busy,
+                    "queues": dict((key, stats.to_dict()) for key, stats in self._stats.items())}
+
+
+class JSONRPCDispatcher(object):
+    """JSON-RPC请求的路由和分发，与网络层无关，供不同实现的RPC Server复用
     """
 
     LOG_FILTERED_METHODS = [
@@ -424,26 +1639,28 @@ class SimpleJSONRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
                             'device.get_crash_log',
                             'device.get_driver_log',
                             'device.get_element_tree',
+                            'device.get_element_tree_diff',
                             'device.get_element_tree_and_capture_screen',
+                            'device.get_recording',
                             'device.capture_screen',
                             'element.get_element_tree',
                             'web.get_frame_tree',
                             ]
+    MAX_ROUTES = 1024 # 路由表容量上限，超出后清空重建
+    _scheduler = None # RequestScheduler，为None时在当前线程直接执行
 
-    def __init__(self, urls, addr):
+    def __init__(self, urls):
         """Constructor
 
         :param urls: list of URL pattern and RPC end point class
-        :param addr: listening address
         :type urls: list
-        :type addr: tuple
         """
-        SimpleXMLRPCServer.__init__(self, addr=addr,
-                                                       requestHandler=SimpleJSONRPCRequestHandler,
-                                                       allow_none=True,
-                                                       encoding='UTF-8',
-                                                       logRequests=False)
-
+        self._routes = {} # 路由表，key为(path, 方法前缀)，value为(endpoint_cls, endpoint_params, log, queue_key)
+        self._endpoints = {} # end point实例缓存，key为(endpoint_cls, endpoint_params)
+        self._endpoints_lock = threading.Lock()
+        self.blobs = BlobStore()
+        self.metrics = get_metrics_registry()
+        self._transfer = threading.local() # 当前线程正在处理的请求的流量统计
         self._dispatcher_patterns = []
         for url_pattern, method_pattern, endpoint_cls in urls:
             if method_pattern:
@@ -454,74 +1671,331 @@ class SimpleJSONRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
                                               method_c_pattern,
                                               endpoint_cls))
 
+    def _match_route(self, path, method):
+        '''按URL规则查找end point
+
+        :returns: tuple (endpoint_cls, endpoint_params, log, queue_key)，未找到则返回尝试过的end point类列表
+        '''
+        tried_enpoint_clss = []
+        for url_pattern, method_pattern, endpoint_cls in self._dispatcher_patterns:
+            m = url_pattern.match(path)
+            if m:
+                tried_enpoint_clss.append(endpoint_cls)
+                if (method_pattern is None) or method_pattern.match(method):
+                    try:
+                        log = logger.get_logger("driverserver_%s" % m.group(1))
+                    except:
+                        log = logger.get_logger()
+                    endpoint_params = tuple(sorted(m.groupdict().items()))
+                    queue_key = m.groupdict().get('device_id')
+                    return endpoint_cls, endpoint_params, log, queue_key
+        return tried_enpoint_clss
+
+    def _get_endpoint(self, endpoint_cls, endpoint_params):
+        '''获取end point实例，同一设备的同一end point只创建一次
+        '''
+        key = (endpoint_cls, endpoint_params)
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            with self._endpoints_lock:
+                endpoint = self._endpoints.get(key)
+                if endpoint is None:
+                    endpoint = endpoint_cls(self, **dict(endpoint_params))
+                    self._endpoints[key] = endpoint
+        return endpoint
+
+    def _invoke(self, queue_key, endpoint, method, params):
+        if self._scheduler is None:
+            return endpoint._dispatch(method, params)
+        if queue_key is None or not endpoint.rpc_serial:
+            # host请求和回调类请求不排队，避免等待回调的设备请求占满工作线程导致死锁
+            return self._scheduler.run_inline(queue_key or 'host', endpoint._dispatch, (method, params))
+        return self._scheduler.submit(queue_key, endpoint._dispatch, (method, params)).result()
+
+    def get_server_stats(self):
+        '''获取请求调度的统计，包括各设备的队列深度、等待时间和执行时间
+
+        :returns: dict
+        '''
+        if self._scheduler is None:
+            return {}
+        return self._scheduler.get_stats()
+
+    def invalidate_endpoints(self, device_id=None):
+        '''清除end point实例缓存，agent启动、重启或关闭后需要调用，
+        使end point重新绑定agent
+
+        :param device_id: 设备udid，为None则清除全部设备
+        :type device_id: str
+        '''
+        with self._endpoints_lock:
+            for key in list(self._endpoints.keys()):
+                if device_id is None or ('device_id', device_id) in key[1]:
+                    self._endpoints.pop(key, None)
+
     def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        return self.dumps_response(self._parse_and_dispatch(data, path))
+
+    def _parse_and_dispatch(self, data, path):
+        '''解析并分发JSON-RPC请求或批量请求
+
+        :returns: dict or list -- 未序列化的JSON-RPC响应
+        '''
+        self._begin_transfer(len(data))
+        try:
+            request = json_codec.loads(data)
+        except ValueError:
+            return Fault(-32700, 'JSON parsing error').to_dict()
+        if isinstance(request, list):
+            return self._dispatch_batch_object(request, path)
+        return self._dispatch_object(request, path)
+
+    def dumps_response(self, response, codec=json_codec):
+        '''序列化JSON-RPC响应，结果不能序列化时返回对应的错误响应
+
+        :param response: JSON-RPC响应或响应列表
+        :type response: dict or list
+        :param codec: 编解码器，默认为json
+        :type codec: JSONCodec
+        :returns: bytes
+        '''
+        try:
+            data = codec.dumpb(response)
+        except (TypeError, ValueError, OverflowError):
+            if isinstance(response, list):
+                data = codec.dumpb([self._checked_response(it, codec) for it in response])
+            else:
+                data = codec.dumpb(self._checked_response(response, codec))
+        self._end_transfer(len(data))
+        return data
+
+    def _begin_transfer(self, bytes_in):
+        '''开始统计当前线程的一次请求的流量，分发过程中记录被调用的方法
+
+        :param bytes_in: 请求字节数
+        :type bytes_in: int
+        '''
+        self._transfer.calls = []
+        self._transfer.bytes_in = bytes_in
+
+    def _end_transfer(self, bytes_out):
+        '''响应序列化后记录流量，批量请求的流量由其中的调用平均分摊
+
+        :param bytes_out: 响应字节数
+        :type bytes_out: int
+        '''
+        calls = getattr(self._transfer, 'calls', None)
+        self._transfer.calls = None
+        if not calls:
+            return
+        bytes_in = self._transfer.bytes_in // len(calls)
+        bytes_out = bytes_out // len(calls)
+        for device, method in calls:
+            self.metrics.add_bytes('rpc', device, method, bytes_in, bytes_out)
+
+    def get_metrics(self):
+        '''获取JSON-RPC请求和agent指令的统计，包括调用次数、错误次数、耗时分位数和流量
+
+        :returns: dict
+        '''
+        return self.metrics.get_metrics()
+
+    def _checked_response(self, response, codec):
+        '''检查单个响应能否序列化，不能序列化时替换为错误响应
+        '''
+        try:
+            codec.dumpb(response)
+            return response
+        except (TypeError, ValueError, OverflowError):
+            fault = Fault(rpcid=response.get('id'))
+            logger.get_logger().error('ProtocolError:%s' % fault.error())
+            return fault.to_dict()
+
+    def _dispatch_batch(self, requests, path):
+        '''按顺序分发JSON-RPC批量请求，单个请求的错误只影响其对应的响应
+
+        :param requests: JSON-RPC请求列表
+        :type requests: list
+        :param path: 请求的URL路径
+        :type path: str
+        :returns: str -- JSON-RPC响应列表
+        '''
+        return self.dumps_response(self._dispatch_batch_object(requests, path))
+
+    def _dispatch_batch_object(self, requests, path):
+        if not requests:
+            return Fault(-32600, 'Empty batch request').to_dict()
+        return [self._dispatch_object(it, path) for it in requests]
+
+    def _dispatch_request(self, request, path):
+        '''分发已解析的JSON-RPC请求
+
+        :param request: JSON-RPC请求
+        :type request: dict
+        :param path: 请求的URL路径
+        :type path: str
+        :returns: str -- JSON-RPC响应
+        '''
+        return self.dumps_response(self._dispatch_object(request, path))
+
+    def _dispatch_object(self, request, path):
+        call = self._prepare_call(request, path)
+        if isinstance(call, dict):
+            return call
+        call.start_time = time.time()
+        try:
+            result = self._invoke(call.queue_key, call.endpoint, call.method, call.params)
+        except Exception as e:
+            return self._call_failed(call, e)
+        return self._call_done(call, result)
+
+    def _prepare_call(self, request, path):
+        '''校验JSON-RPC请求并完成路由
+
+        :returns: _PreparedCall or dict -- 请求无效时返回错误响应
+        '''
         origin_path = path
         path = path[1:] #remove /
         if not path.endswith('/'):
             path += '/'
 
-        try:
-            request = json.loads(data)
-        except ValueError:
-            fault = Fault(-32700, 'JSON parsing error')
-            return fault.response()
         if not isinstance(request, dict):
             fault = Fault(-32600, 'Invalid request data type')
-            return fault.response()
+            return fault.to_dict()
         rpcid = request.get('id', None)
         method = request.get('method', None)
         params = request.get('params', [])
         params_types = (list, dict, tuple)
         if not method or not isinstance(method, six.string_types) or not isinstance(params, params_types):
-            return Fault(-32600, 'Invalid request method or parameters').response()
+            return Fault(-32600, 'Invalid request method or parameters', rpcid).to_dict()
+
+        # 内置end point的方法规则均为"^<前缀>\..*"，因此同一路径下相同前缀的方法路由结果相同
+        route_key = (path, method.split('.', 1)[0])
+        route = self._routes.get(route_key)
+        if route is None:
+            route = self._match_route(path, method)
+            if not isinstance(route, tuple):
+                if not route:
+                    return Fault(-32601, "invalid URL: \"%s\"" % origin_path, rpcid).to_dict()
+                else:
+                    return Fault(-32601, "invalid method: \"%s\", no matched end point, end point: %s tried" %
+                        (method, ", ".join([ '"%s"'%it.__name__ for it in route])), rpcid).to_dict()
+            if len(self._routes) >= self.MAX_ROUTES:
+                self._routes.clear()
+            self._routes[route_key] = route
+        endpoint_cls, endpoint_params, log, queue_key = route
+        try:
+            endpoint = self._get_endpoint(endpoint_cls, endpoint_params)
+        except:
+            fault = Fault(rpcid=rpcid)
+            log.exception(fault.error())
+            return fault.to_dict()
+
+        call = _PreparedCall(rpcid, method, params, endpoint, log, queue_key)
+        calls = getattr(self._transfer, 'calls', None)
+        if calls is not None:
+            calls.append((call.device, method))
+        log.debug('--- --- --- --- --- ---')
+        log.debug('%s <<< %s' % (method, params))
+        return call
+
+    def _call_done(self, call, response):
+        '''记录调用耗时并生成成功的响应
+        '''
+        end_time = call.end_time or time.time()
+        self.metrics.observe('rpc', call.device, call.method, (end_time - call.start_time) * 1000)
+        if call.method in self.LOG_FILTERED_METHODS:
+            call.log.debug('%s >>> done' % call.method)
+        else:
+            call.log.debug('%s >>> %s' % (call.method, response))
+        # wrap response in a singleton tuple
+        if six.PY3 and isinstance(response, six.binary_type):
+            response = response.decode('utf-8')
+        response = (response,)
+        return {"jsonrpc": "2.0", "result": response, "id": call.rpcid}
+
+    def _call_failed(self, call, e):
+        '''记录调用耗时并生成错误响应
+        '''
+        end_time = call.end_time or time.time()
+        if hasattr(e, "extra"):
+            fault = Fault(message=e.message, rpcid=call.rpcid, extra=e.extra)
+        else:
+            fault = Fault(rpcid=call.rpcid)
+        self.metrics.observe('rpc', call.device, call.method, (end_time - call.start_time) * 1000, error=True)
+        call.log.error('%s >>> %s' % (call.method, fault.error()))
+        return fault.to_dict()
 
-        tried_enpoint_clss = []
-        for url_pattern, method_pattern, endpoint_cls in self._dispatcher_patterns:
-            m = url_pattern.match(path)
-            if m:
-                try:
-                    log_suffix = m.group(1)
-                    log = logger.get_logger("driverserver_%s" % log_suffix)
-                except:
-                    log = logger.get_logger()
 
-                tried_enpoint_clss.append(endpoint_cls)
-                if (method_pattern is None) or method_pattern.match(method):
-                    endpoint_params = m.groupdict()
-                    try:
-                        endpoint = endpoint_cls(self, **endpoint_params)
-                    except:
-                        fault = Fault()
-                        log.exception(fault.error())
-                        return fault.response()
-                    else:
-                        break
-        else:
-            if not tried_enpoint_clss:
-                return Fault(-32601, "invalid URL: \"%s\"" % origin_path).response()
-            else:
-                return Fault(-32601, "invalid method: \"%s\", no matched end point, end point: %s tried" %
-                    (method, ", ".join([ '"%s"'%it.__name__ for it in tried_enpoint_clss]))).response()
+class _PreparedCall(object):
+    '''已完成路由、等待执行的JSON-RPC调用
+    '''
+
+    def __init__(self, rpcid, method, params, endpoint, log, queue_key):
+        self.rpcid = rpcid
+        self.method = method
+        self.params = params
+        self.endpoint = endpoint
+        self.log = log
+        self.queue_key = queue_key
+        self.device = queue_key or 'host'
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def serial(self):
+        '''是否需要在设备队列中按FIFO顺序执行，参考JSONRPCDispatcher._invoke
+        '''
+        return self.queue_key is not None and self.endpoint.rpc_serial
+
+class SimpleJSONRPCServer(ThreadingMixIn, JSONRPCDispatcher, SimpleXMLRPCServer):
+    """RPC Server，每个连接由一个线程处理，同时处理的连接数不超过max_connections，
+    超出的连接留在监听队列中等待；end point方法由RequestScheduler的工作线程执行
+    """
+    daemon_threads = True # keep-alive连接的处理线程不阻塞进程退出
+
+    def __init__(self, urls, addr, max_workers=DEFAULT_MAX_WORKERS, max_connections=DEFAULT_MAX_CONNECTIONS):
+        """Constructor
 
+        :param urls: list of URL pattern and RPC end point class
+        :param addr: listening address
+        :param max_workers: 执行end point方法的工作线程数上限
+        :param max_connections: 同时处理的连接数上限
+        :type urls: list
+        :type addr: tuple
+        :type max_workers: int
+        :type max_connections: int
+        """
+        SimpleXMLRPCServer.__init__(self, addr=addr,
+                                                       requestHandler=SimpleJSONRPCRequestHandler,
+                                                       allow_none=True,
+                                                       encoding='UTF-8',
+                                                       logRequests=False)
+        JSONRPCDispatcher.__init__(self, urls)
+        self._scheduler = RequestScheduler(max_workers)
+        self._connection_slots = threading.BoundedSemaphore(max_connections)
+        self._closing = False
+
+    def process_request(self, request, client_address):
+        '''连接数达到上限时暂停accept，直到有连接关闭
+        '''
+        while not self._connection_slots.acquire(False):
+            if self._closing:
+                self.shutdown_request(request)
+                return
+            time.sleep(0.05)
         try:
-            log.debug('--- --- --- --- --- ---')
-            log.debug('%s <<< %s' % (method, params))
+            ThreadingMixIn.process_request(self, request, client_address)
+        except:
+            self._connection_slots.release()
+            raise
 
-            response = endpoint._dispatch(method, params)
-            if method in self.LOG_FILTERED_METHODS:
-                log.debug('%s >>> done' % method)
-            else:
-                log.debug('%s >>> %s' % (method, response))
-            # wrap response in a singleton tuple
-            if six.PY3 and isinstance(response, six.binary_type):
-                response = response.decode('utf-8')
-            response = (response,)
-            response = json.dumps({"jsonrpc": "2.0", "result": response, "id": rpcid})
-        except Exception as e:
-            if hasattr(e, "extra"):
-                fault = Fault(message=e.message, extra=e.extra)
-            else:
-                fault = Fault()
-            response = fault.response()
-            log.error('%s >>> %s' % (method, fault.error()))
-        return response
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self._connection_slots.release()
+
+    def shutdown(self):
+        self._closing = True
+        SimpleXMLRPCServer.shutdown(self)
@@ -0,0 +1,241 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''请求耗时和流量的统计，按层（JSON-RPC请求、agent指令、agent启停阶段）、设备和方法分别统计
+'''
+
+from __future__ import absolute_import, print_function
+
+import bisect
+import threading
+
+from six.moves import _thread
+
+
+# 耗时直方图的桶上界（毫秒），最后一个桶为+Inf
+LATENCY_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# Prometheus指标名前缀
+METRIC_PREFIXES = {
+    'rpc': ('qt4i_rpc_request', 'JSON-RPC request'),
+    'agent': ('qt4i_agent_command', 'XCTestAgent command'),
+    'lifecycle': ('qt4i_agent_lifecycle', 'XCTestAgent lifecycle phase'),
+    }
+
+DEFAULT_STRIPES = 16
+
+
+class MethodStats(object):
+    '''单个方法的统计，包括调用次数、错误次数、耗时直方图和收发字节数
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0 # 毫秒
+        self.max_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, duration, error=False):
+        '''记录一次调用
+
+        :param duration: 耗时（毫秒）
+        :type duration: float
+        :param error: 是否失败
+        :type error: boolean
+        '''
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def merge(self, other):
+        '''累加另一份统计
+        '''
+        self.count += other.count
+        self.errors += other.errors
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def percentile(self, q):
+        '''按直方图估算分位数，在桶内线性插值
+
+        :param q: 分位，例如0.95
+        :type q: float
+        :returns: float -- 毫秒
+        '''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.buckets):
+            if n and cumulative + n >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                if i == len(LATENCY_BUCKETS):
+                    return self.max_time
+                upper = min(LATENCY_BUCKETS[i], self.max_time)
+                return lower + (upper - lower) * (rank - cumulative) / n
+            cumulative += n
+        return self.max_time
+
+    def to_dict(self):
+        count = self.count or 1
+        return {"count": self.count,
+                "errors": self.errors,
+                "avg_ms": self.total_time / count,
+                "max_ms": self.max_time,
+                "p50_ms": self.percentile(0.5),
+                "p95_ms": self.percentile(0.95),
+                "p99_ms": self.percentile(0.99),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out}
+
+
+class MetricsRegistry(object):
+    '''统计数据按线程分散到多个分片，每个分片有独立的锁，记录时只与同分片的线程竞争，
+    读取时合并所有分片
+    '''
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self._stripes = [({}, threading.Lock()) for _ in range(stripes)]
+
+    def _get_stripe(self):
+        return self._stripes[_thread.get_ident() % len(self._stripes)]
+
+    def _get_stats(self, stats, key):
+        method_stats = stats.get(key)
+        if method_stats is None:
+            method_stats = stats[key] = MethodStats()
+        return method_stats
+
+    def observe(self, layer, device, method, duration, error=False, bytes_in=0, bytes_out=0):
+        '''记录一次调用
+
+        :param layer: rpc、agent或lifecycle
+        :type layer: str
+        :param device: 设备udid，host请求为host
+        :type device: str
+        :param method: 方法或指令名称
+        :type method: str
+        :param duration: 耗时（毫秒）
+        :type duration: float
+        :param error: 是否失败
+        :type error: boolean
+        :param bytes_in: 请求字节数
+        :type bytes_in: int
+        :param bytes_out: 响应字节数
+        :type bytes_out: int
+        '''
+        stats, lock = self._get_stripe()
+        with lock:
+            method_stats = self._get_stats(stats, (layer, device, method))
+            method_stats.observe(duration, error)
+            method_stats.bytes_in += bytes_in
+            method_stats.bytes_out += bytes_out
+
+    def add_bytes(self, layer, device, method, bytes_in=0, bytes_out=0):
+        '''累加收发字节数，用于调用完成后才能确定流量的情况
+        '''
+        stats, lock = self._get_stripe()
+        with lock:
+            method_stats = self._get_stats(stats, (layer, device, method))
+            method_stats.bytes_in += bytes_in
+            method_stats.bytes_out += bytes_out
+
+    def snapshot(self):
+        '''合并所有分片的统计
+
+        :returns: dict -- key为(layer, device, method)，value为MethodStats
+        '''
+        result = {}
+        for stats, lock in self._stripes:
+            with lock:
+                for key, method_stats in stats.items():
+                    if key not in result:
+                        result[key] = MethodStats()
+                    result[key].merge(method_stats)
+        return result
+
+    def get_metrics(self):
+        '''获取统计结果
+
+        :returns: dict -- {layer: {device: {method: {count, errors, avg_ms, max_ms, p50_ms, p95_ms, p99_ms, bytes_in, bytes_out}}}}
+        '''
+        result = {}
+        for (layer, device, method), method_stats in self.snapshot().items():
+            result.setdefault(layer, {}).setdefault(device, {})[method] = method_stats.to_dict()
+        return result
+
+    def to_prometheus(self):
+        '''按Prometheus文本格式输出统计结果
+
+        :returns: str
+        '''
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+        for layer, (prefix, desc) in sorted(METRIC_PREFIXES.items()):
+            items = [(device, method, it) for (l, device, method), it in snapshot if l == layer]
+            name = '%s_duration_seconds' % prefix
+            lines.append('# HELP %s %s latency in seconds.' % (name, desc))
+            lines.append('# TYPE %s histogram' % name)
+            for device, method, method_stats in items:
+                labels = 'device="%s",method="%s"' % (_escape_label(device), _escape_label(method))
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, method_stats.buckets):
+                    cumulative += n
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, repr(bound / 1000.0), cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, method_stats.count))
+                lines.append('%s_sum{%s} %s' % (name, labels, repr(method_stats.total_time / 1000.0)))
+                lines.append('%s_count{%s} %d' % (name, labels, method_stats.count))
+            for suffix, attr, help_text in [('errors_total', 'errors', 'failed %ss' % desc),
+                                            ('bytes_in_total', 'bytes_in', '%s bytes received' % desc),
+                                            ('bytes_out_total', 'bytes_out', '%s bytes sent' % desc)]:
+                name = '%s_%s' % (prefix, suffix)
+                lines.append('# HELP %s Total %s.' % (name, help_text))
+                lines.append('# TYPE %s counter' % name)
+                for device, method, method_stats in items:
+                    lines.append('%s{device="%s",method="%s"} %d' % (name, _escape_label(device),
+                                 _escape_label(method), getattr(method_stats, attr)))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        '''清空统计
+        '''
+        for stats, lock in self._stripes:
+            with lock:
+                stats.clear()
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics_registry():
+    '''获取进程内共享的统计
+
+    :returns: MetricsRegistry
+    '''
+    return _registry
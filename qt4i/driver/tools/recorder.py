@@ -0,0 +1,237 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''屏幕录制的分段存储
+
+录制目录下每个分段由两个文件组成：<开始时间毫秒>.mjpeg为连续存放的JPEG帧，
+<开始时间毫秒>.idx为每帧的(时间戳, 偏移, 长度)。分段按时间滚动，总大小超过上限时删除最旧的分段。
+截屏服务写入分段，driver server按时间范围读取。
+'''
+
+from __future__ import absolute_import, print_function
+
+import os
+import struct
+import threading
+import time
+
+from qt4i.driver.tools import logger as logging
+from testbase.conf import settings
+
+
+RECORDING_DIR = settings.get('QT4I_SCREEN_RECORDING_DIR', '/tmp/qt4i_recordings')
+SEGMENT_DURATION = 10 # 每个分段的时长（秒）
+MAX_RECORDING_SIZE = settings.get('QT4I_SCREEN_RECORDING_MAX_SIZE', 512 * 1024 * 1024) # 每台设备录制文件的总大小上限
+RETRY_INTERVAL = 1 # 录制出错后重新开始的初始间隔（秒），连续出错时按倍数增长
+MAX_RETRY_INTERVAL = 60 # 录制出错后重新开始的最大间隔（秒）
+INDEX_FORMAT = '<dQI' # 帧的时间戳、在分段中的偏移、长度
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+DATA_EXT = '.mjpeg'
+INDEX_EXT = '.idx'
+
+logger = logging.get_logger()
+
+
+def get_recording_dir(udid):
+    '''获取设备的录制目录
+
+    :param udid: 设备的udid
+    :type udid: str
+    :rtype: str
+    '''
+    return os.path.join(RECORDING_DIR, udid)
+
+
+def _list_segments(directory):
+    '''返回按开始时间排序的分段列表[(开始时间, 分段路径前缀), ...]
+    '''
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for filename in os.listdir(directory):
+        name, ext = os.path.splitext(filename)
+        if ext == INDEX_EXT and name.isdigit():
+            segments.append((int(name) / 1000.0, os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+class SegmentWriter(object):
+    '''按时间滚动写入分段
+    '''
+
+    def __init__(self, directory, segment_duration=SEGMENT_DURATION, max_size=MAX_RECORDING_SIZE):
+        '''构造函数
+
+        :param directory: 录制目录
+        :type directory: str
+        :param segment_duration: 每个分段的时长（秒）
+        :type segment_duration: float
+        :param max_size: 录制文件的总大小上限（字节）
+        :type max_size: int
+        '''
+        self._directory = directory
+        self._segment_duration = segment_duration
+        self._max_size = max_size
+        self._data_file = None
+        self._index_file = None
+        self._segment_start = None
+        self._offset = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, frame, timestamp):
+        '''写入一帧
+
+        :param frame: JPEG数据
+        :type frame: bytes
+        :param timestamp: 帧的时间戳
+        :type timestamp: float
+        '''
+        if self._segment_start is None or timestamp - self._segment_start >= self._segment_duration:
+            self._roll(timestamp)
+        self._data_file.write(frame)
+        self._data_file.flush()
+        # 帧数据写入后再写索引，读取时只使用索引中已有的帧
+        self._index_file.write(struct.pack(INDEX_FORMAT, timestamp, self._offset, len(frame)))
+        self._index_file.flush()
+        self._offset += len(frame)
+
+    def _roll(self, timestamp):
+        self.close()
+        if not os.path.isdir(self._directory): # 录制目录可能被外部清理
+            os.makedirs(self._directory)
+        path = os.path.join(self._directory, '%013d' % int(timestamp * 1000))
+        self._data_file = open(path + DATA_EXT, 'wb')
+        self._index_file = open(path + INDEX_EXT, 'wb')
+        self._segment_start = timestamp
+        self._offset = 0
+        self._remove_expired_segments()
+
+    def _remove_expired_segments(self):
+        segments = _list_segments(self._directory)
+        sizes = []
+        for _, path in segments:
+            try:
+                sizes.append(os.path.getsize(path + DATA_EXT) + os.path.getsize(path + INDEX_EXT))
+            except OSError:
+                sizes.append(0)
+        total = sum(sizes)
+        for (_, path), size in zip(segments[:-1], sizes): # 不删除正在写入的分段
+            if total <= self._max_size:
+                break
+            for ext in (INDEX_EXT, DATA_EXT):
+                try:
+                    os.remove(path + ext)
+                except OSError:
+                    pass
+            total -= size
+
+    def close(self):
+        fds = (self._data_file, self._index_file)
+        # 先重置状态，关闭失败时下次写入仍会打开新的分段
+        self._data_file = self._index_file = None
+        self._segment_start = None
+        for fd in fds:
+            if fd:
+                fd.close()
+
+
+def read_frames(directory, start_time, end_time):
+    '''按时间范围读取录制的帧
+
+    :param directory: 录制目录
+    :type directory: str
+    :param start_time: 开始时间戳
+    :type start_time: float
+    :param end_time: 结束时间戳
+    :type end_time: float
+    :returns: generator -- (时间戳, JPEG数据)
+    '''
+    segments = _list_segments(directory)
+    for i, (segment_start, path) in enumerate(segments):
+        segment_end = segments[i + 1][0] if i + 1 < len(segments) else time.time()
+        if segment_start > end_time or segment_end < start_time:
+            continue
+        try:
+            with open(path + INDEX_EXT, 'rb') as fd:
+                index = fd.read()
+            data_fd = open(path + DATA_EXT, 'rb')
+        except (IOError, OSError): # 分段已被删除
+            continue
+        with data_fd:
+            for pos in range(0, len(index) - INDEX_SIZE + 1, INDEX_SIZE):
+                timestamp, offset, length = struct.unpack_from(INDEX_FORMAT, index, pos)
+                if start_time <= timestamp <= end_time:
+                    data_fd.seek(offset)
+                    yield timestamp, data_fd.read(length)
+
+
+def export_recording(directory, start_time, end_time, output):
+    '''将时间范围内的帧导出为MJPEG
+
+    :param directory: 录制目录
+    :type directory: str
+    :param start_time: 开始时间戳
+    :type start_time: float
+    :param end_time: 结束时间戳
+    :type end_time: float
+    :param output: 写入的文件对象
+    :type output: file
+    :returns: int -- 导出的帧数
+    '''
+    count = 0
+    for _, frame in read_frames(directory, start_time, end_time):
+        output.write(frame)
+        count += 1
+    return count
+
+
+class ScreenRecorder(threading.Thread):
+    '''订阅截屏服务的帧并写入分段
+    '''
+
+    def __init__(self, broadcaster, directory, **kwargs):
+        '''构造函数
+
+        :param broadcaster: 帧广播
+        :type broadcaster: qt4i.driver.tools.screencapture.FrameBroadcaster
+        :param directory: 录制目录
+        :type directory: str
+        :param kwargs: SegmentWriter的参数
+        '''
+        super(ScreenRecorder, self).__init__()
+        self.daemon = True
+        self.subscriber = broadcaster.subscribe('recorder', latest=False)
+        self._writer = SegmentWriter(directory, **kwargs)
+
+    def run(self):
+        interval = RETRY_INTERVAL
+        while True:
+            try:
+                frame = self.subscriber.next_frame()
+                if frame is None: # 广播已关闭
+                    break
+                self._writer.write(frame, self.subscriber.timestamp)
+                interval = RETRY_INTERVAL
+            except Exception:
+                # 例如磁盘已满或录制目录被删除，等待后在新的分段中继续录制
+                logger.exception('screen recorder failed, retry in %s seconds' % interval)
+                try:
+                    self._writer.close()
+                except Exception:
+                    pass
+                time.sleep(interval)
+                interval = min(interval * 2, MAX_RETRY_INTERVAL)
+        self._writer.close()
@@ -45,8 +45,8 @@ class PortManager(object):
         if port_type not in PortManager.EnumPortType:
             raise Exception("端口类型%s异常，正确的类型有：%s" % (port_type,  str(cls.EnumPortType)))
         if port_type not in cls._port_maps:
-            with cls._lock:
-                cls._port_maps[port_type] = {}
+            with cls._lock: # 并行启动多台设备时避免覆盖其他线程创建的字典
+                cls._port_maps.setdefault(port_type, {})
         if not port:
             port = base
         if udid not in cls._port_maps[port_type]:
@@ -72,7 +72,7 @@ class PortManager(object):
             raise Exception("端口类型%s异常，正确的类型有：%s" % (port_type,  str(cls.EnumPortType)))
         if port_type not in cls._port_maps:
             with cls._lock:
-                cls._port_maps[port_type] = {}
+                cls._port_maps.setdefault(port_type, {})
         if udid not in cls._port_maps[port_type]:
             if port_type == 'web':
                 cls.set_port(port_type, udid, base=27753)
@@ -93,7 +93,7 @@ class PortManager(object):
             raise Exception("端口类型%s异常，正确的类型有：%s" % (port_type,  str(cls.EnumPortType)))
         if port_type not in cls._port_maps:
             with cls._lock:
-                cls._port_maps[port_type] = {}
+                cls._port_maps.setdefault(port_type, {})
         return udid in cls._port_maps[port_type]
     
     @classmethod
@@ -109,7 +109,7 @@ class PortManager(object):
             raise Exception("端口类型%s异常，正确的类型有：%s" % (port_type,  str(cls.EnumPortType)))
         if port_type not in cls._port_maps:
             with cls._lock:
-                cls._port_maps[port_type] = {}
+                cls._port_maps.setdefault(port_type, {})
         if udid in cls._port_maps[port_type]:
             with cls._lock:
                 cls._port_maps[port_type].pop(udid)
@@ -125,5 +125,5 @@ class PortManager(object):
             raise Exception("端口类型%s异常，正确的类型有：%s" % (port_type,  str(cls.EnumPortType)))
         if port_type not in cls._port_maps:
             with cls._lock:
-                cls._port_maps[port_type] = {}
+                cls._port_maps.setdefault(port_type, {})
         return cls._port_maps[port_type]
\ No newline at end of file
@@ -17,19 +17,25 @@
 
 from __future__ import absolute_import, print_function
 
-import Queue
+import collections
+import io
+import json
 import threading
 import time
 import struct
 import subprocess
 import re
 import os
+import select
+import socket
 import traceback
 
 import signal
 import argparse
 import atexit
 import sys
+import zlib
+import six
 from six.moves.socketserver import BaseRequestHandler
 from six.moves.socketserver import TCPServer
 from six.moves.socketserver import ThreadingMixIn
@@ -37,13 +43,36 @@ from six.moves.urllib.request import urlopen
 
 
 from qt4i.driver.tools import logger as logging
+from qt4i.driver.tools.recorder import ScreenRecorder
+from qt4i.driver.tools.recorder import get_recording_dir
 from qt4i.driver.util import Process
+from testbase.conf import settings
+
+try:
+    from PIL import Image
+except ImportError: # 未安装Pillow时不缩放和重新编码，变化检测只比较数据
+    Image = None
 
 
 DEFAULT_IP = '0.0.0.0'
 DEFAULT_PORT = 12306
 DEFAULT_AGENT_PORT = 8100
 DEFAULT_PID_FILE = '/tmp/screencapure.pid'
+MJPEG_FRAME_BUFFER_SIZE = 256 * 1024 # MJPEG帧缓冲区的初始大小，帧更大时按倍数扩容
+FRAME_RING_SIZE = 8 # 广播环形缓冲区保存的帧数
+FPS_WINDOW = 30 # 按最近多少帧计算客户端的帧率
+PHASH_SIZE = 32 # 感知哈希使用的灰度缩略图边长
+KEYFRAME_INTERVAL = 1.0 # 画面未变化时至少每隔多少秒发布一帧，避免感知哈希漏掉细小变化
+# 模拟器常驻截屏命令，需要向标准输出连续输出JPEG，%(udid)s替换为模拟器的udid；
+# 默认不启用，模拟器逐帧截屏。simctl不支持将录制的视频输出到标准输出，需要配置能够连续输出JPEG的工具
+SIM_STREAM_CMD = settings.get('QT4I_SIM_SCREEN_STREAM_CMD', '')
+SIM_SCREENSHOT_CMD = 'xcrun simctl io %(udid)s screenshot --type=jpeg -'
+STREAM_START_TIMEOUT = 10 # 常驻截屏进程输出第一帧的超时时间
+SOURCE_RETRY_INTERVAL = 60 # 使用备用帧来源后，每隔多少秒重新尝试优先的帧来源
+SOURCE_RESTART_INTERVAL = 1 # 帧来源意外结束后重启的初始间隔（秒），连续意外结束时按倍数增长
+SOURCE_MAX_RESTART_INTERVAL = 30 # 帧来源重启间隔的上限（秒）
+SOURCE_MIN_UPTIME = 10 # 帧来源至少运行多少秒后结束才重置重启间隔
+STREAM_READ_SIZE = 256 * 1024
 
 logger = logging.get_logger()
 
@@ -81,6 +110,9 @@ main_parser.add_argument('--listen_port', '-l', metavar='LISTENPORT', dest='list
 main_parser.add_argument('--mjpeg_port', '-m', metavar='MJPEGPORT', dest='mjpeg_port', default=DEFAULT_AGENT_PORT,
                          help='listening port of xctest agent, port %s is used by default' % DEFAULT_AGENT_PORT)
 
+main_parser.add_argument('--record', '-r', action='store_true', dest='record', default=False,
+                         help='record frames into rolling segments for device.get_recording')
+
 subparser_dict = {}
 subparsers = main_parser.add_subparsers(title='List of Commands', metavar='COMMAND')
 for command in CMD_HELP:
@@ -239,35 +271,326 @@ class ThreadedTCPServer(ThreadingMixIn, TCPServer):
     request_queue_size = 16
 
 
+def transcode_jpeg(data, max_size=0, quality=0):
+    '''缩放并重新编码JPEG，未安装Pillow时返回原数据
+
+    :param data: JPEG数据
+    :type data: bytes
+    :param max_size: 长边的最大像素数，0表示不缩放
+    :type max_size: int
+    :param quality: JPEG质量(1-95)，0表示只在缩放时以默认质量重新编码
+    :type quality: int
+    :returns: bytes
+    '''
+    if Image is None or not (max_size or quality):
+        return data
+    try:
+        img = Image.open(io.BytesIO(data))
+        if max_size and max(img.size) > max_size:
+            img.draft('RGB', (max_size, max_size)) # JPEG按1/2、1/4、1/8比例解码，减少解码开销
+            img.thumbnail((max_size, max_size))
+        elif not quality:
+            return data
+        output = io.BytesIO()
+        img.convert('RGB').save(output, 'JPEG', quality=quality or 75)
+    except (IOError, ValueError): # 无法解码的帧原样发送
+        logger.exception('transcode jpeg failed')
+        return data
+    return output.getvalue()
+
+
+def perceptual_hash(data):
+    '''计算JPEG的差异哈希(dHash)，画面相同的帧哈希相同；未安装Pillow时返回数据的CRC32
+
+    :param data: JPEG数据
+    :type data: bytes
+    :rtype: int
+    '''
+    if Image is None:
+        return zlib.crc32(data)
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft('L', (PHASH_SIZE * 2, PHASH_SIZE * 2))
+        pixels = list(img.convert('L').resize((PHASH_SIZE + 1, PHASH_SIZE)).getdata())
+    except (IOError, ValueError):
+        return zlib.crc32(data)
+    value = 0
+    for row in range(PHASH_SIZE):
+        offset = row * (PHASH_SIZE + 1)
+        for col in range(PHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class StreamProfile(collections.namedtuple('StreamProfile', ['max_fps', 'max_size', 'quality'])):
+    '''客户端协商的推流参数
+
+    max_fps为最大帧率，max_size为长边的最大像素数，quality为JPEG质量，均为0表示不限制
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, options):
+        return cls(float(options.get('fps', 0)), int(options.get('max_size', 0)), int(options.get('quality', 0)))
+
+
+DEFAULT_PROFILE = StreamProfile(0, 0, 0)
+
+
+class Frame(object):
+    '''广播的帧，不同缩放参数的编码结果在订阅者之间共享，每种参数只编码一次
+    '''
+    __slots__ = ('seq', 'timestamp', 'data', '_renditions', '_lock')
+
+    def __init__(self, seq, timestamp, data):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.data = data
+        self._renditions = {}
+        self._lock = threading.Lock()
+
+    def render(self, max_size=0, quality=0):
+        '''获取按参数缩放和编码后的数据
+
+        :rtype: bytes
+        '''
+        if not (max_size or quality):
+            return self.data
+        key = (max_size, quality)
+        with self._lock:
+            data = self._renditions.get(key)
+            if data is None:
+                data = self._renditions[key] = transcode_jpeg(self.data, max_size, quality)
+        return data
+
+
+class FrameBroadcaster(object):
+    '''帧广播，最近的帧保存在环形缓冲区中由所有订阅者共享，订阅者只保存读取位置
+    '''
+
+    def __init__(self, capacity=FRAME_RING_SIZE):
+        self._capacity = capacity
+        self._ring = [None] * capacity # 元素为Frame
+        self._next_seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def publish(self, frame, timestamp=None):
+        '''发布一帧，缓冲区满时覆盖最旧的帧
+
+        :param frame: 帧数据，发布后不能修改
+        :type frame: bytes
+        :param timestamp: 帧的时间戳，默认为当前时间
+        :type timestamp: float
+        '''
+        with self._cond:
+            if timestamp is None:
+                timestamp = time.time()
+            self._ring[self._next_seq % self._capacity] = Frame(self._next_seq, timestamp, frame)
+            self._next_seq += 1
+            self._cond.notify_all()
+
+    def get(self, cursor, latest=True, timeout=None):
+        '''获取序号大于cursor的帧
+
+        :param cursor: 上次获取的帧的序号，首次获取时为-1
+        :type cursor: int
+        :param latest: 为True时返回最新的帧，否则返回下一帧，下一帧已被覆盖时返回缓冲区中最旧的帧
+        :type latest: boolean
+        :param timeout: 等待新帧的超时时间，None表示一直等待
+        :type timeout: float
+        :returns: Frame -- 超时或已关闭时返回None
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._next_seq <= cursor + 1 and not self._closed:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            if self._next_seq <= cursor + 1:
+                return None
+            if latest:
+                seq = self._next_seq - 1
+            else:
+                seq = max(cursor + 1, self._next_seq - self._capacity)
+            return self._ring[seq % self._capacity]
+
+    def subscribe(self, name=None, latest=True, profile=DEFAULT_PROFILE):
+        '''订阅帧
+
+        :param name: 订阅者名称，用于统计
+        :type name: str
+        :param latest: 订阅者处理慢时是否跳到最新的帧，参见get
+        :type latest: boolean
+        :param profile: 推流参数
+        :type profile: StreamProfile
+        :rtype: FrameSubscriber
+        '''
+        with self._cond:
+            return FrameSubscriber(self, name, self._next_seq - 1, latest, profile)
+
+    def close(self):
+        '''关闭广播，唤醒所有等待的订阅者
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+class FrameSubscriber(object):
+    '''帧的订阅者，记录读取位置和送达统计
+    '''
+
+    def __init__(self, broadcaster, name, cursor, latest, profile=DEFAULT_PROFILE):
+        self.name = name
+        self.profile = profile
+        self.timestamp = None # 上次获取的帧的时间戳
+        self._broadcaster = broadcaster
+        self._cursor = cursor
+        self._latest = latest
+        self._delivered = 0
+        self._dropped = 0
+        self._lag = 0.0
+        self._max_lag = 0.0
+        self._delivery_times = collections.deque(maxlen=FPS_WINDOW)
+
+    def next_frame(self, timeout=None):
+        '''获取下一帧，中间被跳过的帧计入丢帧数；限制了帧率时先等到下一帧的发送时间
+
+        :param timeout: 超时时间，None表示一直等待
+        :type timeout: float
+        :returns: bytes -- 按推流参数编码的帧数据，超时或广播已关闭时返回None
+        '''
+        if self.profile.max_fps and self._delivery_times:
+            delay = self._delivery_times[-1] + 1.0 / self.profile.max_fps - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        frame = self._broadcaster.get(self._cursor, self._latest, timeout)
+        if frame is None:
+            return None
+        data = frame.render(self.profile.max_size, self.profile.quality)
+        now = time.time()
+        self._dropped += frame.seq - self._cursor - 1
+        self._cursor = frame.seq
+        self.timestamp = frame.timestamp
+        self._delivered += 1
+        self._lag = now - frame.timestamp
+        self._max_lag = max(self._max_lag, self._lag)
+        self._delivery_times.append(now)
+        return data
+
+    def get_stats(self):
+        '''获取统计数据
+
+        :returns: dict -- {'name', 'profile', 'delivered', 'dropped', 'fps', 'lag_ms', 'max_lag_ms'}，
+                         fps按最近FPS_WINDOW帧计算，lag为帧发布到被取走的时间
+        '''
+        times = self._delivery_times
+        fps = 0.0
+        if len(times) > 1 and times[-1] > times[0]:
+            fps = (len(times) - 1) / (times[-1] - times[0])
+        return {'name': self.name,
+                'profile': self.profile._asdict(),
+                'delivered': self._delivered,
+                'dropped': self._dropped,
+                'fps': round(fps, 1),
+                'lag_ms': round(self._lag * 1000, 1),
+                'max_lag_ms': round(self._max_lag * 1000, 1)}
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('connection closed by client')
+        data += chunk
+    return data
+
+
+def get_screen_stats(port=DEFAULT_PORT, host='localhost', timeout=5):
+    '''获取运行中的截屏服务的实时统计
+
+    :param port: 截屏服务的监听端口
+    :type port: int
+    :param host: 截屏服务的地址
+    :type host: str
+    :param timeout: 超时时间（秒）
+    :type timeout: float
+    :returns: dict -- 与ScreenProducer.get_stats的返回值相同
+    '''
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        sock.sendall(b'screenstat')
+        length = struct.unpack("I", _recv_exactly(sock, 4))[0]
+        return json.loads(_recv_exactly(sock, length).decode('utf-8'))
+    finally:
+        sock.close()
+
+
 class ScreenConsumer(BaseRequestHandler):
+    '''推流客户端的连接
+
+    客户端发送"screenshot"开始接收原始帧；或者发送"screenopts"，后跟4字节长度和JSON格式的推流参数，
+    例如{"fps": 10, "max_size": 720, "quality": 60}。之后每帧以4字节长度加JPEG数据发送。
+    客户端发送"screenstat"时返回4字节长度和JSON格式的实时统计，然后关闭连接。
+    '''
 
     def setup(self):
-        self.screenqueue = Queue.Queue(24)
         self.screen_producer = self.server.screen_producer
-        assert self.request.recv(10) == 'screenshot'
+        self.subscriber = None
+        command = self._recv_exactly(10)
+        assert command in (b'screenshot', b'screenopts', b'screenstat')
+        if command == b'screenstat':
+            data = json.dumps(self.screen_producer.get_stats()).encode('utf-8')
+            self.request.sendall(struct.pack("I", len(data)) + data)
+            return
+        profile = DEFAULT_PROFILE
+        if command == b'screenopts':
+            length = struct.unpack("I", self._recv_exactly(4))[0]
+            profile = StreamProfile.from_dict(json.loads(self._recv_exactly(length).decode('utf-8')))
+        self.subscriber = self.screen_producer.broadcaster.subscribe('%s:%s' % self.client_address[:2],
+                                                                     profile=profile)
         self.screen_producer.add_client(self)
 
+    def _recv_exactly(self, size):
+        return _recv_exactly(self.request, size)
+
     def handle(self):
-        while True:
-            image_data = self.screenqueue.get()
+        while self.subscriber is not None:
+            image_data = self.subscriber.next_frame()
+            if image_data is None:
+                break
             try:
                 image_length = len(image_data)
-                self.request.sendall(struct.pack("I", image_length) + image_data)
+                self.request.sendall(struct.pack("I", image_length))
+                self.request.sendall(image_data)
             except:
                 break
 
     def finish(self):
         self.request.close()
-        self.screen_producer.remove_client(self)
+        if self.subscriber is not None:
+            self.screen_producer.remove_client(self)
+            logger.info('screen client stats: %s' % self.subscriber.get_stats())
 
 
 class ScreenCaptureService(Daemon):
 
-    def __init__(self, pidfile, udid, listen_port, mjpeg_port):
+    def __init__(self, pidfile, udid, listen_port, mjpeg_port, record=False):
         Daemon.__init__(self, pidfile)
         self._udid = udid
         self._listen_port = listen_port
         self._mjpeg_port = mjpeg_port
+        self._record = record
 
     def start(self, is_daemon=True):
         '''启动service
@@ -291,6 +614,10 @@ class ScreenCaptureService(Daemon):
             if self._mjpeg_port:
                 screen_producer = ScreenProducer(self._udid, int(self._mjpeg_port))
                 screen_producer.start()
+                if self._record: # 录制时一直截屏，不再等待推流客户端连接
+                    recorder = ScreenRecorder(screen_producer.broadcaster, get_recording_dir(self._udid))
+                    screen_producer.add_client(recorder)
+                    recorder.start()
                 server = ThreadedTCPServer(('localhost', int(self._listen_port)), ScreenConsumer)
                 server.screen_producer = screen_producer
                 server.serve_forever()
@@ -302,10 +629,33 @@ class ScreenCaptureService(Daemon):
 
 
 class MJpegClient(object):
+    '''MJPEG流的客户端，帧数据按Content-Length直接读入预分配的缓冲区，缓冲区在帧之间复用
+    '''
 
-    def __init__(self, url):
-        self.stream = urlopen(url)
+    def __init__(self, url=None, stream=None, boundary=None):
+        '''构造函数
+
+        :param url: MJPEG服务的URL
+        :type url: str
+        :param stream: 已打开的MJPEG流，例如录制的文件，指定时不访问url
+        :type stream: file
+        :param boundary: 流的boundary，指定stream时需要指定
+        :type boundary: str
+        '''
+        self.stream = stream if stream is not None else urlopen(url)
         self.boundary = None
+        self._boundary_lines = ()
+        if boundary:
+            self._set_boundary(boundary)
+        self._readinto = getattr(self.stream, 'readinto', None)
+        self._frame = bytearray(MJPEG_FRAME_BUFFER_SIZE)
+        self._frame_view = memoryview(self._frame)
+
+    def _set_boundary(self, boundary):
+        self.boundary = boundary
+        if isinstance(boundary, six.text_type):
+            boundary = boundary.encode('ascii')
+        self._boundary_lines = (boundary, b'--' + boundary)
 
     def parse_mjpeg_boundary(self):
         '''
@@ -316,15 +666,20 @@ class MJpegClient(object):
         '''
 
         if self.stream.getcode() != 200:
-            raise Exception('Invalid response from server: %d' % self.stream.status)
+            raise Exception('Invalid response from server: %d' % self.stream.getcode())
         h = self.stream.info()
         content_type = h.get('Content-Type', None)
-        match = re.search(r'boundary="?(.*)"?', content_type)
+        match = re.search(r'boundary="?([^";]*)"?', content_type or '')
         if match is None:
             raise Exception('Content-Type header does not provide boundary string')
-        self.boundary = match.group(1)
+        self._set_boundary(match.group(1))
+        return self.boundary
 
-    def read_mjpeg_frame(self):
+    def read_frame(self):
+        '''读取一帧，不复制数据
+
+        :returns: memoryview -- 帧数据，只在下次读取前有效，需要保留时调用bytes()复制
+        '''
         hdr = self._read_headers(self.boundary)
 
         clen = self._parse_content_length(hdr)
@@ -332,13 +687,29 @@ class MJpegClient(object):
             raise EOFError('End of stream reached')
 
         self._check_content_type(hdr, 'image/jpg')
-        left = clen
-        buf = ''
-        while left > 0:
-            tmp = self.stream.read(left)
-            buf += tmp
-            left -= len(tmp)
-        return buf
+        if clen > len(self._frame):
+            self._frame = bytearray(max(clen, len(self._frame) * 2))
+            self._frame_view = memoryview(self._frame)
+        view = self._frame_view[:clen]
+        offset = 0
+        while offset < clen:
+            if self._readinto:
+                n = self._readinto(view[offset:])
+            else: # Python 2的urlopen返回的流没有readinto
+                data = self.stream.read(clen - offset)
+                n = len(data)
+                view[offset:offset + n] = data
+            if not n:
+                raise EOFError('End of stream reached')
+            offset += n
+        return view
+
+    def read_mjpeg_frame(self):
+        '''读取一帧
+
+        :returns: bytes -- JPEG数据
+        '''
+        return self.read_frame().tobytes()
 
     def close(self):
         self.stream.close()
@@ -349,7 +720,10 @@ class MJpegClient(object):
         headers like Content-Type and Content-Length which determine the type and
         length of the data portion.
         '''
-        return self.stream.readline().strip()
+        line = self.stream.readline()
+        if not line:
+            raise EOFError('End of stream reached')
+        return line.strip()
 
     def _read_headers(self, boundary):
         '''Read and return stream headers.
@@ -360,27 +734,27 @@ class MJpegClient(object):
         converted to lower case. Each value in the dictionary is a list of header
         fields values.
         '''
-        l = ''
+        l = b''
         while True:
             l = self._read_header_line()
-            if l != '':
+            if l != b'':
                 break
-        if l != boundary:
+        if l not in self._boundary_lines:
             raise Exception('Boundary string expected, but not found')
 
         headers = {}
         while True:
             l = self._read_header_line()
             # An empty line indicates the end of the header section
-            if l == '':
+            if l == b'':
                 break
 
             # Parse the header into lower case header name and header body
-            i = l.find(':')
+            i = l.find(b':')
             if i == -1:
-                raise Exception('Invalid header line: ' + l)
-            name = l[:i].lower()
-            body = l[i + 1:].strip()
+                raise Exception('Invalid header line: %r' % l)
+            name = l[:i].lower().decode('latin-1')
+            body = l[i + 1:].strip().decode('latin-1')
 
             lst = headers.get(name, list())
             lst.append(body)
@@ -411,11 +785,211 @@ class MJpegClient(object):
         return True
 
 
+class FrameSourceError(Exception):
+    '''帧来源不可用
+    '''
+
+
+class JpegStreamParser(object):
+    '''从连续输出的JPEG数据中切分出完整的帧
+
+    按JPEG段结构解析，不会被EXIF缩略图中的EOI标记截断；熵编码数据中的0xFF后为0x00或RST标记。
+    '''
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0 # 当前帧中下一个待解析的位置，0表示还未找到SOI
+        self._in_scan = False
+
+    def feed(self, data):
+        '''输入数据
+
+        :param data: 进程输出的数据
+        :type data: bytes
+        :returns: list -- 数据中包含的完整帧
+        '''
+        self._buf += data
+        frames = []
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def _next_frame(self):
+        buf = self._buf
+        if self._pos == 0:
+            start = buf.find(b'\xff\xd8')
+            if start < 0:
+                del buf[:-1] # 保留可能是SOI第一个字节的0xFF
+                return None
+            del buf[:start]
+            self._pos = 2
+        while True:
+            if self._in_scan:
+                i = buf.find(b'\xff', self._pos)
+                while 0 <= i < len(buf) - 1 and (buf[i + 1] == 0 or 0xd0 <= buf[i + 1] <= 0xd7):
+                    i = buf.find(b'\xff', i + 2)
+                if i < 0 or i == len(buf) - 1:
+                    self._pos = len(buf) - 1 if i < 0 else i
+                    return None
+                self._pos = i
+                self._in_scan = False
+            pos = self._pos
+            if pos + 2 > len(buf):
+                return None
+            if buf[pos] != 0xff: # 数据损坏，丢弃当前帧
+                del buf[:pos]
+                self._pos = 0
+                return self._next_frame()
+            marker = buf[pos + 1]
+            if marker == 0xff: # 填充字节
+                self._pos += 1
+            elif marker == 0xd9: # EOI
+                frame = bytes(buf[:pos + 2])
+                del buf[:pos + 2]
+                self._pos = 0
+                return frame
+            elif 0xd0 <= marker <= 0xd8 or marker == 0x01: # 无长度的标记
+                self._pos += 2
+            else:
+                if pos + 4 > len(buf):
+                    return None
+                length = (buf[pos + 2] << 8) | buf[pos + 3]
+                if pos + 2 + length > len(buf):
+                    return None
+                self._pos += 2 + length
+                self._in_scan = (marker == 0xda) # SOS之后为熵编码数据
+
+
+class FrameSource(object):
+    '''ScreenProducer的帧来源
+    '''
+
+    def open(self):
+        '''开始读取，失败时抛出异常
+        '''
+        pass
+
+    def read_frame(self):
+        '''读取一帧，阻塞直到有新帧
+
+        :returns: bytes -- JPEG数据
+        :raises: EOFError -- 来源已结束
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MJpegFrameSource(FrameSource):
+    '''XCTestAgent输出的MJPEG流
+    '''
+
+    def __init__(self, url):
+        self._url = url
+        self._client = None
+
+    def open(self):
+        self._client = MJpegClient(self._url)
+        self._client.parse_mjpeg_boundary()
+
+    def read_frame(self):
+        return self._client.read_mjpeg_frame()
+
+    def close(self):
+        if self._client:
+            self._client.close()
+            self._client = None
+
+
+class ProcessFrameSource(FrameSource):
+    '''常驻进程的标准输出，进程需要连续输出JPEG
+    '''
+
+    def __init__(self, cmd, start_timeout=STREAM_START_TIMEOUT):
+        '''构造函数
+
+        :param cmd: 命令，为字符串时通过shell执行
+        :type cmd: str or list
+        :param start_timeout: 输出第一帧的超时时间
+        :type start_timeout: float
+        '''
+        self._cmd = cmd
+        self._start_timeout = start_timeout
+        self._process = None
+        self._parser = None
+        self._frames = collections.deque()
+        self._started = False
+
+    def open(self):
+        self._parser = JpegStreamParser()
+        self._frames.clear()
+        self._started = False
+        # 使用新的进程组，关闭时能结束shell管道中的所有进程
+        self._process = subprocess.Popen(self._cmd, shell=isinstance(self._cmd, six.string_types),
+                                         stdout=subprocess.PIPE, preexec_fn=os.setsid)
+
+    def read_frame(self):
+        fd = self._process.stdout.fileno()
+        while not self._frames:
+            if not self._started:
+                readable, _, _ = select.select([fd], [], [], self._start_timeout)
+                if not readable:
+                    raise FrameSourceError('no frame from "%s" in %ss' % (self._cmd, self._start_timeout))
+            data = os.read(fd, STREAM_READ_SIZE)
+            if not data:
+                raise EOFError('process exited with code %s' % self._process.wait())
+            self._frames.extend(self._parser.feed(data))
+        self._started = True
+        return self._frames.popleft()
+
+    def close(self):
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            try:
+                os.killpg(self._process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self._process.stdout.close()
+        self._process.wait()
+        self._process = None
+
+
+class ScreenshotFrameSource(FrameSource):
+    '''每帧执行一次模拟器截屏命令，作为常驻截屏不可用时的后备
+    '''
+
+    def __init__(self, udid):
+        self._cmd = SIM_SCREENSHOT_CMD % {'udid': udid}
+
+    def read_frame(self):
+        return subprocess.check_output(self._cmd, shell=True)
+
+
 class ScreenProducer(threading.Thread):
 
-    def __init__(self, udid, mjpeg_port):
+    def __init__(self, udid, mjpeg_port, frame_sources=None):
+        '''构造函数
+
+        :param udid: 设备的udid
+        :type udid: str
+        :param mjpeg_port: XCTestAgent的MJPEG端口
+        :type mjpeg_port: int
+        :param frame_sources: 创建FrameSource的函数列表，按优先级排列，一个来源没有读到任何帧时使用下一个，
+                              之后每隔SOURCE_RETRY_INTERVAL重新尝试第一个；来源运行不到SOURCE_MIN_UPTIME就结束时，
+                              重启间隔从SOURCE_RESTART_INTERVAL开始按倍数增长；默认真机使用XCTestAgent的MJPEG流，
+                              模拟器在配置了QT4I_SIM_SCREEN_STREAM_CMD时使用常驻截屏进程，否则逐帧截屏
+        :type frame_sources: list
+        '''
         super(ScreenProducer, self).__init__()
         self._clients = set()
+        self.broadcaster = FrameBroadcaster()
+        self.suppressed_frames = 0
+        self._last_hash = None
+        self._last_publish_time = 0
         self._udid = udid
         self.running = True
         self._mutex = threading.Lock()
@@ -428,6 +1002,14 @@ class ScreenProducer(threading.Thread):
             self._url = "http://127.0.0.1:%s" % mjpeg_port
         else:
             self._is_simulator = True
+        if frame_sources is None:
+            if self._is_simulator:
+                frame_sources = [lambda: ScreenshotFrameSource(udid)]
+                if SIM_STREAM_CMD:
+                    frame_sources.insert(0, lambda: ProcessFrameSource(SIM_STREAM_CMD % {'udid': udid}))
+            else:
+                frame_sources = [lambda: MJpegFrameSource(self._url)]
+        self._frame_sources = frame_sources
 
     @property
     def is_sim(self):
@@ -446,63 +1028,96 @@ class ScreenProducer(threading.Thread):
                 self.no_client = True
                 self.mjpeg_conn_event.clear()
 
-    def process_mjpeg_stream(self, mjpeg_client):
-        mjpeg_client.parse_mjpeg_boundary()
+    def get_client_stats(self):
+        '''获取所有客户端的送达统计
 
-        while True:
-            jpeg_frame = mjpeg_client.read_mjpeg_frame()
-            with self._mutex:
-                if len(self._clients) == 0:
-                    break
-            for client in self._clients:
-                if client.screenqueue.full():
-                    continue
-                client.screenqueue.put(jpeg_frame)
+        :rtype: list
+        '''
+        with self._mutex:
+            clients = list(self._clients)
+        return [client.subscriber.get_stats() for client in clients]
+
+    def get_stats(self):
+        '''获取实时统计，包括所有客户端的送达统计和画面未变化而未发布的帧数
+
+        :rtype: dict
+        '''
+        return {'clients': self.get_client_stats(),
+                'suppressed_frames': self.suppressed_frames}
 
-    def _capture_screen_by_xctestagent(self):
+    def _publish_frame(self, jpeg_frame):
+        '''发布一帧，与上一帧画面相同时不发布，但间隔KEYFRAME_INTERVAL后仍会发布
+        '''
+        frame_hash = perceptual_hash(jpeg_frame)
+        now = time.time()
+        if frame_hash == self._last_hash and now - self._last_publish_time < KEYFRAME_INTERVAL:
+            self.suppressed_frames += 1
+            return
+        self._last_hash = frame_hash
+        self._last_publish_time = now
+        self.broadcaster.publish(jpeg_frame, now)
+
+    def _process_frame_source(self, frame_source, deadline=None):
+        '''从帧来源读取并发布帧，直到没有客户端、来源结束或到达deadline
+
+        :param deadline: 停止读取的时间戳，为None时不限制
+        :type deadline: float
+        :returns: int -- 读到的帧数
+        '''
+        count = 0
         try:
-            if self.no_client:
-                self.mjpeg_conn_event.wait()
-            mjpeg_client = MJpegClient(self._url)
-            self.process_mjpeg_stream(mjpeg_client)
+            frame_source.open()
+            while self.running:
+                jpeg_frame = frame_source.read_frame()
+                count += 1
+                with self._mutex:
+                    if len(self._clients) == 0:
+                        break
+                self._publish_frame(jpeg_frame)
+                if deadline is not None and time.time() >= deadline:
+                    break
         except EOFError:
             pass
         except Exception:
             logger.exception(traceback.format_exc())
         finally:
-            mjpeg_client.close()
-
-    def _capture_screen_by_simctl(self):
-        try:
-            if self.no_client:
-                self.mjpeg_conn_event.wait()
-            cmd = 'xcrun simctl io %s screenshot --type=jpeg -' % self._udid
-            jpeg_frame = subprocess.check_output(cmd, shell=True)
-            with self._mutex:
-                if len(self._clients) == 0:
-                    return
-            for client in self._clients:
-                if client.screenqueue.full():
-                    continue
-                client.screenqueue.put(jpeg_frame)
-        except:
-            logger.exception(traceback.format_exc())
-            time.sleep(1)
+            frame_source.close()
+        return count
 
     def run(self):
+        index = 0
+        retry_time = None # 重新尝试第一个帧来源的时间
+        restart_interval = SOURCE_RESTART_INTERVAL
         while self.running:
-            if self.is_sim:
-                self._capture_screen_by_simctl()
-            else:
-                self._capture_screen_by_xctestagent()
+            if self.no_client:
+                self.mjpeg_conn_event.wait()
+            if retry_time is not None and time.time() >= retry_time:
+                index, retry_time = 0, None
+                logger.info('retry frame source 0')
+            start_time = time.time()
+            count = self._process_frame_source(self._frame_sources[index](), retry_time)
+            if not self.running or self.no_client or (retry_time is not None and time.time() >= retry_time):
+                continue # 停止、没有客户端或需要重新尝试第一个帧来源，不是意外结束
+            if count == 0 and index + 1 < len(self._frame_sources):
+                index += 1
+                retry_time = time.time() + SOURCE_RETRY_INTERVAL
+                logger.warning('frame source failed, fall back to frame source %d' % index)
+                continue
+            if time.time() - start_time >= SOURCE_MIN_UPTIME:
+                restart_interval = SOURCE_RESTART_INTERVAL
+                continue
+            logger.warning('frame source %d exited after %d frames, restart in %ss' % (index, count, restart_interval))
+            time.sleep(restart_interval)
+            restart_interval = min(restart_interval * 2, SOURCE_MAX_RESTART_INTERVAL)
 
     def stop(self):
         self.running = False
+        self.broadcaster.close()
 
 
 if __name__ == '__main__':
     args = main_parser.parse_args()
-    sc = ScreenCaptureService(args.pidfile, args.udid, args.listen_port, args.mjpeg_port)
+    sc = ScreenCaptureService(args.pidfile, args.udid, args.listen_port, args.mjpeg_port, args.record)
 
     if args.func == 'start':
         sc.start()
@@ -15,8 +15,10 @@
 '''driver的常用辅助工具（仅限driver内部使用）
 '''
 from qt4i.driver.util._args import *
+from qt4i.driver.util._codec import *
 from qt4i.driver.util._files import *
+from qt4i.driver.util._find import *
 from qt4i.driver.util._process import *
 from qt4i.driver.util._task import *
 
-__all__ = ['Args', 'FileManager', 'zip_decompress','Process', 'Task', 'ThreadTask']
\ No newline at end of file
+__all__ = ['Args', 'get_json_codec', 'get_msgpack_codec', 'FileManager', 'find_elements_in_rounds', 'zip_decompress','Process', 'Task', 'ThreadTask']
\ No newline at end of file
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''JSON编解码，优先使用已安装的orjson/ujson，支持msgpack
+'''
+
+import json
+import os
+
+import six
+from testbase.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec(object):
+    '''标准库json编解码
+    '''
+    name = 'json'
+    content_type = 'application/json-rpc'
+
+    def dumps(self, obj):
+        '''序列化为文本
+
+        :returns: str
+        '''
+        return json.dumps(obj)
+
+    def dumpb(self, obj):
+        '''序列化为UTF-8编码的字节
+
+        :returns: bytes
+        '''
+        data = self.dumps(obj)
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        return data
+
+    def loads(self, data):
+        '''反序列化，解析失败抛出ValueError
+
+        :param data: 文本或UTF-8编码的字节
+        :type data: str or bytes
+        '''
+        if not six.PY2 and isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    '''orjson编解码，orjson不支持的对象（例如超过64位的整数）退回标准库
+    '''
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode('utf-8')
+
+    def dumpb(self, obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UJSONCodec(JSONCodec):
+    '''ujson编解码
+    '''
+    name = 'ujson'
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii=False)
+        except (TypeError, OverflowError):
+            return json.dumps(obj)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class MsgpackCodec(JSONCodec):
+    '''msgpack编解码，只用于HTTP包体，dumps返回的是字节
+    '''
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def dumps(self, obj):
+        return self.dumpb(obj)
+
+    def dumpb(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise ValueError('msgpack parsing error: %s' % e)
+
+
+JSON_CODECS = [(OrjsonCodec, orjson), (UJSONCodec, ujson), (JSONCodec, json)]
+# 指定JSON编解码器(json、ujson或orjson)，未配置时兼容读取同名环境变量，都未指定时按JSON_CODECS的顺序选择
+JSON_CODEC = settings.get('QT4I_JSON_CODEC', None) or os.environ.get('QT4I_JSON_CODEC')
+
+
+def get_json_codec(name=None):
+    '''获取JSON编解码器，默认按orjson、ujson、json的顺序选择已安装的实现，
+    可以通过配置项QT4I_JSON_CODEC指定
+
+    :param name: json、ujson或orjson
+    :type name: str
+    :returns: JSONCodec
+    '''
+    name = name or JSON_CODEC
+    for codec_cls, module in JSON_CODECS:
+        if module is not None and (name is None or name == codec_cls.name):
+            return codec_cls()
+    return JSONCodec()
+
+
+def get_msgpack_codec():
+    '''获取msgpack编解码器，未安装msgpack时返回None
+
+    :returns: MsgpackCodec or None
+    '''
+    if msgpack is None:
+        return None
+    return MsgpackCodec()
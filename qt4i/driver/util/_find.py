@@ -0,0 +1,126 @@
+﻿# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''批量查找控件的轮次调度
+'''
+
+import sys
+import threading
+import time
+
+import six
+
+
+def _parent_depths(locators):
+    depths = []
+    for item in locators:
+        depth, parent = 0, item.get('parent')
+        while parent is not None and depth < len(locators): # 限制层数，避免parent循环引用
+            depth += 1
+            parent = locators[parent].get('parent')
+        depths.append(depth)
+    return depths
+
+
+def _map_concurrently(func, items, max_concurrency):
+    '''用最多max_concurrency个线程执行func，返回与items一一对应的结果，有异常时抛出第一个异常
+    '''
+    if max_concurrency <= 1 or len(items) <= 1:
+        return [func(it) for it in items]
+    results = [None] * len(items)
+    errors = []
+    indexes = six.moves.queue.Queue()
+    for i in range(len(items)):
+        indexes.put(i)
+    def work():
+        while True:
+            try:
+                i = indexes.get_nowait()
+            except six.moves.queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=work) for _ in range(min(max_concurrency, len(items)) - 1)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    work() # 当前线程也参与查找
+    for t in threads:
+        t.join()
+    if errors:
+        six.reraise(*errors[0])
+    return results
+
+
+def find_elements_in_rounds(find, locators, timeout, interval, backoff_factor, max_interval, max_concurrency=1):
+    '''按轮次查找多个locator，每轮查找所有未找到的locator，直到全部找到或超时。
+    每轮按父子层级分批，父element先于子element查找，同一批中互不依赖的locator最多用max_concurrency个线程并发查找；
+    未找到时轮次间隔按指数增长，减少对设备的请求次数
+    
+    :param find: 查找单个locator的函数，参数为(locators中的一项, parent_id)，返回find_elements的结果
+    :type find: callable
+    :param locators: [{'locator': <str>, 'strategy': <str>, 'parent_id': <int>, 'parent': <locators中的下标>}, ...]
+    :type locators: list
+    :param timeout: 查找全部element的超时值（秒），为0时只查找一轮
+    :type timeout: float
+    :param interval: 第一轮与第二轮之间的间隔（秒）
+    :type interval: float
+    :param backoff_factor: 间隔的增长倍数
+    :type backoff_factor: float
+    :param max_interval: 间隔的上限（秒）
+    :type max_interval: float
+    :param max_concurrency: 并发查找的线程数上限，为1时按顺序查找
+    :type max_concurrency: int
+    :returns: list -- 与locators一一对应，每项与find_elements的返回值相同
+    '''
+    start_time = time.time()
+    results = [None] * len(locators)
+    counts = [0] * len(locators)
+    depths = _parent_depths(locators)
+    pending = sorted(range(len(locators)), key=lambda i: depths[i])
+    while True:
+        for depth in sorted(set(depths[i] for i in pending)):
+            batch = []
+            for i in pending:
+                if depths[i] != depth:
+                    continue
+                item = locators[i]
+                parent_id = item.get('parent_id')
+                if item.get('parent') is not None:
+                    parent = results[item['parent']]
+                    if parent is None or not parent['elements']: # 父element还未找到
+                        continue
+                    parent_id = parent['elements'][0]['element']
+                batch.append((i, parent_id))
+            found = _map_concurrently(lambda it: find(locators[it[0]], it[1]), batch, max_concurrency)
+            for (i, _), result in zip(batch, found):
+                counts[i] += result['find_count']
+                results[i] = result
+                if result['elements']:
+                    pending.remove(i)
+        remaining = timeout - (time.time() - start_time)
+        if not pending or remaining <= 0:
+            break
+        if interval > 0:
+            time.sleep(min(interval, remaining))
+            interval = min(interval * backoff_factor, max_interval)
+    find_time = int((time.time() - start_time) * 1000)
+    for i, result in enumerate(results):
+        if result is None:
+            result = results[i] = {'elements': []}
+        result['find_count'] = counts[i]
+        result['find_time'] = find_time
+    return results
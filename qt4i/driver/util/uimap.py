@@ -14,11 +14,17 @@
 #
 '''UIAutomation和XCTest的控件映射表
 '''
+import collections
+import threading
+
 import six
 
 from tuia.qpathparser import QPathParser
 
 
+QPATH_CACHE_SIZE = 1024 # 解析结果缓存的QPath数量上限
+
+
 XCT_UIA_MAPS = {
     'Any': 'UIAElement',
     'Other': 'UIAElement',
@@ -99,12 +105,84 @@ UIA_XCT_MAPS = {
     'UIATableCell':'Cell',
 }
 
-def xctest2instruments(locator):
-    qpath_array, _ = QPathParser().parse(locator)
+class QPathCache(object):
+    '''QPath解析和转换结果的LRU缓存，key为QPath字符串，超出容量时淘汰最久未使用的结果。
+    缓存的结果被多个调用方共享，调用方不能修改
+    '''
+
+    def __init__(self, max_size=QPATH_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        '''获取缓存的结果，未缓存时调用factory(key)生成并缓存
+
+        :param key: 缓存的key
+        :type key: tuple
+        :param factory: 生成结果的函数
+        :type factory: function
+        '''
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                value = self._items.pop(key)
+                self._items[key] = value
+                return value
+            self.misses += 1
+        value = factory(key)
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        '''获取缓存的统计
+
+        :returns: dict -- {'size': <int>, 'max_size': <int>, 'hits': <int>, 'misses': <int>}
+        '''
+        with self._lock:
+            return {'size': len(self._items),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+qpath_cache = QPathCache()
+
+
+def _translate_qpath(key):
+    target, locator = key
+    class_maps = UIA_XCT_MAPS if target == 'xctest' else XCT_UIA_MAPS
+    qpath_array, qpath_lex = QPathParser().parse(locator)
     for node in qpath_array:
         if 'classname' in node:
-            if node['classname'][1] in XCT_UIA_MAPS.keys():
-                node['classname'][1] = XCT_UIA_MAPS[node['classname'][1]]
+            if node['classname'][1] in class_maps:
+                node['classname'][1] = class_maps[node['classname'][1]]
+    return qpath_array, qpath_lex
+
+
+def instruments2xctest(locator):
+    '''解析QPath并将UIAutomation的控件类型转换为XCTest的控件类型，结果会被缓存
+
+    :param locator: QPath，例如: "/classname='UIAWindow'"
+    :type locator: str
+    :returns: tuple (qpath_array, qpath_lex) -- 与QPathParser().parse的结果相同，不能修改
+    '''
+    return qpath_cache.get(('xctest', locator), _translate_qpath)
+
+
+def _build_instruments_locator(key):
+    qpath_array, _ = _translate_qpath(key)
     new_locator = ''   
     for node in qpath_array:
         new_locator += '/'
@@ -119,5 +197,17 @@ def xctest2instruments(locator):
                 node_str = "{}{}{}".format(p, node[p][0], node[p][1]) 
             properties.append(node_str)
         properties = ' & '.join(properties)
-        new_locator += properties.decode('utf-8')
+        if six.PY2:
+            properties = properties.decode('utf-8')
+        new_locator += properties
     return new_locator
+
+
+def xctest2instruments(locator):
+    '''将QPath中XCTest的控件类型转换为UIAutomation的控件类型，结果会被缓存
+
+    :param locator: QPath
+    :type locator: str
+    :returns: str
+    '''
+    return qpath_cache.get(('instruments', locator), _build_instruments_locator)
@@ -0,0 +1,229 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''在控件树快照上本地执行QPath和XPath查询，不与agent交互
+
+控件树为get_element_tree返回的格式，可以是录制下来的JSON。QPath的语义与agent查找一致：
+每一段在上一段匹配到的控件的子孙中查找，MaxDepth默认为1（只查找子控件），
+Instance从1开始；不以/开头的字符串按name在所有子孙中查找。
+XPath使用xml.etree.ElementTree支持的子集，节点名为classname，属性为name、label、value、visible和enabled。
+'''
+
+from __future__ import absolute_import, print_function
+
+import bisect
+import json
+import re
+import xml.etree.ElementTree as ET
+
+import six
+
+from qt4i.driver.util.uimap import instruments2xctest
+
+
+INDEXED_ATTRS = ('classname', 'name', 'label')
+ATTR_ALIASES = {'isenabled': 'enabled', 'isvisible': 'visible'}
+INSTANCE_BASE = 1 # QPath中Instance的起始值，与instruments驱动一致
+XPATH_ATTRS = ('name', 'label', 'value', 'visible', 'enabled')
+
+
+def _to_text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.text_type):
+        return value
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8')
+    return six.text_type(value)
+
+
+def _equals(actual, expected):
+    if actual is None:
+        return expected is None
+    if isinstance(expected, bool) or isinstance(actual, bool):
+        return actual == expected
+    return actual == expected or _to_text(actual) == _to_text(expected)
+
+
+class UITreeSnapshot(object):
+    '''控件树快照，按先序遍历展开并对classname、name和label建立索引
+    '''
+
+    def __init__(self, tree):
+        '''构造函数
+
+        :param tree: get_element_tree返回的控件树，查询期间不能修改
+        :type tree: dict
+        '''
+        self.tree = tree
+        self._nodes = [] # 先序遍历的节点
+        self._depths = []
+        self._ends = [] # 节点子树在_nodes中的结束位置（不含）
+        self._indexes = dict((attr, {}) for attr in INDEXED_ATTRS)
+        self._patterns = {}
+        self._xml_root = None
+        self._xml_positions = None
+        stack = [(tree, 0, None)]
+        while stack:
+            node, depth, pos = stack.pop()
+            if pos is not None: # 子树已遍历完
+                self._ends[pos] = len(self._nodes)
+                continue
+            pos = len(self._nodes)
+            self._nodes.append(node)
+            self._depths.append(depth)
+            self._ends.append(None)
+            for attr in INDEXED_ATTRS:
+                value = node.get(attr)
+                if value is not None:
+                    self._indexes[attr].setdefault(value, []).append(pos)
+            stack.append((node, depth, pos))
+            children = node.get('children') or []
+            stack.extend((child, depth + 1, None) for child in reversed(children))
+
+    @classmethod
+    def from_json(cls, data):
+        '''从录制的JSON构造快照
+
+        :param data: JSON文本，可以是控件树或get_element_tree_and_capture_screen的返回值
+        :type data: str
+        :rtype: UITreeSnapshot
+        '''
+        tree = json.loads(data)
+        if 'element_tree' in tree:
+            tree = tree['element_tree']
+        return cls(tree)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def query(self, locator):
+        '''查询控件，以/开头时先按QPath解析，解析失败按XPath查询；其他字符串按name查询
+
+        :param locator: QPath、XPath或name
+        :type locator: str
+        :returns: list -- 匹配的控件树节点，按先序遍历的顺序
+        '''
+        locator = str(locator) if not isinstance(locator, six.string_types) else locator
+        if not locator.startswith('/'):
+            return self.query_name(locator)
+        try:
+            qpath_array, _ = instruments2xctest(locator)
+        except Exception: # QPathSyntaxError
+            return self.query_xpath(locator)
+        return self.query_qpath(qpath_array)
+
+    def exists(self, locator):
+        '''控件是否存在
+
+        :rtype: boolean
+        '''
+        return len(self.query(locator)) > 0
+
+    def query_name(self, name):
+        '''按name在所有控件中查询
+
+        :rtype: list
+        '''
+        return [self._nodes[pos] for pos in self._indexes['name'].get(name, [])]
+
+    def query_qpath(self, locator):
+        '''按QPath查询
+
+        :param locator: QPath字符串，或instruments2xctest解析后的qpath_array
+        :type locator: str or list
+        :rtype: list
+        '''
+        if isinstance(locator, six.string_types):
+            locator, _ = instruments2xctest(locator)
+        contexts = [0]
+        for segment in locator:
+            props = []
+            max_depth = 1
+            instance = None
+            for key, (operator, value) in segment.items():
+                key = key.lower()
+                if key == 'maxdepth':
+                    max_depth = int(value)
+                elif key == 'instance':
+                    instance = int(value) - INSTANCE_BASE
+                elif key != 'uitype':
+                    props.append((ATTR_ALIASES.get(key, key), operator, value))
+            matches = set()
+            for context in contexts:
+                found = [pos for pos in self._candidates(context, max_depth, props) if self._match(pos, props)]
+                if instance is not None:
+                    found = found[instance:instance + 1] if instance >= 0 else []
+                matches.update(found)
+            contexts = sorted(matches)
+            if not contexts:
+                break
+        return [self._nodes[pos] for pos in contexts]
+
+    def _candidates(self, context, max_depth, props):
+        start, end = context + 1, self._ends[context]
+        positions = None
+        for attr, operator, value in props:
+            if operator == '=' and attr in self._indexes:
+                indexed = self._indexes[attr].get(value, [])
+                if positions is None or len(indexed) < len(positions):
+                    positions = indexed
+        if positions is None:
+            positions = six.moves.range(start, end)
+        else:
+            positions = positions[bisect.bisect_left(positions, start):bisect.bisect_left(positions, end)]
+        limit = self._depths[context] + max_depth
+        return [pos for pos in positions if self._depths[pos] <= limit]
+
+    def _match(self, pos, props):
+        node = self._nodes[pos]
+        for attr, operator, expected in props:
+            actual = node.get(attr)
+            if operator == '~=':
+                if actual is None or not self._get_pattern(expected).search(_to_text(actual)):
+                    return False
+            elif not _equals(actual, expected):
+                return False
+        return True
+
+    def _get_pattern(self, pattern):
+        regex = self._patterns.get(pattern)
+        if regex is None:
+            regex = self._patterns[pattern] = re.compile(_to_text(pattern))
+        return regex
+
+    def query_xpath(self, locator):
+        '''按XPath查询，支持xml.etree.ElementTree的XPath子集，例如: //Cell[@label='abc']、/Application/Window[1]
+
+        :param locator: XPath
+        :type locator: str
+        :rtype: list
+        '''
+        if self._xml_root is None:
+            self._build_xml()
+        if locator.startswith('/'):
+            locator = '.' + locator
+        return [self._nodes[self._xml_positions[elem]] for elem in self._xml_root.findall(locator)]
+
+    def _build_xml(self):
+        self._xml_root = ET.Element('root')
+        self._xml_positions = {}
+        parents = [self._xml_root] # 按深度保存的父节点
+        for pos, node in enumerate(self._nodes):
+            depth = self._depths[pos]
+            attrs = dict((attr, _to_text(node[attr])) for attr in XPATH_ATTRS if node.get(attr) is not None)
+            elem = ET.SubElement(parents[depth], node.get('classname') or 'Other', attrs)
+            self._xml_positions[elem] = pos
+            del parents[depth + 1:]
+            parents.append(elem)
@@ -0,0 +1,306 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''控件树的增量传输
+
+driver端按设备保存上次返回的控件树和每个节点的哈希，客户端带上本地控件树的根哈希请求时，
+只返回发生变化的子树；客户端用返回的补丁更新本地控件树。
+
+节点哈希由节点自身属性和所有子节点哈希计算，属性和结构不变时哈希不变。
+'''
+
+from __future__ import absolute_import, print_function
+
+import collections
+import hashlib
+import json
+import threading
+
+
+TREE_CACHE_SIZE = 8 # 每台设备保存的控件树数量上限（按root_id和max_depth区分）
+
+
+def convert_to_qpath(element):
+    '''将XCTestAgent返回的控件树原地转换成QPath使用的格式
+
+    :param element: XCTestAgent返回的控件树
+    :type element: dict
+    :returns: dict -- 转换后的控件树，与element为同一对象
+    '''
+    stack = [element]
+    while stack: # 不使用递归，避免层级过深时超出递归深度
+        node = stack.pop()
+        if 'type' in node:
+            node['classname'] = node.pop('type')
+        if 'isEnabled' in node:
+            node['enabled'] = (node.pop('isEnabled') == '1')
+        if 'isVisible' in node:
+            node['visible'] = (node.pop('isVisible') == '1')
+        rect = node.get('rect')
+        if rect is not None and 'origin' not in rect:
+            size = {'width': rect.pop('width'), 'height': rect.pop('height')}
+            node['rect'] = {'origin': rect, 'size': size} # 复用原字典作为origin
+        children = node.get('children')
+        if children:
+            stack.extend(children)
+        elif children is None:
+            node['children'] = []
+    return element
+
+
+class _HashNode(object):
+    '''节点哈希，tree_hash为包含子孙节点的哈希，own_hash只包含节点自身属性
+    '''
+    __slots__ = ('tree_hash', 'own_hash', 'children')
+
+    def __init__(self, tree_hash, own_hash, children):
+        self.tree_hash = tree_hash
+        self.own_hash = own_hash
+        self.children = children
+
+
+def _own_hash(node):
+    attrs = dict((k, v) for k, v in node.items() if k != 'children')
+    data = json.dumps(attrs, sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def hash_tree(tree):
+    '''计算控件树所有节点的哈希
+
+    :param tree: 控件树
+    :type tree: dict
+    :returns: _HashNode -- 与控件树结构相同的哈希树
+    '''
+    results = {}
+    stack = [(tree, False)]
+    while stack: # 后序遍历，避免层级过深时超出递归深度
+        node, visited = stack.pop()
+        children = node.get('children') or []
+        if not visited:
+            stack.append((node, True))
+            stack.extend((child, False) for child in children)
+            continue
+        child_hashes = [results.pop(id(child)) for child in children]
+        own_hash = _own_hash(node)
+        md5 = hashlib.md5(own_hash.encode('ascii'))
+        for child_hash in child_hashes:
+            md5.update(child_hash.tree_hash.encode('ascii'))
+        results[id(node)] = _HashNode(md5.hexdigest(), own_hash, child_hashes)
+    return results[id(tree)]
+
+
+def _match_children(old_children, new_children):
+    '''为每个新子节点匹配旧子节点，依次按子树哈希、节点自身哈希、相同下标匹配，每个旧子节点最多匹配一次
+
+    :param old_children: 旧子节点的哈希树列表
+    :type old_children: list
+    :param new_children: 新子节点的哈希树列表
+    :type new_children: list
+    :returns: list -- 每个新子节点匹配的旧子节点下标，未匹配为None
+    '''
+    matches = [None] * len(new_children)
+    used = set()
+    for attr in ('tree_hash', 'own_hash'):
+        candidates = {}
+        for i, old in enumerate(old_children):
+            if i not in used:
+                candidates.setdefault(getattr(old, attr), collections.deque()).append(i)
+        for i, new in enumerate(new_children):
+            if matches[i] is None and candidates.get(getattr(new, attr)):
+                matches[i] = candidates[getattr(new, attr)].popleft()
+                used.add(matches[i])
+    for i in range(min(len(old_children), len(new_children))):
+        if matches[i] is None and i not in used:
+            matches[i] = i
+            used.add(i)
+    return matches
+
+
+def diff_tree(old_hashes, new_tree, new_hashes):
+    '''比较两棵控件树，返回变化的子树
+
+    子节点按哈希与旧子节点匹配，子节点增删或重排时只返回子节点列表的变化，匹配到的旧子节点只传输下标，
+    未匹配的新子节点传输整棵子树；节点自身属性变化时只返回属性。补丁按先序排列，path为更新后控件树中的下标。
+
+    :param old_hashes: 旧控件树的哈希树
+    :type old_hashes: _HashNode
+    :param new_tree: 新控件树
+    :type new_tree: dict
+    :param new_hashes: 新控件树的哈希树
+    :type new_hashes: _HashNode
+    :returns: list -- [{'path': [子节点下标, ...], 'attrs': 节点自身属性} 或
+                       {'path': [子节点下标, ...], 'children': [旧子节点下标或新子树, ...]}, ...]
+    '''
+    patches = []
+    stack = [([], old_hashes, new_tree, new_hashes)]
+    while stack:
+        path, old, node, new = stack.pop()
+        if old.tree_hash == new.tree_hash:
+            continue
+        if old.own_hash != new.own_hash:
+            patches.append({'path': path, 'attrs': dict((k, v) for k, v in node.items() if k != 'children')})
+        children = node['children']
+        matches = _match_children(old.children, new.children)
+        if matches != list(range(len(old.children))):
+            patches.append({'path': path,
+                            'children': [children[i] if index is None else index for i, index in enumerate(matches)]})
+        for i in range(len(children) - 1, -1, -1):
+            if matches[i] is not None:
+                stack.append((path + [i], old.children[matches[i]], children[i], new.children[i]))
+    return patches
+
+
+def _copy_path(tree, path):
+    '''复制从根节点到path指向节点路径上的节点，其余子树仍与原控件树共享
+
+    :returns: tuple -- (复制后的根节点, 复制后path指向的节点)
+    '''
+    root = node = dict(tree)
+    for index in path:
+        children = node['children'] = list(node['children'])
+        node = children[index] = dict(children[index])
+    return root, node
+
+
+def apply_patches(tree, patches):
+    '''用diff_tree返回的补丁更新控件树
+
+    采用写时复制，只复制补丁路径上的节点，原控件树不会被修改，未变化的子树在新旧控件树间共享。
+
+    :param tree: 控件树
+    :type tree: dict
+    :param patches: 补丁
+    :type patches: list
+    :returns: dict -- 更新后的控件树
+    '''
+    for patch in patches:
+        path = patch['path']
+        if 'attrs' in patch:
+            tree, node = _copy_path(tree, path)
+            children = node.get('children', [])
+            node.clear()
+            node.update(patch['attrs'])
+            node['children'] = children
+        elif 'children' in patch:
+            tree, node = _copy_path(tree, path)
+            children = node.get('children', [])
+            node['children'] = [children[it] if isinstance(it, int) else it for it in patch['children']]
+        elif not path:
+            tree = patch['node']
+        else:
+            tree, parent = _copy_path(tree, path[:-1])
+            parent['children'] = list(parent['children'])
+            parent['children'][path[-1]] = patch['node']
+    return tree
+
+
+def truncate_tree(tree, max_depth):
+    '''复制控件树的前max_depth层
+
+    :param tree: 控件树
+    :type tree: dict
+    :param max_depth: 保留的层数，顶层为第1层，0表示不截断
+    :type max_depth: int
+    :returns: dict
+    '''
+    if max_depth <= 0:
+        return tree
+    result = dict(tree)
+    stack = [(result, 1)]
+    while stack:
+        node, depth = stack.pop()
+        if depth >= max_depth:
+            node['children'] = []
+            continue
+        node['children'] = [dict(child) for child in node.get('children') or []]
+        stack.extend((child, depth + 1) for child in node['children'])
+    return result
+
+
+class UITreeCache(object):
+    '''driver端保存的控件树，用于计算增量
+    '''
+
+    def __init__(self, max_size=TREE_CACHE_SIZE):
+        self._max_size = max_size
+        self._trees = collections.OrderedDict() # key为(root_id, max_depth)，value为哈希树
+        self._lock = threading.Lock()
+
+    def get_diff(self, key, tree, base_hash=None):
+        '''保存新控件树，并返回相对客户端控件树的增量
+
+        :param key: 控件树的标识
+        :type key: tuple
+        :param tree: 新控件树
+        :type tree: dict
+        :param base_hash: 客户端控件树的根哈希，为None或与保存的控件树不一致时返回完整控件树
+        :type base_hash: str
+        :returns: dict -- {'hash': 根哈希, 'tree': 完整控件树} 或 {'hash': 根哈希, 'base': base_hash, 'patches': 补丁}
+        '''
+        new_hashes = hash_tree(tree)
+        with self._lock:
+            old_hashes = self._trees.pop(key, None)
+            self._trees[key] = new_hashes
+            while len(self._trees) > self._max_size:
+                self._trees.popitem(last=False)
+        if base_hash is None or old_hashes is None or old_hashes.tree_hash != base_hash:
+            return {'hash': new_hashes.tree_hash, 'tree': tree}
+        return {'hash': new_hashes.tree_hash,
+                'base': base_hash,
+                'patches': diff_tree(old_hashes, tree, new_hashes)}
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+
+class UITreeMirror(object):
+    '''客户端保存的控件树，按driver返回的增量更新
+    '''
+
+    def __init__(self):
+        self._trees = {} # key为(root_id, max_depth)，value为(根哈希, 控件树)
+
+    def get_base_hash(self, key):
+        '''获取本地控件树的根哈希
+
+        :returns: str or None
+        '''
+        item = self._trees.get(key)
+        return item[0] if item else None
+
+    def update(self, key, result):
+        '''用get_diff的返回值更新本地控件树
+
+        之前返回的控件树不会被修改，但与之后的结果共享未变化的子树，调用者不应修改返回的控件树。
+
+        :param key: 控件树的标识
+        :type key: tuple
+        :param result: UITreeCache.get_diff的返回值
+        :type result: dict
+        :returns: dict -- 更新后的控件树
+        '''
+        if 'tree' in result:
+            tree = result['tree']
+        else:
+            base_hash, tree = self._trees.get(key, (None, None))
+            if base_hash is None or base_hash != result['base']:
+                raise ValueError('base hash mismatch: %s != %s' % (base_hash, result['base']))
+            tree = apply_patches(tree, result['patches'])
+        self._trees[key] = (result['hash'], tree)
+        return tree
+
+    def clear(self):
+        self._trees.clear()
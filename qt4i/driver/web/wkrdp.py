@@ -17,7 +17,6 @@
 
 from __future__ import absolute_import, print_function
 
-import json
 import re
 import struct
 import socket
@@ -36,6 +35,9 @@ from pymobiledevice.lockdown import LockdownClient
 from qt4i.driver.tools.logger import get_logger
 from qt4i.driver.tools.sched import PortManager
 from qt4i.driver.tools.dt import DT
+from qt4i.driver.util import get_json_codec
+
+json_codec = get_json_codec()
 
 
 class EnumSelector(object):
@@ -406,11 +408,11 @@ class WebKitRemoteDebugProtocol(object):
                 "method":"Target.sendMessageToTarget",
                 "params":{
                     "targetId":self.target_id,
-                    "message":json.dumps(data)}
+                    "message":json_codec.dumps(data)}
             }       
         self.seq += 1
         data["id"] = self.seq
-        data = json.dumps(data)
+        data = json_codec.dumps(data)
         if PY2:
             wrapped_data = Data(data)
         else:
@@ -428,7 +430,7 @@ class WebKitRemoteDebugProtocol(object):
         target_id = params['targetId']
         if self.target_id == target_id:
             self.is_target_wrapped = False
-            return json.loads(params['message'].decode('UTF-8'), encoding='UTF-8')
+            return json_codec.loads(params['message'])
         else:
             raise Exception("Target id is not valid.")
     
@@ -452,7 +454,7 @@ class WebKitRemoteDebugProtocol(object):
                 response['__argument']['WIRApplicationIdentifierKey'] != self.app_id:
                 continue
             data = response['__argument']['WIRMessageDataKey']
-            data = json.loads(data.decode('UTF-8'), encoding='UTF-8')
+            data = json_codec.loads(data)
             if ('id' in data and (data['id'] == self.seq)) or ignore_id:
                 if not (self.is_target_domain and self.is_target_wrapped == True):
                     return data
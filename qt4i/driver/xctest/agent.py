@@ -17,6 +17,8 @@
 
 from __future__ import absolute_import, print_function
 
+import contextlib
+import multiprocessing
 import os
 import time
 import select
@@ -29,6 +31,7 @@ from six import with_metaclass
 
 from qt4i.driver.tools.sched import PortManager
 from qt4i.driver.tools import logger, dt
+from qt4i.driver.tools.metrics import get_metrics_registry
 from qt4i.driver.util import Task
 from qt4i.driver.util import ThreadTask
 from qt4i.driver.util import Process
@@ -49,6 +52,12 @@ MAX_PORT_NUM = 50
 DEFAULT_IP = '127.0.0.1'
 DEFAULT_PORT = 8100
 AGENT_STORE_PATH = os.path.join(dt.QT4I_CACHE_ROOT, 'xctestagent')
+AGENT_POLL_INTERVAL = 0.5 # 启动时检查agent是否可用的间隔（秒）
+PROCESS_POLL_INTERVAL = 0.1 # 关闭时检查xcodebuild进程是否退出的间隔（秒）
+PROCESS_EXIT_TIMEOUT = 10 # 关闭时等待xcodebuild进程退出的超时（秒），超时后终止进程
+RELAY_TIMEOUT = 5 # 等待端口转发线程启动或退出的超时（秒）
+# 批量启动agent时的最大并发数，xcodebuild编译和启动较耗CPU，默认为CPU核数的一半
+AGENT_START_CONCURRENCY = settings.get('QT4I_AGENT_START_CONCURRENCY', max(1, multiprocessing.cpu_count() // 2))
 
 
 class EnumDevice():
@@ -68,19 +77,31 @@ class XCUITestAgentManager(with_metaclass(Singleton, object)):
     '''
     
     _agents = {}  # 维护Agents的实例，key为设备的udid，value为Agent实例
-    _lock = threading.Lock()
+    _lock = threading.Lock() # 保护_device_locks和_progress
+    _device_locks = {} # 每台设备的启停锁，不同设备的agent可以同时启动
+    _progress = {} # 批量启动的进度，key为设备的udid
+    
+    @classmethod
+    def _get_device_lock(cls, device_id):
+        with cls._lock:
+            if device_id not in cls._device_locks:
+                cls._device_locks[device_id] = threading.RLock()
+            return cls._device_locks[device_id]
     
     @classmethod
     def stop_all_agents(cls):
         '''关闭全部Agent
         '''
-        for device_id in cls._agents:
-            cls._agents[device_id].stop()
-            PortManager.del_port('agent', device_id)
-            logger.get_logger("xctest_%s" % device_id).info('stop_agent')
-        cls._agents = {}
+        for device_id in list(cls._agents):
+            with cls._get_device_lock(device_id):
+                agent = cls._agents.pop(device_id, None)
+                if agent is None:
+                    continue
+                agent.stop()
+                PortManager.del_port('agent', device_id)
+                logger.get_logger("xctest_%s" % device_id).info('stop_agent')
 
-    def start_agent(self, device_id, server_ip=DEFAULT_IP, server_port=DEFAULT_PORT, keep_alive=False, retry=3, timeout=60):
+    def start_agent(self, device_id, server_ip=DEFAULT_IP, server_port=DEFAULT_PORT, keep_alive=True, retry=3, timeout=60):
         '''启动Agent并返回
         
         :param device_id: 设备ID
@@ -89,7 +110,7 @@ class XCUITestAgentManager(with_metaclass(Singleton, object)):
         :type server_ip: str
         :param server_port: 设备端口号
         :type server_port: int
-        :param keep_alive: HTTP远程连接是否使用keep-alive，默认为False
+        :param keep_alive: HTTP远程连接是否使用keep-alive，默认为True
         :type keep_alive: boolean
         :param retry: 启动尝试次数，默认3次
         :type retry: int
@@ -97,36 +118,104 @@ class XCUITestAgentManager(with_metaclass(Singleton, object)):
         :type timeout: int
         :returns: XCUITestAgent
         '''
-        self.log = logger.get_logger("xctest_%s" % device_id)
-        if device_id not in self._agents:
-            try:
-                PortManager.set_port('agent', device_id, server_port)
-                server_port = PortManager.get_port('agent', device_id)
-                self.log.info('start_agent, port: %d' %server_port)
-                with self._lock:
+        if device_id in self._agents:
+            return self._agents[device_id]
+        log = logger.get_logger("xctest_%s" % device_id)
+        with self._get_device_lock(device_id):
+            if device_id not in self._agents:
+                try:
+                    PortManager.set_port('agent', device_id, server_port)
+                    server_port = PortManager.get_port('agent', device_id)
+                    log.info('start_agent, port: %d' %server_port)
                     self._agents[device_id] = XCUITestAgent(device_id, server_ip, server_port, keep_alive, retry, timeout)
-            except:
-                self.log.exception('start_agent')
-                PortManager.del_port('agent', device_id)
-                raise
-        return self._agents[device_id]
+                except:
+                    log.exception('start_agent')
+                    PortManager.del_port('agent', device_id)
+                    raise
+            return self._agents[device_id]
+    
+    def start_agents(self, device_ids, max_workers=None, callback=None, wait=True, **kwargs):
+        '''并行启动多台设备的Agent
+        
+        :param device_ids: 设备ID列表
+        :type device_ids: list
+        :param max_workers: 最大并发数，默认为AGENT_START_CONCURRENCY
+        :type max_workers: int
+        :param callback: 每台设备启动结束时的回调，参数为(device_id, progress)
+        :type callback: callable
+        :param wait: 是否等待全部启动完成，为False时立即返回，通过get_start_progress查询进度
+        :type wait: boolean
+        :param kwargs: start_agent的其他参数
+        :returns: dict -- {device_id: progress}，参考get_start_progress
+        '''
+        max_workers = max(1, max_workers or AGENT_START_CONCURRENCY)
+        semaphore = threading.Semaphore(max_workers)
+        with self._lock:
+            for device_id in device_ids:
+                self._progress[device_id] = {'state': 'pending', 'elapsed_ms': 0, 'error': None}
+
+        def start(device_id):
+            with semaphore:
+                time0 = time.time()
+                self._update_progress(device_id, state='starting')
+                try:
+                    self.start_agent(device_id, **kwargs)
+                    progress = self._update_progress(device_id, state='started', elapsed_ms=int((time.time() - time0) * 1000))
+                except Exception as e:
+                    progress = self._update_progress(device_id, state='failed', error=str(e),
+                                                     elapsed_ms=int((time.time() - time0) * 1000))
+            if callback:
+                callback(device_id, progress)
+
+        threads = []
+        for device_id in device_ids:
+            t = threading.Thread(target=start, args=(device_id,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        if wait:
+            for t in threads:
+                t.join()
+        return self.get_start_progress(device_ids)
+    
+    def _update_progress(self, device_id, **progress):
+        with self._lock:
+            self._progress[device_id].update(progress)
+            return dict(self._progress[device_id])
+    
+    def get_start_progress(self, device_ids=None):
+        '''获取批量启动Agent的进度
+        
+        :param device_ids: 设备ID列表，默认为全部
+        :type device_ids: list
+        :returns: dict -- {device_id: {'state': pending|starting|started|failed, 'elapsed_ms': 启动耗时, 'error': 失败原因}}
+        '''
+        with self._lock:
+            if device_ids is None:
+                device_ids = list(self._progress)
+            return dict((device_id, dict(self._progress[device_id])) for device_id in device_ids if device_id in self._progress)
         
     def restart_agent(self, device_id):
         '''重启Agent
         '''
-        if device_id in self._agents:
-            self._agents[device_id].stop()
-            self._agents[device_id].start()
-        else:
-            self.start_agent(device_id)
+        with self._get_device_lock(device_id):
+            if device_id in self._agents:
+                agent = self._agents[device_id]
+                time0 = time.time()
+                agent.stop()
+                agent.start()
+                agent.metrics.observe('lifecycle', device_id, 'restart', (time.time() - time0) * 1000)
+            else:
+                self.start_agent(device_id)
         
     def stop_agent(self, device_id):
         '''关闭Agent
         '''
-        if device_id in self._agents:
-            self._agents[device_id].stop()
-            PortManager.del_port('agent', device_id)
-            self._agents.pop(device_id)
+        with self._get_device_lock(device_id):
+            if device_id in self._agents:
+                self._agents[device_id].stop()
+                PortManager.del_port('agent', device_id)
+                self._agents.pop(device_id)
     
     def get_agent(self, device_id):
         '''根据udid获取Agent对象
@@ -173,7 +262,7 @@ class XCUITestAgent(object):
                             Command.QTA_ELEMENT_TREE,
                             ]
 
-    def __init__(self, device_id, server_ip=DEFAULT_IP, server_port=DEFAULT_PORT, keep_alive=False, retry=3, timeout=60):
+    def __init__(self, device_id, server_ip=DEFAULT_IP, server_port=DEFAULT_PORT, keep_alive=True, retry=3, timeout=60):
         self.log_name = "xctest_%s" % device_id
         self.log = logger.get_logger(self.log_name)
         
@@ -204,11 +293,30 @@ class XCUITestAgent(object):
         self.stub_port = 18123 + self._server_port - 8100
         self.stub_server_url = 'http://%s:%d' % (DEFAULT_IP, self.stub_port)
         self.stub_client = RemoteConnection(self.stub_server_url, keep_alive=False, logger_name=self.log_name)
-        self.stub_client.set_timeout(0.01)
         self.error_handler = ErrorHandler()
+        self.metrics = get_metrics_registry()
+        self.unsupported_commands = set() # 当前版本agent不支持的指令，启动agent时重置
         self._command_executor = RemoteConnection(self._server_url, keep_alive=keep_alive, logger_name=self.log_name)
         self._is_relay_quit = threading.Event()
+        self._is_relay_ready = threading.Event()
         self.start(retry, timeout)
+
+    @contextlib.contextmanager
+    def _measure(self, phase):
+        '''统计启停阶段的耗时，记录到metrics的lifecycle层
+        
+        :param phase: 阶段名称
+        :type phase: str
+        '''
+        time0 = time.time()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            exec_time = (time.time() - time0) * 1000
+            self.metrics.observe('lifecycle', self.udid, phase, exec_time, error)
+            self.log.info('[ %s ] consumed [ %dms ]' % (phase, exec_time))
     
     def _tcp_relay(self):
         '''将设备8100端口映射到本地8100端口，虚拟机不需要映射
@@ -217,11 +325,12 @@ class XCUITestAgent(object):
             return
         if not self._relay_thread and self._server_ip == DEFAULT_IP:
             self._relay_error = None
+            self._is_relay_ready.clear()
             self._relay_thread = threading.Thread(target=self._forward_ports)
             self._relay_thread.daemon = True
             self.log.info("Start TCPRelay Thread")
             self._relay_thread.start()
-            time.sleep(1)
+            self._is_relay_ready.wait(RELAY_TIMEOUT) # 端口监听完成或出错
             if self._relay_error:
                 raise Exception(self._relay_error)
             if not self._relay_thread.is_alive():
@@ -250,6 +359,7 @@ class XCUITestAgent(object):
                 
             self._quit_relay_thread = False # 退出端口转发线程的标识位
             self._is_relay_quit.clear()
+            self._is_relay_ready.set()
             while not self._quit_relay_thread:
                 try:
                     rl, wl, xl = select.select(self._tcp_servers, [], []) #@UnusedVariable
@@ -267,6 +377,7 @@ class XCUITestAgent(object):
         except Exception:
             self._relay_error = traceback.format_exc()
             self.log.exception('forward ports')
+            self._is_relay_ready.set()
 
     def _build_agent_for_simulator(self, xcode_version):
         agent_dir = os.path.join(AGENT_STORE_PATH, xcode_version)
@@ -341,25 +452,28 @@ class XCUITestAgent(object):
         :param timeout: 单次启动超时 (秒)
         :type timeout: int
         '''
-        if self.type == EnumDevice.Simulator:
-            dt.DT().reboot(self.udid)
-            xcode_version = dt.DT.get_xcode_version()
-            if dt.DT.compare_xcode_version("9.0") >= 0:
-                self._agent_cmd = self._get_xcodebuild_agent_cmd_for_simulator(xcode_version)
-            else:
-                self._agent_cmd = self._get_fbsimctl_agent_cmd_for_simulator(xcode_version)
-        else:
-            self._agent_cmd = ' '.join(['xcodebuild',
-                '-project %s' % self.XCTestAgentPath,
-                '-scheme %s' % 'XCTestAgent',
-                '-destination "platform=%s,id=%s"' % (self.type, self.udid),
-                'test'])
-        # 清理遗留的xcodebuild进程
-        Process().kill_process_by_name(self._agent_cmd.replace('"', ''))
-        Process().kill_process_by_port(self._server_port)
         start_time = time.time()
+        with self._measure('start.prepare'):
+            if self.type == EnumDevice.Simulator:
+                dt.DT().reboot(self.udid)
+                xcode_version = dt.DT.get_xcode_version()
+                if dt.DT.compare_xcode_version("9.0") >= 0:
+                    self._agent_cmd = self._get_xcodebuild_agent_cmd_for_simulator(xcode_version)
+                else:
+                    self._agent_cmd = self._get_fbsimctl_agent_cmd_for_simulator(xcode_version)
+            else:
+                self._agent_cmd = ' '.join(['xcodebuild',
+                    '-project %s' % self.XCTestAgentPath,
+                    '-scheme %s' % 'XCTestAgent',
+                    '-destination "platform=%s,id=%s"' % (self.type, self.udid),
+                    'test'])
+            self.unsupported_commands.clear()
+            # 清理遗留的xcodebuild进程
+            Process().kill_process_by_name(self._agent_cmd.replace('"', ''))
+            Process().kill_process_by_port(self._server_port)
         # 启动端口转发线程
-        self._tcp_relay()
+        with self._measure('start.relay'):
+            self._tcp_relay()
         for _ in range(retry):
             self.log.info("Start XCTestAgent: %s" %self._agent_cmd)
             self.log.info("XCTestAgent Version: %s" %self.version)
@@ -367,13 +481,11 @@ class XCUITestAgent(object):
                                        stdout_line_callback=self._stdout_line_callback, 
                                        stderr_line_callback=self._stderr_line_callback)
             
-            time0 = time.time()
-            while time.time() - time0 < timeout:
-                if self.is_working():
-                    exec_time = (time.time() - start_time) * 1000
-                    self.log.info('[ %s ] consumed [ %dms ]' %('Start XCTestAgent', exec_time))
-                    return
-                time.sleep(3)
+            if self._wait_for_working(timeout):
+                exec_time = (time.time() - start_time) * 1000
+                self.metrics.observe('lifecycle', self.udid, 'start', exec_time)
+                self.log.info('[ %s ] consumed [ %dms ]' %('Start XCTestAgent', exec_time))
+                return
             
             _dt = dt.DT()
             self.log.info("Uninstall com.apple.test.XCTestAgent-Runner")
@@ -381,33 +493,81 @@ class XCUITestAgent(object):
             if not result:
                 self.log.error(_dt.uninstall_error)
         
+        self.metrics.observe('lifecycle', self.udid, 'start', (time.time() - start_time) * 1000, True)
         self.stop()
         error_log_name = 'xctest_%s' % self.udid
         agent_error_log = logger.get_agent_error_log(error_log_name, start_time)
         raise AgentStartError("Failed to start XCTestAgent.\nDetails:%s" % agent_error_log)
     
+    def _wait_for_working(self, timeout):
+        '''轮询HEALTH接口直到agent可用，xcodebuild进程提前退出时不再等待
+        
+        :param timeout: 超时 (秒)
+        :type timeout: int
+        :returns: boolean
+        '''
+        time0 = time.time()
+        deadline = time0 + timeout
+        working = False
+        while True:
+            if self.is_working():
+                working = True
+                break
+            if self._process.poll() is not None:
+                self.log.error('XCTestAgent process exited with code %s' % self._process.poll())
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(AGENT_POLL_INTERVAL, remaining))
+        exec_time = (time.time() - time0) * 1000
+        self.metrics.observe('lifecycle', self.udid, 'start.launch', exec_time, not working)
+        self.log.info('[ %s ] consumed [ %dms ]' % ('start.launch', exec_time))
+        return working
+
+    def _wait_for_process_exit(self, timeout):
+        '''等待PC上xcodebuild进程退出，超时后终止进程
+        
+        :param timeout: 超时 (秒)
+        :type timeout: int
+        '''
+        if self._process is None or self._process.process is None:
+            return
+        deadline = time.time() + timeout
+        while self._process.poll() is None and time.time() < deadline:
+            time.sleep(PROCESS_POLL_INTERVAL)
+        if self._process.poll() is None:
+            self.log.warning('XCTestAgent process did not exit in %ss, terminate it' % timeout)
+            self._process.stop()
+
     def stop(self, is_timeout=False):
         '''关闭Agent
         '''
+        time0 = time.time()
         if not is_timeout:
             # 停止手机上Agent进程
-            try:
-                self._command_executor.set_timeout(2)
-                self.execute(Command.QTA_STOP_AGENT)
-            except:
-                pass
+            with self._measure('stop.agent'):
+                try:
+                    self.execute(Command.QTA_STOP_AGENT, request_timeout=2)
+                except:
+                    pass
+        self._command_executor.close() # 关闭空闲连接，下面的请求使用新连接才能唤醒端口转发线程
         # 停止PC上端口转发线程
         if self._relay_thread:
-            self._quit_relay_thread = True
-            try:
-                self._execute(Command.HEALTH) # 发送请求，退出select阻塞
-            except:
-                pass
-            self._is_relay_quit.wait() # 等待端口转发线程退出
-            self._relay_thread = None
-        self._command_executor.reset_timeout()
+            with self._measure('stop.relay'):
+                self._quit_relay_thread = True
+                try:
+                    self._execute(Command.HEALTH, timeout=1) # 发送请求，退出select阻塞
+                except:
+                    pass
+                if not self._is_relay_quit.wait(RELAY_TIMEOUT): # 等待端口转发线程退出
+                    self.log.error('TCPRelay thread did not quit in %ss' % RELAY_TIMEOUT)
+                self._relay_thread = None
+        self._command_executor.close()
         # 等待PC上xcodebuild进程停止
-        time.sleep(10)
+        with self._measure('stop.process'):
+            self._wait_for_process_exit(PROCESS_EXIT_TIMEOUT)
+        self.metrics.observe('lifecycle', self.udid, 'stop', (time.time() - time0) * 1000)
         self._process = None
         self.session_id = None
         self.log.info("Stop XCTestAgent successfully")
@@ -418,9 +578,7 @@ class XCUITestAgent(object):
         :returns: boolean
         '''
         try:
-            self._command_executor.set_timeout(1)
-            response = self._execute(Command.HEALTH)
-            self._command_executor.reset_timeout()
+            response = self._execute(Command.HEALTH, timeout=1)
             return response['value'] == 'XCTestAgent is ready'
         except XCTestAgentDeadException:
             self.log.exception('XCTestAgentDead')
@@ -481,11 +639,26 @@ class XCUITestAgent(object):
         self.capabilities = response['value']['capabilities']
         return response
     
-    def _execute(self, command, params={}):
+    def _execute(self, command, params={}, timeout=None):
         '''执行指令
+
+        :param timeout: 本次请求的超时时间（秒），为None时使用连接的默认超时
+        :type timeout: float
+        '''
+        time0 = time.time()
+        error = True
+        try:
+            response = self._check_response(command, self._command_executor.execute(command, params, timeout))
+            error = False
+            return response
+        finally:
+            bytes_in, bytes_out = self._command_executor.get_last_transfer()
+            self.metrics.observe('agent', self.udid, command, (time.time() - time0) * 1000,
+                                 error, bytes_in, bytes_out)
+
+    def _check_response(self, command, response):
+        '''检查指令的执行结果
         '''
-        response = self._command_executor.execute(command, params)
-        
         if response:
             if not command in self.LOG_FILTERED_METHODS:
                 self.log.debug(response)
@@ -501,11 +674,11 @@ class XCUITestAgent(object):
     
     def capture_screen(self):
         try:
-            return self.stub_client.execute(Command.SCREENSHOT, {})
+            return self.stub_client.execute(Command.SCREENSHOT, {}, timeout=0.01)
         except XCTestAgentTimeoutException:
             return None    
     
-    def execute(self, command, params={}, timeout=CommandTimeout):
+    def execute(self, command, params={}, timeout=CommandTimeout, request_timeout=None):
         '''执行指令
 
         :param command: 指令名称
@@ -514,6 +687,8 @@ class XCUITestAgent(object):
         :type params: dict 例如 {bundleId: com.tencent.test}
         :param timeout: 指令执行超时等待时常
         :type timeout: int
+        :param request_timeout: 本次HTTP请求的超时时间（秒），为None时使用连接的默认超时
+        :type request_timeout: float
         :returns: 返回结果，dict
         '''
         time0 = time.time()
@@ -537,17 +712,17 @@ class XCUITestAgent(object):
             
         elif command == Command.QUIT:
             if 'sessionId' in params:
-                response = self._execute(command, params)
+                response = self._execute(command, params, request_timeout)
             else:
                 response = {}
             self.session_id = None
             
         elif command == Command.STATUS:
-            response = self._execute(command, params)
+            response = self._execute(command, params, request_timeout)
             if self.session_id is None:
                 self.session_id = response['sessionId']
         else:
-            response = self._execute(command, params)
+            response = self._execute(command, params, request_timeout)
             
         exec_time = int((time.time() - time0) * 1000)
         self.log.info('[ %s ] consumed [ %dms ]' %(command, exec_time))
@@ -37,52 +37,41 @@ from qt4i.driver.tools.dt import DT
 from qt4i.driver.tools import mobiledevice
 from qt4i.driver.tools.logger import get_logger_path_by_name, clean_expired_log, str_to_time
 from qt4i.driver.tools import logger
+from qt4i.driver.tools.recorder import export_recording
+from qt4i.driver.tools.recorder import get_recording_dir
 from qt4i.driver.xctest.webdriverclient.exceptions import NoSuchElementException
 from qt4i.driver.xctest.webdriverclient.exceptions import XCTestAgentTimeoutException
-from qt4i.driver.util.uimap import UIA_XCT_MAPS
+from qt4i.driver.xctest.webdriverclient.exceptions import UnknownCommandException
+from qt4i.driver.xctest.webdriverclient.remote_connection import RemoteConnection
+from qt4i.driver.xctest.webdriverclient.remote_connection import AGENT_POOL_SIZE
+from qt4i.driver.util import find_elements_in_rounds
+from qt4i.driver.util.uimap import instruments2xctest
+from qt4i.driver.util.uitree import UITreeCache
+from qt4i.driver.util.uitree import convert_to_qpath
+from qt4i.driver.util.uitree import truncate_tree
 from qt4i.driver.xctest.webdriverclient.errorhandler import ErrorCode
 from qt4i.driver.util.modalmap import DeviceProperty
 from testbase.conf import settings
-from tuia.qpathparser import QPathParser
 from pymobiledevice import lockdown
 
 
 DEFAULT_IP = '127.0.0.1'
 DEFAULT_PORT = 8100
 TMP_LOAD_FILE = '/tmp/tmpFile'
+FIND_BACKOFF_FACTOR = 2 # agent不支持等待查找时，客户端轮询间隔的增长倍数
+FIND_MAX_INTERVAL = 0.5 # 客户端轮询的最大间隔（秒）
+RECORDING_DURATION = 30 # 未指定开始时间时获取的录屏时长（秒）
 
 TMP_DIR_PATH = settings.get('QT4I_TMP_DIR_PATH', '/tmp')
 
-def convert_to_qpath(element):
-    '''转换成qpath
-    '''
-    if 'type' in element:
-        element['classname'] = element['type']
-        element.pop('type')
-    if 'isEnabled' in element:
-        element['enabled'] = (element['isEnabled'] == '1')
-        element.pop('isEnabled')
-    if 'isVisible' in element:
-        element['visible'] = (element['isVisible'] == '1')
-        element.pop('isVisible')
-    if 'rect' in element:
-        element['rect']= {
-            'origin': {'x': element['rect']['x'], 'y': element['rect']['y']},
-            'size'  : {'width': element['rect']['width'], 'height': element['rect']['height']},
-        }
-    children = []
-    for child in element.get('children', []):
-        children.append(convert_to_qpath(child))
-    element['children'] = children
-    return element
-
 class lazy(object): 
     def __init__(self, func): 
         self.func = func 
     
     def __get__(self, instance, cls): 
         val = self.func(instance) 
-        setattr(instance, self.func.__name__, val) 
+        if val is not None: # agent未启动时不缓存，启动后重新获取
+            setattr(instance, self.func.__name__, val) 
         return val
 
 class Device(RPCEndpoint):
@@ -94,6 +83,7 @@ class Device(RPCEndpoint):
     def __init__(self, rpc_server, device_id):
         self.rpc_server = rpc_server
         self.udid = device_id
+        self.tree_cache = UITreeCache()
         RPCEndpoint.__init__(self)
     
     @rpc_method   
@@ -115,6 +105,7 @@ class Device(RPCEndpoint):
         该接口请不要再使用，准备遗弃，请使用host中对应接口
         '''
         XCUITestAgentManager.stop_all_agents()
+        self.rpc_server.invalidate_endpoints()
     
     @lazy
     def agent(self):
@@ -123,23 +114,26 @@ class Device(RPCEndpoint):
         return self.agent_manager.get_agent(self.udid)
 
     @rpc_method
-    def start_agent(self, agent_ip=DEFAULT_IP, agent_port=DEFAULT_PORT, keep_alive=False, retry=3, timeout=55):
+    def start_agent(self, agent_ip=DEFAULT_IP, agent_port=DEFAULT_PORT, keep_alive=True, retry=3, timeout=55):
         '''启动Agent，只支持设备主机使用，本地运行不使用该接口
         '''
         self._agent_port = agent_port
         self.agent_manager.start_agent(self.udid, agent_ip, agent_port, keep_alive, retry, timeout)
+        self.rpc_server.invalidate_endpoints(self.udid)
 
     @rpc_method
     def restart_agent(self):
         '''重启Agent，只支持设备主机使用，本地运行不使用该接口
         '''
         self.agent_manager.restart_agent(self.udid)
+        self.rpc_server.invalidate_endpoints(self.udid)
 
     @rpc_method
     def stop_agent(self):
         '''关闭Agent
         '''
         self.agent_manager.stop_agent(self.udid)
+        self.rpc_server.invalidate_endpoints(self.udid)
           
     @rpc_method
     def install(self, file_path):
@@ -355,14 +349,83 @@ class Device(RPCEndpoint):
         return base64_img
 
     @rpc_method
-    def get_element_tree(self):
-        '''从顶层开始获取UI树字典
+    def capture_screen_handle(self):
+        '''截屏，PNG数据通过二进制通道下载，参考RPCClientProxy.fetch_blob
+
+        :returns: str -- token
+        '''
+        return self.rpc_server.blobs.add_data(base64.b64decode(self.capture_screen()))
+
+    def _export_recording(self, start_time, end_time):
+        if end_time is None:
+            end_time = time.time()
+        if start_time is None:
+            start_time = end_time - RECORDING_DURATION
+        filepath = os.path.join(TMP_DIR_PATH, '%s.mjpeg' % uuid.uuid1())
+        with open(filepath, 'wb') as fd:
+            count = export_recording(get_recording_dir(self.udid), start_time, end_time, fd)
+        if count == 0:
+            os.remove(filepath)
+            raise Exception('no recording between %s and %s, is screencapture started with --record?' % (start_time, end_time))
+        return filepath
+
+    @rpc_method
+    def get_recording(self, start_time=None, end_time=None):
+        '''获取截屏服务录制的屏幕视频
+        
+        :param start_time: 开始时间戳（driver server所在主机的时间），默认为结束时间前RECORDING_DURATION秒
+        :type start_time: float
+        :param end_time: 结束时间戳，默认为当前时间
+        :type end_time: float
+        :returns: str -- base64编码后的MJPEG数据
+        '''
+        filepath = self._export_recording(start_time, end_time)
+        try:
+            with open(filepath, 'rb') as fd:
+                return base64.b64encode(fd.read())
+        finally:
+            os.remove(filepath)
+
+    @rpc_method
+    def get_recording_handle(self, start_time=None, end_time=None):
+        '''获取截屏服务录制的屏幕视频，MJPEG数据通过二进制通道下载，参数参考get_recording
+        
+        :returns: str -- token
+        '''
+        return self.rpc_server.blobs.add_file(self._export_recording(start_time, end_time), delete=True)
+
+    @rpc_method
+    def get_element_tree(self, max_depth=0, root_id=None):
+        '''从顶层或指定控件开始获取UI树字典
         
+        :param max_depth: 树的深度, 默认为0，获取所有子孙控件树
+        :type max_depth: int
+        :param root_id: 作为树根的element的id，默认为None，从顶层开始
+        :type root_id: int
         :returns: dict
         '''
-        result = self.agent.execute(Command.GET_ELEMENT_TREE)['value']['tree']
+        if root_id is None or root_id == 1:
+            result = convert_to_qpath(self.agent.execute(Command.GET_ELEMENT_TREE)['value']['tree'])
+            return truncate_tree(result, max_depth)
+        result = self.agent.execute(Command.QTA_ELEMENT_TREE, 
+            {'id': root_id, 'max_depth': max_depth})['value']['tree']
         return convert_to_qpath(result)
     
+    @rpc_method
+    def get_element_tree_diff(self, base_hash=None, max_depth=0, root_id=None):
+        '''获取UI树相对上次结果的增量，参考qt4i.driver.util.uitree
+        
+        :param base_hash: 客户端本地UI树的根哈希，为None时返回完整UI树
+        :type base_hash: str
+        :param max_depth: 树的深度, 默认为0，获取所有子孙控件树
+        :type max_depth: int
+        :param root_id: 作为树根的element的id，默认为None，从顶层开始
+        :type root_id: int
+        :returns: dict -- {'hash': 根哈希, 'tree': 完整UI树} 或 {'hash': 根哈希, 'base': base_hash, 'patches': 变化的子树}
+        '''
+        tree = self.get_element_tree(max_depth, root_id)
+        return self.tree_cache.get_diff((root_id, max_depth), tree, base_hash)
+    
     @rpc_method
     def get_element_tree_and_capture_screen(self, filepath=None):
         '''获取UI树并截屏(该接口仅限UISpy使用)
@@ -1029,35 +1092,20 @@ class Element(RPCEndpoint):
         :returns: dict : {'elements': [{'element':id, 'attributes':<encode str>}], 'path': <encode str>, 'valid_path_part': <encode str>, 'invalid_path_part': <encode str>, 'find_count': <int>, "find_time": int}
         '''
         if strategy == "qpath":
-            #解析QPath
-            qpath_array, qpath_lex = QPathParser().parse(locator)
-            for node in qpath_array:
-                if 'classname' in node:
-                    if node['classname'][1] in UIA_XCT_MAPS.keys():
-                        node['classname'][1] = UIA_XCT_MAPS[node['classname'][1]]
+            #解析QPath，解析结果有缓存
+            qpath_array, qpath_lex = instruments2xctest(locator)
             locator_value = qpath_array
             valid_path = None
             invalid_path = None
         else:
             locator_value = locator
         start_time = time.time()
-        elements = []
-        count = 0
         parent_id = parent_id if parent_id else 1
-        while True:
-            before_step_time = time.time()
-            count += 1
-            response = self.agent.execute(Command.QTA_FIND_ELEMENTS,
-                                {'using': strategy, 'value': locator_value, 'id':parent_id})
-            elements = response['value']
-            after_step_time = time.time()
-            step_time = after_step_time - before_step_time
-            if elements or after_step_time - start_time >= timeout:
-                break
-            if interval > 0:
-                sleep_time = interval - step_time
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
+        params = {'using': strategy, 'value': locator_value, 'id':parent_id}
+        response, count = self._wait_find_elements(params, timeout, interval)
+        if response is None:
+            response, count = self._poll_find_elements(params, timeout, interval)
+        elements = response['value']
         if elements:
             elements = [{'element': int(e['ELEMENT'])} for e in elements]
             if strategy == "qpath":
@@ -1084,6 +1132,62 @@ class Element(RPCEndpoint):
             result['invalid_path_part'] = invalid_path
         return result
 
+    @rpc_method
+    def find_elements_many(self, locators, timeout=3, interval=0.005):
+        '''在一次RPC请求中查找多个element，按轮次查找所有未找到的locator，直到全部找到或超时。
+        每个locator仍是一条agent指令，互不依赖的locator通过agent连接池的AGENT_POOL_SIZE个连接并发发送。
+        可以通过parent引用同一批中的其他locator作为父element，父element找到后才查找。
+        未全部找到时轮次间隔按指数增长，不超过FIND_MAX_INTERVAL。
+        
+        :param locators: [{'locator': <str>, 'strategy': <str>, 'parent_id': <int>, 'parent': <locators中的下标>}, ...]
+        :type locators: list
+        :param timeout: 查找全部element的超时值（单位: 秒），为0时只查找一轮
+        :type timeout: float
+        :param interval: 第一轮与第二轮查找的间隔（单位: 秒）
+        :type interval: float
+        :returns: list -- 与locators一一对应，每项与find_elements的返回值相同
+        '''
+        def find(item, parent_id):
+            return self.find_elements(item['locator'], 0, interval, item.get('strategy', By.QPATH), parent_id)
+        return find_elements_in_rounds(find, locators, timeout, interval, FIND_BACKOFF_FACTOR, FIND_MAX_INTERVAL,
+                                       AGENT_POOL_SIZE)
+
+    def _wait_find_elements(self, params, timeout, interval):
+        '''由agent在设备端轮询查找，一次请求等待到找到控件或超时。agent的响应与QTA_FIND_ELEMENTS相同，
+        info中的find_count为设备端的查找次数
+
+        :returns: tuple (response, find_count) -- agent不支持该指令时response为None
+        '''
+        if Command.QTA_WAIT_FIND_ELEMENTS in self.agent.unsupported_commands:
+            return None, 0
+        params = dict(params, timeout=timeout, interval=interval)
+        request_timeout = RemoteConnection.get_timeout()
+        if request_timeout is not None:
+            request_timeout += timeout
+        try:
+            response = self.agent.execute(Command.QTA_WAIT_FIND_ELEMENTS, params, request_timeout=request_timeout)
+        except UnknownCommandException:
+            self.agent.unsupported_commands.add(Command.QTA_WAIT_FIND_ELEMENTS)
+            return None, 0
+        return response, response.get('info', {}).get('find_count', 1)
+
+    def _poll_find_elements(self, params, timeout, interval):
+        '''客户端轮询查找，未找到时查找间隔按指数增长，减少对设备的请求次数
+
+        :returns: tuple (response, find_count)
+        '''
+        deadline = time.time() + timeout
+        count = 0
+        while True:
+            count += 1
+            response = self.agent.execute(Command.QTA_FIND_ELEMENTS, params)
+            remaining = deadline - time.time()
+            if response['value'] or remaining <= 0:
+                return response, count
+            if interval > 0:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * FIND_BACKOFF_FACTOR, FIND_MAX_INTERVAL)
+
     @rpc_method
     def find_element_with_predicate(self, element_id, predicate):
         '''通过predicate文本获取第一个匹配的子element
@@ -151,6 +151,7 @@ class Command(object):
     QTA_DEVICE_ROTATE = "qtaDeviceRotate"
     QTA_DEVICE_SENDKEYS = "qtaDeviceSendKeys"
     QTA_FIND_ELEMENTS =  "qtaFindElements"
+    QTA_WAIT_FIND_ELEMENTS = "qtaWaitFindElements"
     QTA_ELEMENT_CLICK = "qtaElementClick"
     QTA_ELEMENT_DOUBLE_CLICK = "qtaElementDoubleClick"
     QTA_ELEMENT_LONG_CLICK = "qtaElementLongClick"
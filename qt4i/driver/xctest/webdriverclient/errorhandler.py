@@ -35,6 +35,7 @@ from qt4i.driver.xctest.webdriverclient.exceptions import UnexpectedAlertPresent
 from qt4i.driver.xctest.webdriverclient.exceptions import NoAlertPresentException
 from qt4i.driver.xctest.webdriverclient.exceptions import ErrorInResponseException
 from qt4i.driver.xctest.webdriverclient.exceptions import TimeoutException
+from qt4i.driver.xctest.webdriverclient.exceptions import UnknownCommandException
 from qt4i.driver.xctest.webdriverclient.exceptions import WebDriverException
 from qt4i.driver.xctest.webdriverclient.exceptions import MoveTargetOutOfBoundsException
 from qt4i.driver.xctest.webdriverclient.exceptions import RotationNotAllowedException
@@ -174,6 +175,9 @@ class ErrorHandler(object):
             exception_class = XCTestAgentDeadException
         elif status in ErrorCode.SENDKEYS_FAILED:
             exception_class = SendKeysFailedException
+        elif status in ErrorCode.UNKNOWN_COMMAND or status == 404:
+            # 旧版本agent不支持的指令，HTTP 404由RemoteConnection转换为status
+            exception_class = UnknownCommandException
         else:
             exception_class = WebDriverException
         
@@ -186,8 +190,8 @@ class ErrorHandler(object):
                 except:
                     pass
                 else:
-                    status = value['error']
-                    message = value['message']
+                    if isinstance(value, dict):
+                        message = value.get('message', message)
                     raise exception_class(response, message)
 
         value = response['value']
@@ -265,6 +265,12 @@ class SendKeysFailedException(ErrorInResponseException):
     """
     pass
 
+class UnknownCommandException(WebDriverException):
+    """
+    Thrown when the command is not supported by XCTestAgent.
+    """
+    pass
+
 class XCTestAgentTimeoutException(WebDriverException):
     """
     Thrown when XCTestAgent response is timed out. 
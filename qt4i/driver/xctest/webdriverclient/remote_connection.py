@@ -18,9 +18,10 @@
 from __future__ import absolute_import, print_function
 
 import socket
+import select
 import string
+import threading
 import base64
-import json
 
 try:
     import http.client as httplib
@@ -32,11 +33,16 @@ except ImportError: # above is available in py3+, below is py2.7
     import urlparse as parse
 
 from testbase.conf import settings
+from qt4i.driver.rpc import ConnectionPool
 from qt4i.driver.tools import logger as logging
+from qt4i.driver.util import get_json_codec
 from qt4i.driver.xctest.webdriverclient.command import Command
 from qt4i.driver.xctest.webdriverclient.errorhandler import ErrorCode
 from qt4i.driver.xctest.webdriverclient.exceptions import XCTestAgentTimeoutException
 
+json_codec = get_json_codec()
+AGENT_POOL_SIZE = 2 # 每个agent保留的空闲连接数，同一设备的指令是串行执行的
+
 
 class Request(url_request.Request):
     """Extends the url_request.Request to support all HTTP request types.
@@ -154,15 +160,18 @@ class RemoteConnection(object):
         cls._timeout = cls._default_timeout
     
     def set_timeout(self, timeout):
+        """Override the default timeout of this connection, prefer the timeout argument of execute
+        """
         self._timeout = timeout
         
     def reset_timeout(self):
         self._timeout = self._default_timeout
 
-    def __init__(self, remote_server_addr, keep_alive=False, resolve_ip=True, logger_name='RemoteConnection'):
+    def __init__(self, remote_server_addr, keep_alive=True, resolve_ip=True, logger_name='RemoteConnection'):
         # Attempt to resolve the hostname and get an IP address.
         self.logger = logging.get_logger(logger_name)
         self.keep_alive = keep_alive
+        self._transfer = threading.local() # 当前线程最近一次请求的收发字节数
         parsed_url = parse.urlparse(remote_server_addr)
         addr = ""
         if parsed_url.hostname and resolve_ip:
@@ -184,8 +193,9 @@ class RemoteConnection(object):
 
         self._url = remote_server_addr
         if keep_alive:
-            self._conn = httplib.HTTPConnection(
-                str(addr), str(parsed_url.port), timeout=self._timeout)
+            # 持久连接，复用前检查连接是否已被对端关闭
+            self._pool = ConnectionPool('http', '%s:%s' % (addr or parsed_url.hostname, parsed_url.port),
+                                        max_size=AGENT_POOL_SIZE)
 
         self._commands = {
             Command.HEALTH: ('GET', '/health'),
@@ -351,6 +361,8 @@ class RemoteConnection(object):
                 ('POST', '/session/$sessionId/context'),
             Command.QTA_FIND_ELEMENTS:
                 ('POST', '/session/$sessionId/qta/element/$id/elements'),
+            Command.QTA_WAIT_FIND_ELEMENTS:
+                ('POST', '/session/$sessionId/qta/element/$id/elements/wait'),
             Command.QTA_DEVICE_CLICK:
                 ('POST', '/session/$sessionId/qta/click'),
             Command.QTA_ELEMENT_CLICK:
@@ -423,7 +435,7 @@ class RemoteConnection(object):
                 ('POST', '/session/$sessionId/wda/element/forceTouch/$id'),
         }
 
-    def execute(self, command, params):
+    def execute(self, command, params, timeout=None):
         """Send a command to the remote server.
         Any path subtitutions required for the URL mapped to the command should be
         included in the command parameters.
@@ -432,16 +444,93 @@ class RemoteConnection(object):
         :type command: str
         :param params: A dictionary of named parameters to send with the command as its JSON payload.
         :type params: dict
+        :param timeout: Timeout of this command in seconds, None for the timeout of this connection.
+        :type timeout: float
         :returns: dict 
         """
         command_info = self._commands[command]
         assert command_info is not None, 'Unrecognised command %s' % command
-        data = json.dumps(params)
+        data = json_codec.dumps(params)
+        self._transfer.request_size = len(data)
+        self._transfer.response_size = 0
         path = string.Template(command_info[1]).substitute(params)
         url = '%s%s' % (self._url, path)
-        return self._request(command_info[0], url, body=data)
+        return self._request(command_info[0], url, body=data, timeout=timeout)
+
+    def get_last_transfer(self):
+        """Get the request and response sizes of the last command executed in current thread.
+
+        :returns: tuple -- (request bytes, response bytes)
+        """
+        return (getattr(self._transfer, 'request_size', 0), getattr(self._transfer, 'response_size', 0))
+
+    def close(self):
+        """Close the idle persistent connections.
+        """
+        if self.keep_alive:
+            self._pool.clear()
+
+    def _get_timeout(self, timeout):
+        if timeout is None:
+            timeout = self._timeout
+        if timeout == socket._GLOBAL_DEFAULT_TIMEOUT:
+            return socket.getdefaulttimeout()
+        return timeout
+
+    def _acquire_connection(self, timeout):
+        """Get a persistent connection, idle connections closed by the agent or the relay are dropped.
 
-    def _request(self, method, url, body=None):
+        :returns: tuple (connection, reused)
+        """
+        while True:
+            conn, reused = self._pool.acquire()
+            if reused and conn.sock is not None:
+                # 空闲的keep-alive连接可读说明对端已关闭或有残留数据，不能复用
+                try:
+                    readable = select.select([conn.sock], [], [], 0)[0]
+                except (ValueError, socket.error):
+                    readable = True
+                if readable:
+                    self._pool.discard(conn)
+                    continue
+            break
+        self._prepare_connection(conn, timeout)
+        return conn, reused
+
+    def _prepare_connection(self, conn, timeout):
+        """Set the timeout of this request, connect and disable Nagle's algorithm for new connections
+        """
+        conn.timeout = timeout
+        if conn.sock is None:
+            conn.connect()
+            # 请求头和包体分两次发送，避免与对端的延迟确认叠加产生几十毫秒的等待
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            conn.sock.settimeout(timeout)
+
+    def _keep_alive_request(self, method, path, body, headers, timeout):
+        """Send the request on a persistent connection, reconnect once if a reused connection is broken.
+
+        :returns: tuple (connection, response)
+        """
+        conn, reused = self._acquire_connection(timeout)
+        while True:
+            try:
+                conn.request(method, path, body, headers)
+                return conn, conn.getresponse()
+            except socket.timeout:
+                self._pool.discard(conn)
+                raise
+            except (httplib.HTTPException, socket.error):
+                self._pool.discard(conn)
+                if not reused:
+                    raise
+            # 复用的连接可能已被agent或端口转发关闭，用新连接重试一次
+            self.logger.debug('Reconnect to %s' % self._url)
+            conn, reused = self._pool.new_connection(), False
+            self._prepare_connection(conn, timeout)
+
+    def _request(self, method, url, body=None, timeout=None):
         """Send an HTTP request to the remote server.
 
         :param method: A string for the HTTP method to send the request with.
@@ -450,9 +539,12 @@ class RemoteConnection(object):
         :type url: str
         :param body: A string for request body. Ignored unless method is POST or PUT.
         :type body: str
+        :param timeout: Timeout of this request in seconds, None for the timeout of this connection.
+        :type timeout: float
         :returns: A dictionary with the server's parsed JSON response.
         """
         self.logger.debug('%s %s %s' % (method, url, body))
+        timeout = self._get_timeout(timeout)
         
         for _ in range(3):
             try:
@@ -469,13 +561,7 @@ class RemoteConnection(object):
                         headers["Authorization"] = "Basic %s" % auth
                     if body and method != 'POST' and method != 'PUT':
                         body = None
-                    try:
-                        self._conn.request(method, parsed_url.path, body, headers)
-                        resp = self._conn.getresponse()
-                    except (httplib.HTTPException, socket.error):
-                        self._conn.close()
-                        raise
-        
+                    conn, resp = self._keep_alive_request(method, parsed_url.path, body, headers, timeout)
                     statuscode = resp.status
                 else:
                     password_manager = None
@@ -510,7 +596,7 @@ class RemoteConnection(object):
                         opener = url_request.build_opener(url_request.HTTPRedirectHandler(),
                                                           HttpErrorHandler(),
                                                           url_request.ProxyHandler({}))
-                    resp = opener.open(request, timeout=self._timeout)
+                    resp = opener.open(request, timeout=timeout)
                     statuscode = resp.code
                     if not hasattr(resp, 'getheader'):
                         if hasattr(resp.headers, 'getheader'):
@@ -518,10 +604,21 @@ class RemoteConnection(object):
                         elif hasattr(resp.headers, 'get'):
                             resp.getheader = lambda x: resp.headers.get(x)
         
-                data = resp.read()
+                try:
+                    data = resp.read()
+                except Exception:
+                    if self.keep_alive:
+                        self._pool.discard(conn)
+                    raise
+                if self.keep_alive:
+                    if resp.will_close:
+                        self._pool.discard(conn)
+                    else:
+                        self._pool.release(conn)
+                self._transfer.response_size = len(data)
                 try:
                     if 300 <= statuscode < 304:
-                        return self._request('GET', resp.getheader('location'))
+                        return self._request('GET', resp.getheader('location'), timeout=timeout)
                     body = data.decode('utf-8').replace('\x00', '').strip()
                     if 399 < statuscode < 500:
                         return {'status': statuscode, 'value': body}
@@ -530,7 +627,7 @@ class RemoteConnection(object):
                         content_type = resp.getheader('Content-Type').split(';')
                     if not any([x.startswith('image/png') for x in content_type]):
                         try:
-                            data = json.loads(body.strip())
+                            data = json_codec.loads(body.strip())
                         except ValueError:
                             if 199 < statuscode < 300:
                                 status = ErrorCode.SUCCESS
@@ -18,6 +18,7 @@
 from __future__ import absolute_import, print_function, division
 
 import base64
+import functools
 import os
 import re
 import time
@@ -35,6 +36,7 @@ from qt4i.exceptions import ControlAmbiguousError
 from qt4i.exceptions import ControlNotFoundError
 from qt4i.app import App
 from qt4i.device import QT4i_LOGS_PATH
+from qt4i.driver.rpc import DriverApiError
 from qt4i.qpath import QPath
 from qt4i.util import Rectangle, EnumDirect, Timeout
 
@@ -43,12 +45,26 @@ INS_IOS_DRIVER = True if settings.get('IOS_DRIVER', 'xctest') == 'instruments' e
 QTA_AI_SWITCH = settings.get('QT4I_AI_SWITCH', False)
 
 
+def ui_action(func):
+    '''修饰会改变UI的控件操作，操作后使所属App下的控件属性快照失效
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._app.invalidate_snapshots()
+    return wrapper
+
+
 class ControlContainer(object):
     '''控件集合接口
     '''
     
     def __init__(self):
         self._locators = {}  # 对象定义
+        self._prefetched = {} # prefetch查找到的element id，key为控件名
+        self._prefetch_epoch = None
         
     def __getitem__(self, key):
         '''操作符"[]"重载
@@ -95,8 +111,68 @@ class ControlContainer(object):
                 params['url'] = url
             if mt_instance is not None:
                 params['instance'] = mt_instance
-            return cls(**params)
+            control = cls(**params)
+            element_id = self._get_prefetched(key)
+            if element_id is not None:
+                control._element = _Element(element_id)
+            return control
         raise Exception('控件定义的结构异常: [%s]' % key)
+
+    def _get_prefetched(self, key):
+        if not self._prefetched or self._prefetch_epoch != self._app.snapshot_epoch:
+            return None
+        return self._prefetched.get(key)
+
+    def prefetch(self, timeout=0):
+        '''在一次请求中查找所有子控件并缓存element id，之后通过Controls获取的控件不再单独查找。
+        所属App下的控件执行点击、拖拽、输入等操作后缓存失效，需要时重新调用
+        
+        :param timeout: 查找全部子控件的超时值（秒），默认为0，只查找一轮，未找到的控件之后按原方式单独查找
+        :type timeout: float
+        :return: {控件名: 是否找到唯一的控件}
+        :rtype: dict
+        '''
+        self._prefetched = {}
+        if INS_IOS_DRIVER:
+            return {}
+        keys, items = [], []
+        indexes = {}
+        for key, params in self._locators.items():
+            if not isinstance(params, dict) or not issubclass(params.get('type'), Element):
+                continue
+            control = self[key]
+            if control._locator is None or isinstance(control._locator, int):
+                continue
+            indexes[key] = len(items)
+            keys.append(key)
+            items.append({'locator': str(control._locator), 'strategy': control.strategy, 'root': params.get('root'), 'control': control})
+        for item in items:
+            root = item.pop('root')
+            control = item.pop('control')
+            root_key = root[1:] if isinstance(root, string_types) and root.startswith('@') else None
+            if root_key in indexes:
+                item['parent'] = indexes[root_key]
+            elif isinstance(control._root, Element):
+                item['parent_id'] = control._root._element.id
+        if not items:
+            return {}
+        epoch = self._app.snapshot_epoch
+        try:
+            results = self._app.driver.element.find_elements_many(items, timeout, Element.timeout.interval)
+        except DriverApiError as e:
+            if 'is not supported by endpoint' in str(e): # 旧版本driver server
+                return {}
+            raise
+        def is_unique(i): # 控件和各级父控件都只找到一个
+            parent = items[i].get('parent')
+            return len(results[i]['elements']) == 1 and (parent is None or is_unique(parent))
+        found = {}
+        for i, key in enumerate(keys):
+            found[key] = is_unique(i)
+            if found[key]:
+                self._prefetched[key] = results[i]['elements'][0]['element']
+        self._prefetch_epoch = epoch
+        return found
     
     @property
     def Controls(self):
@@ -159,6 +235,8 @@ class Element(ControlContainer):
     '''
     
     timeout = Timeout(5, 0.005)
+    snapshot_enabled = False # 为True时label、name、value、visible、enabled和rect从属性快照读取，参考snapshot
+    snapshot_ttl = 0.2 # 属性快照的有效期（秒），轮询等待属性变化时不会一直读到旧值
     
     def __init__(self, root, locator, **ext):
         '''构造函数
@@ -192,6 +270,9 @@ class Element(ControlContainer):
         self._check_locator(self._locator)
         # -*- -*- -*-
         self._element = LazyInit(self, '_element', self._init_element)
+        self._snapshot = None
+        self._snapshot_epoch = None
+        self._snapshot_time = 0
    
     def _check_locator(self, _locator):
         if isinstance(_locator, string_types) and not _locator.startswith('/'): #默认为_locator为id
@@ -234,6 +315,7 @@ class Element(ControlContainer):
             else                               : _id = self._find()
         if not isinstance(_id, int): raise Exception('element is invalid')
         self._element = _Element(_id)
+        self.invalidate_snapshot() # 重新查找到的可能是另一个element
         return self._element
     
 
@@ -374,8 +456,31 @@ class Element(ControlContainer):
     def _get_attr(self, attr_name):
         '''获取控件的属性
         '''
+        if self.snapshot_enabled:
+            return self.snapshot().get(attr_name)
         return self._app.driver.element.get_element_attr(self._element.id, attr_name)
     
+    def snapshot(self, refresh=False):
+        '''获取控件的属性快照，一次调用获取全部属性并缓存，直到设备或控件执行点击、拖拽、输入等操作，
+        或超过snapshot_ttl
+        
+        :param refresh: 是否忽略缓存重新获取
+        :type refresh: boolean
+        :rtype: dict
+        '''
+        epoch = self._app.snapshot_epoch
+        if (refresh or self._snapshot is None or self._snapshot_epoch != epoch
+                or time.time() - self._snapshot_time >= self.snapshot_ttl):
+            self._snapshot = self.get_attr_dict()
+            self._snapshot_epoch = epoch
+            self._snapshot_time = time.time()
+        return self._snapshot
+    
+    def invalidate_snapshot(self):
+        '''使该控件的属性快照失效，下次读取属性时重新获取
+        '''
+        self._snapshot = None
+    
     def get_attr_dict(self):
         '''获取元素的属性信息，返回字典
         
@@ -408,6 +513,7 @@ class Element(ControlContainer):
         return self._get_attr('value')
     
     @value.setter
+    @ui_action
     def value(self, value):
         '''设置value(输入，支持中文)
         '''
@@ -435,11 +541,19 @@ class Element(ControlContainer):
         
         :rtype: Rectangle
         '''
-        rect = self._app.driver.element.get_rect(self._element.id)
+        rect = None
+        if self.snapshot_enabled:
+            rect = self.snapshot().get('rect')
+            if rect and 'origin' not in rect:
+                rect = {'origin': {'x': rect['x'], 'y': rect['y']},
+                        'size': {'width': rect['width'], 'height': rect['height']}}
+        if not rect:
+            rect = self._app.driver.element.get_rect(self._element.id)
         origin = rect['origin']
         size = rect['size']
         return Rectangle(origin['x'], origin['y'], origin['x'] + size['width'], origin['y'] + size['height'])
 
+    @ui_action
     def send_keys(self, keys):
         '''输入字符串
 
@@ -449,6 +563,7 @@ class Element(ControlContainer):
         '''
         self._app.driver.element.send_keys(self._element.id, keys)
     
+    @ui_action
     def scroll_to_visible(self, rate=1.0, drag_times=20):
         '''自动滚动到元素可见（技巧: Path中不写visible=true，当对象在屏幕可视范围之外，例如底部，调用此方法可以自动滚动到该元素为可见）
         
@@ -472,12 +587,14 @@ class Element(ControlContainer):
                     self._app.driver.device.drag(0.5, 0.45, 0.5 ,0.55)
                 elif rate >= 0.5 and rate <= 1: 
                     self._app.driver.device.drag(0.5, 0.55, 0.5 ,0.45)
+                self._app.invalidate_snapshots()
                 time.sleep(0.3)
                 if self.visible:
                     break
             else:
                 raise Exception('该控件不可见，请检查控件的位置[%s]和可见属性是否正常' % self.rect)
     
+    @ui_action
     def click(self, offset_x=None, offset_y=None):
         '''点击控件
         
@@ -488,6 +605,7 @@ class Element(ControlContainer):
         '''
         self._app.driver.element.click(self._element.id, offset_x, offset_y)
     
+    @ui_action
     def double_click(self, offset_x=0.5, offset_y=0.5):
         '''双击控件
         
@@ -498,6 +616,7 @@ class Element(ControlContainer):
         '''
         self._app.driver.element.double_click(self._element.id, offset_x, offset_y)
     
+    @ui_action
     def long_click(self, duration=3, offset_x=0.5, offset_y=0.5):
         '''单指长按
         
@@ -510,6 +629,7 @@ class Element(ControlContainer):
         '''
         self._app.driver.element.long_click(self._element.id, offset_x, offset_y, duration)
         
+    @ui_action
     def _tap_with_options(self, options={}):
         '''自定义点击(默认单指点击一次控件的中央)
         
@@ -530,6 +650,7 @@ class Element(ControlContainer):
                                   }}
         self._app.driver.element.click(self._element.id, None, None, options)
     
+    @ui_action
     def drag(self, from_x=0.9, from_y=0.5, to_x=0.1, to_y=0.5, duration=0.5):
         '''回避控件边缘，在控件体内拖拽（默认在控件内从右向左拖拽）
         
@@ -546,6 +667,7 @@ class Element(ControlContainer):
         '''
         self._app.driver.element.drag(self._element.id, from_x, from_y, to_x, to_y, duration)
     
+    @ui_action
     def drag2(self, direct=EnumDirect.Left):
         '''回避边缘在控件体内拖拽
         
@@ -557,6 +679,7 @@ class Element(ControlContainer):
         if direct == EnumDirect.Up    : self._app.driver.element.drag(self._element.id, 0.5, 0.5, 0.5, 0.1, 0.5)
         if direct == EnumDirect.Down  : self._app.driver.element.drag(self._element.id, 0.5, 0.5, 0.5, 0.9, 0.5)
     
+    @ui_action
     def flick(self, from_x=0.9, from_y=0.5, to_x=0.1, to_y=0.5):
         '''滑动/拂去（默认从右向左回避边缘进行滑动/拂去）该接口比drag的滑动速度快，如果滚动距离大，建议用此接口
         
@@ -571,6 +694,7 @@ class Element(ControlContainer):
         '''
         self._app.driver.element.drag(self._element.id, from_x, from_y, to_x, to_y, 0)
     
+    @ui_action
     def flick2(self, direct=EnumDirect.Left):
         '''回避边缘在控件体内滑动/拂去
         
@@ -643,6 +767,7 @@ class Element(ControlContainer):
         '''
         return MetisView(self)
     
+    @ui_action
     def force_touch(self, pressure=1.0, duration=2.0):
         '''3D touch
 
@@ -729,6 +854,7 @@ class Slider(Element):
         self._ios_version = self._app.device.ios_version
     
     @Window.value.setter
+    @ui_action
     def value(self, value):
         '''设置进度条的值(取值0~1之间)
         '''
@@ -861,6 +987,7 @@ class PickerWheel(Element):
     '''滚轮选择框
     '''
     
+    @ui_action
     def select(self, value):
         self._app.driver.element.select_picker_wheel(self._element.id, value)
 
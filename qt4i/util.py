@@ -62,6 +62,24 @@ class Timeout(BaseTimeout):
     def __repr__(self):
         return "%s" % {"timeout": self.timeout, "interval": self.interval}
 
+    def waitObjectProperty(self, obj, property_name, waited_value, regularMatch=False):
+        '''等待对象的属性值，每次比较前使obj的属性快照失效，读取最新的属性值，参数与基类相同
+        '''
+        return BaseTimeout.waitObjectProperty(self, _FreshSnapshot(obj), property_name, waited_value, regularMatch)
+
+
+class _FreshSnapshot(object):
+    '''读取属性前使对象的属性快照失效
+    '''
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getattr__(self, name):
+        invalidate_snapshot = getattr(self._obj, 'invalidate_snapshot', None)
+        if callable(invalidate_snapshot):
+            invalidate_snapshot()
+        return getattr(self._obj, name)
+
 
 class RegExpCompile(object):
     '''编译正则表达式
@@ -0,0 +1,76 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''RemoteConnection到XCTestAgent的Command.HEALTH往返基准测试，使用本地模拟的agent
+'''
+
+from __future__ import absolute_import, print_function
+
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from qt4i.driver.xctest.webdriverclient.command import Command
+from qt4i.driver.xctest.webdriverclient.remote_connection import RemoteConnection
+
+
+class FakeAgentHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''模拟XCTestAgent的/health接口
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = b'{"value": "XCTestAgent is ready", "sessionId": null, "status": 0}'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAgentServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def bench(conn, count):
+    '''返回每秒往返次数
+    '''
+    time0 = time.time()
+    for _ in range(count):
+        assert conn.execute(Command.HEALTH, {})['value'] == 'XCTestAgent is ready'
+    return count / (time.time() - time0)
+
+
+def main(count=2000):
+    server = FakeAgentServer(('127.0.0.1', 0), FakeAgentHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    for keep_alive, name in [(False, 'before (new connection)'), (True, 'after (keep-alive)')]:
+        conn = RemoteConnection(url, keep_alive=keep_alive)
+        bench(conn, 100) # 预热
+        print('%-24s: %d round trips/s' % (name, bench(conn, count)))
+        conn.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''RPC编解码基准测试，使用get_element_tree形式的控件树响应
+'''
+
+from __future__ import absolute_import, print_function
+
+import time
+
+from qt4i.driver.rpc import RPCClientProxy
+from qt4i.driver.util import get_json_codec
+from qt4i.driver.util import get_msgpack_codec
+from qt4i.driver.util._codec import JSON_CODECS
+
+
+def build_element_tree(depth=6, width=4):
+    '''构造与convert_to_qpath结果相同结构的控件树，节点数约为width**depth
+    '''
+    index = [0]
+
+    def build(level):
+        index[0] += 1
+        node = {'classname': 'Cell' if level else 'Application',
+                'label': u'列表项 %d' % index[0],
+                'name': 'item_%d' % index[0],
+                'value': None,
+                'visible': True,
+                'enabled': index[0] % 7 != 0,
+                'rect': {'origin': {'x': index[0] % 375, 'y': index[0] % 812},
+                         'size': {'width': 375, 'height': 44}},
+                'children': []}
+        if level < depth:
+            node['children'] = [build(level + 1) for _ in range(width)]
+        return node
+    return build(0)
+
+
+def bench(func, repeat):
+    '''返回单次调用的平均耗时(毫秒)
+    '''
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) * 1000 / repeat
+
+
+def main(repeat=10):
+    response = {'jsonrpc': '2.0', 'id': 'abcdefgh', 'result': [build_element_tree()]}
+    proxy = RPCClientProxy('http://127.0.0.1:12306/')
+    stdlib = get_json_codec('json')
+    data = stdlib.dumpb(response)
+    print('payload: %.1fKB' % (len(data) / 1024.0))
+
+    # 修改前：标准库json解码后再逐层调用encode_dict
+    before = bench(lambda: proxy.encode_dict(stdlib.loads(data)['result'][0]), repeat)
+    print('%-8s dumps: %7.2fms  loads+encode_dict: %7.2fms' % (
+          'before', bench(lambda: stdlib.dumpb(response), repeat), before))
+
+    codecs = [get_json_codec(codec_cls.name) for codec_cls, module in JSON_CODECS if module is not None]
+    msgpack_codec = get_msgpack_codec()
+    if msgpack_codec:
+        codecs.append(msgpack_codec)
+    for codec in codecs:
+        encoded = codec.dumpb(response)
+        assert codec.loads(encoded) == response
+        print('%-8s dumps: %7.2fms  loads:              %7.2fms' % (
+              codec.name, bench(lambda: codec.dumpb(response), repeat), bench(lambda: codec.loads(encoded), repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''SimpleJSONRPCServer分发echo请求的吞吐量基准测试（不经过网络）
+'''
+
+from __future__ import absolute_import, print_function
+
+import json
+import time
+
+from tests.unit.rpc_tests import start_demo_server
+
+
+def bench_dispatch(server, count, cached=True):
+    data = json.dumps({"jsonrpc": "2.0", "id": "1", "method": "demo.echo", "params": ["hello"]})
+    time0 = time.time()
+    for _ in range(count):
+        if not cached: # 模拟每次请求都重新匹配URL并创建end point
+            server._routes.clear()
+            server._endpoints.clear()
+        server._marshaled_dispatch(data, None, '/device/demo/')
+    return count / (time.time() - time0)
+
+
+def main(count=50000):
+    server = start_demo_server()
+    bench_dispatch(server, 1000)
+    print('before (no cache) : %d calls/s' % bench_dispatch(server, count, cached=False))
+    print('after (cached)    : %d calls/s' % bench_dispatch(server, count))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
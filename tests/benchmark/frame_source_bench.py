@@ -0,0 +1,59 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''逐帧启动进程与常驻进程截屏的帧率对比，用输出JPEG的Python进程代替simctl
+'''
+
+from __future__ import absolute_import, print_function
+
+import subprocess
+import sys
+import time
+
+from qt4i.driver.tools.screencapture import ProcessFrameSource
+
+
+FRAME_SIZE = 200 * 1024
+
+# 输出一帧或连续输出count帧的模拟截屏进程
+FAKE_SCREENSHOT = '''
+import os, sys
+out = getattr(sys.stdout, "buffer", sys.stdout)
+frame = b"\\xff\\xd8\\xff\\xda\\x00\\x02" + os.urandom(%d).replace(b"\\xff", b"\\x00") + b"\\xff\\xd9"
+for _ in range(int(sys.argv[1])):
+    out.write(frame)
+out.flush()
+''' % FRAME_SIZE
+
+
+def main(count=100):
+    cmd = [sys.executable, '-c', FAKE_SCREENSHOT]
+    time0 = time.time()
+    for _ in range(count):
+        subprocess.check_output(cmd + ['1'])
+    before = count / (time.time() - time0)
+
+    source = ProcessFrameSource(cmd + [str(count)])
+    time0 = time.time()
+    source.open()
+    for _ in range(count):
+        assert len(source.read_frame()) == FRAME_SIZE + 8
+    after = count / (time.time() - time0)
+    source.close()
+    print('before (process per frame): %7.1f fps' % before)
+    print('after  (persistent process): %7.1f fps' % after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''MJpegClient读帧基准测试，输出帧率和每帧分配的内存
+
+用法: python -m tests.benchmark.mjpeg_bench [录制的MJPEG流文件 boundary]
+不指定文件时使用合成的MJPEG流。
+'''
+
+from __future__ import absolute_import, print_function
+
+import io
+import os
+import random
+import sys
+import time
+
+from qt4i.driver.tools.screencapture import MJpegClient
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+
+BOUNDARY = '--BoundaryString'
+RECV_SIZE = 16 * 1024 # 模拟socket每次返回的数据量
+
+
+def build_stream(count=300, boundary=BOUNDARY):
+    '''构造与XCTestAgent输出格式相同的MJPEG流，帧大小在100KB到300KB之间
+    '''
+    rand = random.Random(0)
+    chunks = []
+    for _ in range(count):
+        size = rand.randint(100 * 1024, 300 * 1024)
+        chunks.append(('%s\r\nContent-type: image/jpg\r\nContent-Length: %d\r\n\r\n'
+                       % (boundary, size)).encode('ascii'))
+        chunks.append(b'\xff\xd8' + os.urandom(size - 4) + b'\xff\xd9')
+        chunks.append(b'\r\n\r\n')
+    return b''.join(chunks)
+
+
+class SocketLikeStream(io.RawIOBase):
+    '''每次读取最多返回RECV_SIZE字节，模拟网络流
+    '''
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), RECV_SIZE, len(self._data) - self._pos)
+        b[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+
+class LegacyMJpegClient(MJpegClient):
+    '''修改前的读帧实现：逐块读取并拼接
+    '''
+
+    def read_frame(self):
+        hdr = self._read_headers(self.boundary)
+        clen = self._parse_content_length(hdr)
+        if clen == 0:
+            raise EOFError('End of stream reached')
+        self._check_content_type(hdr, 'image/jpg')
+        left = clen
+        buf = b''
+        while left > 0:
+            tmp = self.stream.read(left)
+            buf += tmp
+            left -= len(tmp)
+        return buf
+
+
+def open_client(cls, data, boundary):
+    return cls(stream=io.BufferedReader(SocketLikeStream(data)), boundary=boundary)
+
+
+def measure(cls, data, boundary):
+    '''返回(帧数, 帧率, 每帧峰值内存增量KB)
+    '''
+    client = open_client(cls, data, boundary)
+    count = 0
+    time0 = time.time()
+    try:
+        while True:
+            client.read_frame()
+            count += 1
+    except EOFError:
+        pass
+    fps = count / (time.time() - time0)
+    peak = 0
+    if tracemalloc:
+        client = open_client(cls, data, boundary)
+        client.read_frame() # 预热，新实现在此分配帧缓冲区
+        tracemalloc.start()
+        frames = 0
+        try:
+            while True:
+                base = tracemalloc.get_traced_memory()[0]
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                client.read_frame()
+                peak += tracemalloc.get_traced_memory()[1] - base
+                frames += 1
+        except EOFError:
+            pass
+        tracemalloc.stop()
+        peak = peak / float(max(frames, 1))
+    return count, fps, peak / 1024.0
+
+
+def main():
+    if len(sys.argv) > 2:
+        with open(sys.argv[1], 'rb') as fd:
+            data = fd.read()
+        boundary = sys.argv[2]
+    else:
+        boundary = BOUNDARY
+        data = build_stream(boundary=boundary)
+    print('stream: %.1fMB' % (len(data) / 1024.0 / 1024))
+    for cls, name in [(LegacyMJpegClient, 'before (concatenate)'), (MJpegClient, 'after  (readinto)')]:
+        print('%s: %d frames  %7.1f fps  %8.1fKB allocated/frame' % ((name,) + measure(cls, data, boundary)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''find_elements查找前QPath解析和控件类型转换的基准测试
+'''
+
+from __future__ import absolute_import, print_function
+
+import time
+
+from tuia.qpathparser import QPathParser
+
+from qt4i.driver.util.uimap import UIA_XCT_MAPS
+from qt4i.driver.util.uimap import instruments2xctest
+from qt4i.driver.util.uimap import qpath_cache
+
+
+def parse_without_cache(locator):
+    '''修改前wda.Element.find_elements中的实现
+    '''
+    qpath_array, qpath_lex = QPathParser().parse(locator)
+    for node in qpath_array:
+        if 'classname' in node:
+            if node['classname'][1] in UIA_XCT_MAPS.keys():
+                node['classname'][1] = UIA_XCT_MAPS[node['classname'][1]]
+    return qpath_array, qpath_lex
+
+
+def main(locator_count=300, repeat=20):
+    locators = ["/classname='UIAWindow' && visible=true /classname='UIATableView' && maxdepth=6 "
+                "/classname='UIATableCell' && name~='item_%d' && instance=%d" % (i, i % 3)
+                for i in range(locator_count)]
+    for name, func in [('before (parse)', parse_without_cache), ('after (cached)', instruments2xctest)]:
+        qpath_cache.clear()
+        time0 = time.time()
+        for _ in range(repeat):
+            for locator in locators:
+                func(locator)
+        cost = (time.time() - time0) * 1000000 / (repeat * locator_count)
+        print('%-16s: %.1fus per lookup' % (name, cost))
+    print('cache stats     : %s' % qpath_cache.get_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''RPCClientProxy单次调用耗时的基准测试
+'''
+
+from __future__ import absolute_import, print_function
+
+import time
+
+from qt4i.driver.rpc import RPCClientProxy
+from qt4i.driver.rpc import SimpleJSONRPCRequestHandler
+from tests.unit.rpc_tests import start_demo_server
+
+
+def bench_calls(driver, count):
+    time0 = time.time()
+    for _ in range(count):
+        driver.demo.echo()
+    return (time.time() - time0) * 1000.0 / count
+
+
+def main(count=2000):
+    server = start_demo_server()
+    url = 'http://127.0.0.1:%d/device/demo/' % server.server_address[1]
+    # before: HTTP/1.0服务端 + 默认transport，每次调用新建TCP连接
+    SimpleJSONRPCRequestHandler.protocol_version = 'HTTP/1.0'
+    driver = RPCClientProxy(url, keep_alive=False)
+    bench_calls(driver, 50) # 预热
+    print('before (connect per call): %.3fms per call' % bench_calls(driver, count))
+    # after: HTTP/1.1服务端 + 连接池
+    SimpleJSONRPCRequestHandler.protocol_version = 'HTTP/1.1'
+    driver = RPCClientProxy(url)
+    bench_calls(driver, 50)
+    print('after (connection pool)  : %.3fms per call' % bench_calls(driver, count))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
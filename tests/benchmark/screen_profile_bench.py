@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''推流参数和变化检测的基准测试，输出每个客户端收到的数据量和编码耗时，需要安装Pillow
+'''
+
+from __future__ import absolute_import, print_function
+
+import io
+import random
+import time
+
+from qt4i.driver.tools import screencapture
+from qt4i.driver.tools.screencapture import FrameBroadcaster
+from qt4i.driver.tools.screencapture import ScreenProducer
+from qt4i.driver.tools.screencapture import StreamProfile
+from qt4i.driver.tools.screencapture import perceptual_hash
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+
+def build_frames(count=60, changed_ratio=0.3, size=(1170, 2532)):
+    '''构造模拟屏幕的JPEG序列，只有changed_ratio比例的帧画面有变化
+    '''
+    rand = random.Random(0)
+    frames = []
+    img = Image.new('RGB', size, 'white')
+    for i in range(count):
+        if i == 0 or rand.random() < changed_ratio:
+            img = Image.new('RGB', size, 'white')
+            draw = ImageDraw.Draw(img)
+            for row in range(0, size[1], 132):
+                draw.rectangle([0, row, size[0], row + 130], fill=(rand.randint(200, 255),) * 3)
+                draw.text((40, row + 50), u'cell %d-%d' % (i, row), fill='black')
+        output = io.BytesIO()
+        img.save(output, 'JPEG', quality=85)
+        frames.append(output.getvalue())
+    return frames
+
+
+def main():
+    if Image is None:
+        print('Pillow is required: pip install Pillow')
+        return
+    frames = build_frames()
+    profiles = [StreamProfile(0, 0, 0)] * 2 + [StreamProfile(0, 720, 60)] * 4 + [StreamProfile(0, 360, 40)] * 4
+
+    time0 = time.time()
+    for frame in frames:
+        perceptual_hash(frame)
+    print('perceptual hash: %.1fms/frame' % ((time.time() - time0) * 1000 / len(frames)))
+
+    native = sum(len(frame) for frame in frames)
+    print('before: %d clients x %.1fMB = %.1fMB' % (len(profiles), native / 1048576.0,
+                                                   native * len(profiles) / 1048576.0))
+
+    producer = ScreenProducer('aaaaaaaaaaaa', 8100)
+    producer.broadcaster = FrameBroadcaster(capacity=len(frames))
+    subscribers = [producer.broadcaster.subscribe(latest=False, profile=profile) for profile in profiles]
+    transcoded = []
+    transcode = screencapture.transcode_jpeg
+    def counting_transcode(*args):
+        transcoded.append(args[1:])
+        return transcode(*args)
+    screencapture.transcode_jpeg = counting_transcode
+    time0 = time.time()
+    for frame in frames:
+        producer._publish_frame(frame)
+    sent = 0
+    for subscriber in subscribers:
+        while True:
+            data = subscriber.next_frame(timeout=0)
+            if data is None:
+                break
+            sent += len(data)
+    elapsed = time.time() - time0
+    screencapture.transcode_jpeg = transcode
+    print('after:  %d frames published, %d suppressed, %d encodes for %d clients, %.1fMB sent in %.2fs'
+          % (len(frames) - producer.suppressed_frames, producer.suppressed_frames, len(transcoded),
+             len(profiles), sent / 1048576.0, elapsed))
+
+
+if __name__ == '__main__':
+    main()
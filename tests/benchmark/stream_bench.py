@@ -0,0 +1,91 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''流式响应的服务端峰值内存基准测试（需要Python 3）
+'''
+
+from __future__ import absolute_import, print_function
+
+import base64
+import os
+import threading
+import tracemalloc
+
+import six.moves.http_client as http_client
+
+from qt4i.driver.rpc import rpc_method
+from qt4i.driver.rpc import RPCEndpoint
+from qt4i.driver.rpc import SimpleJSONRPCServer
+from qt4i.driver.rpc import STREAM_HEADER
+
+
+class PayloadEndpoint(RPCEndpoint):
+    '''返回预先构造的响应，避免请求和构造过程计入峰值内存
+    '''
+    rpc_name_prefix = "device." # 使用driver中的方法名，响应内容不输出到日志
+    payloads = {}
+
+    def __init__(self, rpc_server, device_id):
+        RPCEndpoint.__init__(self)
+
+    @rpc_method
+    def capture_screen(self):
+        return self.payloads['capture_screen']
+
+    @rpc_method
+    def get_element_tree(self):
+        return self.payloads['get_element_tree']
+
+
+def bench_peak_memory(port, name, stream):
+    '''返回一次调用的峰值内存增量(MB)，客户端按分块读取并丢弃响应
+    '''
+    body = '{"jsonrpc": "2.0", "id": "1", "method": "device.%s"}' % name
+    headers = {'Content-Type': 'application/json-rpc', 'Accept-Encoding': 'gzip'}
+    if stream:
+        headers[STREAM_HEADER] = 'chunked'
+    conn = http_client.HTTPConnection('127.0.0.1', port)
+    tracemalloc.start()
+    conn.request('POST', '/device/demo/', body, headers)
+    resp = conn.getresponse()
+    while resp.read(64*1024):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    conn.close()
+    return peak / 1024.0 / 1024
+
+
+def main():
+    PayloadEndpoint.payloads = {
+        'capture_screen': base64.b64encode(os.urandom(6*1024*1024)).decode('ascii'),
+        'get_element_tree': {'children': [{'classname': 'Button', 'label': 'item %d' % i, 'visible': True,
+                                           'rect': {'origin': {'x': i, 'y': i}, 'size': {'width': 10, 'height': 10}}}
+                                          for i in range(30000)]},
+        }
+    urls = [(r"^device/(?P<device_id>[\w\-]+)/$", r"^device\..*", PayloadEndpoint)]
+    server = SimpleJSONRPCServer(urls=urls, addr=('127.0.0.1', 0))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    port = server.server_address[1]
+    for name in PayloadEndpoint.payloads:
+        bench_peak_memory(port, name, False) # 预热
+        print('%-16s before (buffered): %.1fMB' % (name, bench_peak_memory(port, name, False)))
+        print('%-16s after (streamed) : %.1fMB' % (name, bench_peak_memory(port, name, True)))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''convert_to_qpath基准测试，使用XCTestAgent格式的合成控件树，输出耗时和峰值内存
+'''
+
+from __future__ import absolute_import, print_function
+
+import time
+
+from qt4i.driver.util import get_json_codec
+from qt4i.driver.util.uitree import convert_to_qpath
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+
+def build_agent_tree(count=50000, width=5):
+    '''按广度优先构造XCTestAgent格式的控件树
+
+    :param count: 节点数
+    :param width: 每个节点的子节点数
+    '''
+    def new_node(index):
+        return {'type': 'Cell', 'label': u'列表项 %d' % index, 'name': 'item_%d' % index, 'value': None,
+                'isEnabled': '1', 'isVisible': '1' if index % 3 else '0',
+                'rect': {'x': index % 375, 'y': index % 812, 'width': 375, 'height': 44},
+                'children': []}
+    root = new_node(0)
+    queue, head, index = [root], 0, 1
+    while index < count:
+        parent = queue[head]
+        head += 1
+        for _ in range(width):
+            child = new_node(index)
+            parent['children'].append(child)
+            queue.append(child)
+            index += 1
+    return root
+
+
+def build_deep_tree(depth):
+    '''构造只有一条分支的深层控件树
+    '''
+    root = node = {'type': 'Other', 'rect': {'x': 0, 'y': 0, 'width': 1, 'height': 1}, 'children': []}
+    for _ in range(depth):
+        child = {'type': 'Other', 'rect': {'x': 0, 'y': 0, 'width': 1, 'height': 1}, 'children': []}
+        node['children'].append(child)
+        node = child
+    return root
+
+
+def convert_to_qpath_recursive(element):
+    '''修改前的递归实现
+    '''
+    if 'type' in element:
+        element['classname'] = element['type']
+        element.pop('type')
+    if 'isEnabled' in element:
+        element['enabled'] = (element['isEnabled'] == '1')
+        element.pop('isEnabled')
+    if 'isVisible' in element:
+        element['visible'] = (element['isVisible'] == '1')
+        element.pop('isVisible')
+    if 'rect' in element:
+        element['rect']= {
+            'origin': {'x': element['rect']['x'], 'y': element['rect']['y']},
+            'size'  : {'width': element['rect']['width'], 'height': element['rect']['height']},
+        }
+    children = []
+    for child in element.get('children', []):
+        children.append(convert_to_qpath_recursive(child))
+    element['children'] = children
+    return element
+
+
+def measure(func, data, codec, repeat):
+    '''返回(解码和转换的平均耗时毫秒, 转换时的峰值内存增量KB)
+    '''
+    elapsed = 0
+    for _ in range(repeat):
+        tree = codec.loads(data)
+        time0 = time.time()
+        func(tree)
+        elapsed += time.time() - time0
+    peak = 0
+    if tracemalloc:
+        tree = codec.loads(data)
+        tracemalloc.start()
+        func(tree)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed * 1000 / repeat, peak / 1024.0
+
+
+def main(count=50000, repeat=5):
+    codec = get_json_codec()
+    data = codec.dumpb(build_agent_tree(count))
+    print('nodes: %d  payload: %.1fMB' % (count, len(data) / 1024.0 / 1024))
+    before = measure(convert_to_qpath_recursive, data, codec, repeat)
+    after = measure(convert_to_qpath, data, codec, repeat)
+    assert convert_to_qpath_recursive(codec.loads(data)) == convert_to_qpath(codec.loads(data))
+    print('before (recursive): %7.1fms  peak %8.1fKB' % before)
+    print('after  (iterative): %7.1fms  peak %8.1fKB' % after)
+
+    deep_tree = build_deep_tree(20000)
+    convert_to_qpath(deep_tree)
+    try:
+        convert_to_qpath_recursive(build_deep_tree(20000))
+        print('depth 20000: both ok')
+    except RuntimeError: # RecursionError
+        print('depth 20000: recursive version exceeds recursion limit, iterative version ok')
+
+
+if __name__ == '__main__':
+    main()
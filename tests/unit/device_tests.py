@@ -26,6 +26,7 @@ from qt4i.icontrols import Element
 from qt4i.app import App
 from qt4i.app import NLCType
 from qt4i.util import EnumDirect
+from qt4i.driver.util.uitree import UITreeCache
 
 
 class DeviceAcquirementTest(unittest.TestCase):
@@ -122,20 +123,39 @@ class DeviceActionTest(unittest.TestCase):
 
     def test_print_uitree_with_return(self):
         self._start_app()
-        self.device.driver.device.get_element_tree.return_value = \
+        self.device.driver.device.get_element_tree_diff.return_value = {"hash": "0", "tree":
             {"classname": "Application", "label": "7.8.5_gn", "name": "7.8.5_gn", "value":"",
-             "visible":True, "enabled": True, "children":{}}
+             "visible":True, "enabled": True, "children":{}}}
         result = self.device.print_uitree(True)
         self.assertIsInstance(result, dict, 'print_uitree should have a dict return')
 
     def test_print_uitree_without_resturn(self):
         self._start_app()
-        self.device.driver.device.get_element_tree.return_value = \
+        self.device.driver.device.get_element_tree_diff.return_value = {"hash": "0", "tree":
             {"classname": "Application", "label": "7.8.5_gn", "name": "7.8.5_gn", "value":"",
-             "visible":True, "enabled": True, "children":{}}
+             "visible":True, "enabled": True, "children":{}}}
         result = self.device.print_uitree()
         self.assertIsNone(result, 'print_uitree should return None: %s' % type(result))
 
+    def test_snapshot_not_changed_by_get_element_tree(self):
+        self._start_app()
+        def build_tree(label):
+            return {"classname": "Application", "label": "demo", "name": "demo", "value": "",
+                    "visible": True, "enabled": True, "children": [
+                        {"classname": "Button", "label": label, "name": "ok", "value": "",
+                         "visible": True, "enabled": True, "children": []}]}
+        cache = UITreeCache()
+        trees, results = [build_tree('a'), build_tree('b')], []
+        def get_element_tree_diff(base_hash, max_depth, root_id):
+            results.append(cache.get_diff((root_id, max_depth), trees.pop(0), base_hash))
+            return results[-1]
+        self.device.driver.device.get_element_tree_diff.side_effect = get_element_tree_diff
+        snapshot = self.device.take_snapshot()
+        self.assertEqual([node['label'] for node in snapshot.query('ok')], ['a'])
+        self.assertEqual(self.device.get_element_tree()['children'][0]['label'], 'b')
+        self.assertEqual([node['label'] for node in snapshot.query('ok')], ['a'], 'get_element_tree不应修改已有快照')
+        self.assertIn('patches', results[-1], '第二次获取应为增量更新')
+
     def test_click(self):
         self._start_app()
         self.device.click() 
@@ -0,0 +1,185 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''qt4i.icontrols的单元测试用例
+'''
+
+
+import unittest
+import mock
+
+from qt4i.app import App
+from qt4i.device import Device
+from qt4i.device import Keyboard
+from qt4i.icontrols import Element
+from qt4i.icontrols import Window
+from qt4i.qpath import QPath
+from qt4i.util import Timeout
+
+
+def create_device():
+    '''模拟的设备，invalidate_snapshots使snapshot_epoch递增
+    '''
+    device = mock.MagicMock()
+    device.snapshot_epoch = 0
+    def invalidate_snapshots():
+        device.snapshot_epoch += 1
+    device.invalidate_snapshots.side_effect = invalidate_snapshots
+    return device
+
+
+class DemoWindow(Window):
+    '''prefetch test window
+    '''
+
+    def __init__(self, app):
+        Window.__init__(self, app)
+        self.updateLocator({
+            'list': {'type': Element, 'root': self, 'locator': QPath("/classname='Table' & maxdepth=10")},
+            'cell': {'type': Element, 'root': '@list', 'locator': QPath("/classname='Cell' & maxdepth=1")},
+            'button': {'type': Element, 'root': '@cell', 'locator': 'ok'},
+        })
+
+
+class PrefetchTest(unittest.TestCase):
+    '''ControlContainer.prefetch test
+    '''
+
+    def setUp(self):
+        self.app = App(create_device(), 'com.tencent.demo')
+        self.find_elements_many = self.app.driver.element.find_elements_many
+        self.window = DemoWindow(self.app)
+
+    def set_results(self, **counts):
+        ids = {'list': 10, 'cell': 20, 'button': 30}
+        locators = dict((str(params['locator']), key) for key, params in self.window._locators.items())
+        def find_elements_many(items, timeout, interval):
+            results = []
+            for item in items:
+                key = locators[item['locator']]
+                results.append({'elements': [{'element': ids[key] + i} for i in range(counts[key])]})
+            return results
+        self.find_elements_many.side_effect = find_elements_many
+
+    def get_items(self):
+        items = self.find_elements_many.call_args[0][0]
+        return items, dict((item['locator'], item) for item in items)
+
+    def test_parent_chain(self):
+        self.set_results(list=1, cell=1, button=1)
+        found = self.window.prefetch()
+        items, by_locator = self.get_items()
+        table, cell, button = by_locator["/classname='Table' & maxdepth=10"], by_locator["/classname='Cell' & maxdepth=1"], by_locator['ok']
+        self.assertEqual(table['parent_id'], 1, '根控件应以Window为父element')
+        self.assertIs(items[cell['parent']], table)
+        self.assertIs(items[button['parent']], cell)
+        self.assertEqual(button['strategy'], 'id')
+        self.assertEqual(self.find_elements_many.call_args[0][1], 0, '默认只查找一轮')
+        self.assertEqual(found, {'list': True, 'cell': True, 'button': True})
+        self.assertEqual(self.window.Controls['button']._element.id, 30)
+        self.assertFalse(self.app.driver.element.find_elements.called, 'prefetch后不应再单独查找')
+
+    def test_is_unique(self):
+        self.set_results(list=1, cell=2, button=1)
+        found = self.window.prefetch()
+        self.assertEqual(found, {'list': True, 'cell': False, 'button': False}, '父控件不唯一时子控件不应缓存')
+        self.assertEqual(list(self.window._prefetched), ['list'])
+
+    def test_epoch(self):
+        self.set_results(list=1, cell=1, button=1)
+        self.window.prefetch()
+        self.assertIsNotNone(self.window._get_prefetched('list'))
+        self.app.invalidate_snapshots()
+        self.assertIsNone(self.window._get_prefetched('list'), 'UI操作后prefetch缓存应失效')
+
+
+class SnapshotTest(unittest.TestCase):
+    '''Element.snapshot test
+    '''
+
+    def setUp(self):
+        self.device = create_device()
+        self.app = App(self.device, 'com.tencent.demo')
+        self.driver = self.app.driver
+        self.driver.element.find_elements.return_value = {'elements': [{'element': 5}], 'find_count': 1, 'find_time': 1}
+        self.driver.element.get_element_attrs.return_value = {'label': 'a', 'rect': {'x': 1, 'y': 2, 'width': 3, 'height': 4}}
+        self.element = Element(Window(self.app), QPath("/classname='Button' & maxdepth=10"))
+        self.element.snapshot_enabled = True
+        self.element.snapshot_ttl = 100
+
+    def test_cached(self):
+        self.assertEqual((self.element.label, self.element.label), ('a', 'a'))
+        self.assertEqual(self.driver.element.get_element_attrs.call_count, 1, '快照未缓存')
+        self.element.snapshot(refresh=True)
+        self.assertEqual(self.driver.element.get_element_attrs.call_count, 2)
+
+    def test_invalidated_by_element_action(self):
+        self.element.label
+        self.element.value = 'b'
+        self.element.label
+        self.assertEqual(self.driver.element.get_element_attrs.call_count, 2, '控件操作后快照未失效')
+
+    def test_invalidated_by_device_action(self):
+        self.element.label
+        self.device.invalidate_snapshots()
+        self.element.label
+        self.assertEqual(self.driver.element.get_element_attrs.call_count, 2, '设备操作后快照未失效')
+
+    def test_ttl(self):
+        self.element.snapshot_ttl = 0
+        self.element.label
+        self.element.label
+        self.assertEqual(self.driver.element.get_element_attrs.call_count, 2, '快照超过有效期后未失效')
+
+    def test_invalidated_by_find(self):
+        self.element.label
+        self.element.wait_for_exist(1, 0.005)
+        self.element.label
+        self.assertEqual(self.driver.element.get_element_attrs.call_count, 2, '重新查找控件后快照未失效')
+
+    def test_wait_object_property(self):
+        self.driver.element.get_element_attrs.side_effect = [{'label': 'a'}, {'label': 'a'}, {'label': 'b'}]
+        self.element.label
+        Timeout(1, 0.01).waitObjectProperty(self.element, 'label', 'b')
+        self.assertEqual(self.driver.element.get_element_attrs.call_count, 3)
+
+    def test_rect(self):
+        rect = self.element.rect
+        self.assertEqual((rect.left, rect.top, rect.right, rect.bottom), (1, 2, 4, 6), '快照中的rect格式转换错误')
+        self.driver.element.get_element_attrs.return_value = {'rect': {'origin': {'x': 1, 'y': 2}, 'size': {'width': 3, 'height': 4}}}
+        self.element.snapshot(refresh=True)
+        rect = self.element.rect
+        self.assertEqual((rect.left, rect.top, rect.right, rect.bottom), (1, 2, 4, 6))
+        self.assertFalse(self.driver.element.get_rect.called)
+        self.driver.element.get_element_attrs.return_value = {'label': 'a'}
+        self.driver.element.get_rect.return_value = {'origin': {'x': 0, 'y': 0}, 'size': {'width': 5, 'height': 5}}
+        self.element.snapshot(refresh=True)
+        self.assertEqual(self.element.rect.width, 5, '快照中没有rect时应单独获取')
+
+
+class DeviceActionSnapshotTest(unittest.TestCase):
+    '''设备操作使属性快照失效
+    '''
+
+    def test_device_action(self):
+        device = mock.MagicMock()
+        Device.click(device, 0.5, 0.5)
+        Device.drag(device)
+        Device._dismiss_alert(device, [])
+        self.assertEqual(device.invalidate_snapshots.call_count, 3)
+
+    def test_send_keys(self):
+        device = mock.MagicMock()
+        Keyboard(device).send_keys('abc')
+        self.assertTrue(device.invalidate_snapshots.called, '输入后快照未失效')
@@ -0,0 +1,517 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''qt4i.driver.rpc的单元测试用例
+'''
+
+
+import io
+import json
+import mock
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import six
+import six.moves.http_client as http_client
+
+from qt4i.driver.rpc import rpc_method
+from qt4i.driver.rpc import RPCEndpoint
+from qt4i.driver.rpc import RPCClientProxy
+from qt4i.driver.rpc import ConnectionPool
+from qt4i.driver.rpc import DriverApiError
+from qt4i.driver.rpc import WebSocketChannel
+from qt4i.driver.rpc import SimpleJSONRPCServer
+from qt4i.driver.rpc import STREAM_HEADER
+from qt4i.driver.util import get_json_codec
+from qt4i.driver.util import get_msgpack_codec
+
+
+class DemoEndpoint(RPCEndpoint):
+    '''测试用RPC end point
+    '''
+    rpc_name_prefix = "demo."
+    instance_count = 0
+    slow_calls = 0
+
+    def __init__(self, rpc_server, device_id):
+        self.rpc_server = rpc_server
+        self.udid = device_id
+        DemoEndpoint.instance_count += 1
+        self.serial = DemoEndpoint.instance_count
+        RPCEndpoint.__init__(self)
+
+    @rpc_method
+    def echo(self, value=True):
+        return value
+
+    @rpc_method
+    def blob_handle(self, text):
+        return self.rpc_server.blobs.add_data(text.encode('utf-8'))
+
+    @rpc_method
+    def file_handle(self, file_path):
+        return self.rpc_server.blobs.add_file(file_path)
+
+    @rpc_method
+    def upload_handle(self, file_path):
+        return self.rpc_server.blobs.add_upload(file_path)
+
+    @rpc_method
+    def instance_id(self):
+        return self.serial
+
+    @rpc_method
+    def delay_echo(self, value, seconds):
+        time.sleep(seconds)
+        return value
+
+    @rpc_method
+    def slow_count(self, seconds):
+        DemoEndpoint.slow_calls += 1
+        time.sleep(seconds)
+        return DemoEndpoint.slow_calls
+
+
+DEMO_URLS = [(r"^device/(?P<device_id>[\w\-]+)/$", r"^demo\..*", DemoEndpoint)]
+
+
+def start_demo_server(server_cls=SimpleJSONRPCServer, **kwargs):
+    server = server_cls(urls=DEMO_URLS, addr=('127.0.0.1', 0), **kwargs)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+class RPCClientProxyTest(unittest.TestCase):
+    '''RPCClientProxy test
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_demo_server()
+        cls.driver_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        ConnectionPool.clear_all()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_echo(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url, allow_none=True, encoding='UTF-8')
+        self.assertEqual(driver.demo.echo('hello'), 'hello', 'RPC调用返回值错误')
+
+    def test_echo_without_keep_alive(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url, keep_alive=False)
+        self.assertEqual(driver.demo.echo([1, {'a': 2}]), [1, {'a': 2}], 'RPC调用返回值错误')
+
+    def test_connection_pool_shared(self):
+        driver1 = RPCClientProxy('%s/device/demo1/' % self.driver_url)
+        driver2 = RPCClientProxy('%s/device/demo2/' % self.driver_url)
+        pool = ConnectionPool.get_pool('http', '127.0.0.1:%d' % self.server.server_address[1])
+        pool.clear()
+        for _ in range(10):
+            driver1.demo.echo()
+            driver2.demo.echo()
+        self.assertEqual(pool.idle_count, 1, '串行调用应复用同一个连接')
+
+    def test_batch(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        with driver.batch() as batch:
+            r1 = batch.demo.echo('a')
+            r2 = batch.demo.not_exist()
+            r3 = batch.demo.echo({'b': 1})
+            self.assertFalse(r1.done(), '批量调用不应在退出with语句前发送')
+        self.assertEqual(r1.result(), 'a', 'RPC调用返回值错误')
+        self.assertRaises(DriverApiError, r2.result)
+        self.assertEqual(r3.result(), {'b': 1}, 'RPC调用返回值错误')
+
+    def test_endpoint_cache(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        endpoint_id = driver.demo.instance_id()
+        self.assertEqual(driver.demo.instance_id(), endpoint_id, '同一设备的end point应被复用')
+        other = RPCClientProxy('%s/device/other/' % self.driver_url)
+        self.assertNotEqual(other.demo.instance_id(), endpoint_id, '不同设备的end point不应共用')
+        self.server.invalidate_endpoints('demo')
+        self.assertNotEqual(driver.demo.instance_id(), endpoint_id, 'end point缓存未失效')
+
+    def test_streamed_response(self):
+        tree = {'children': [{'name': 'n%d' % i, 'rect': [i, i, 10, 10]} for i in range(20000)]}
+        conn = http_client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        body = json.dumps({"jsonrpc": "2.0", "id": "1", "method": "demo.echo", "params": [tree]})
+        conn.request('POST', '/device/demo/', body, {STREAM_HEADER: 'chunked', 'Content-Type': 'application/json-rpc'})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked', '大响应未使用chunked编码')
+        self.assertEqual(json.loads(resp.read())['result'][0], tree, '流式响应内容错误')
+        conn.close()
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        self.assertEqual(driver.demo.echo(tree), tree, 'gzip流式响应解码错误')
+        self.assertEqual(driver.demo.echo('x' * 300000), 'x' * 300000, '长字符串流式响应错误')
+
+    def test_codec(self):
+        value = {'label': u'中文', 'rect': {'origin': {'x': 1.5, 'y': 2}}, 'value': None, 'visible': True}
+        for name in ['json', None]:
+            codec = get_json_codec(name)
+            self.assertEqual(codec.loads(codec.dumpb(value)), value, '%s编解码错误' % codec.name)
+        with mock.patch('qt4i.driver.util._codec.JSON_CODEC', 'json'):
+            self.assertEqual(get_json_codec().name, 'json', '未按QT4I_JSON_CODEC配置选择编解码器')
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        self.assertEqual(driver.demo.echo(value), value, 'RPC调用返回值错误')
+
+    @unittest.skipIf(get_msgpack_codec() is None, 'msgpack is not installed')
+    def test_msgpack_response(self):
+        codec = get_msgpack_codec()
+        conn = http_client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        body = json.dumps({"jsonrpc": "2.0", "id": "1", "method": "demo.echo", "params": [u'中文']})
+        conn.request('POST', '/device/demo/', body, {'Accept': codec.content_type, 'Content-Type': 'application/json-rpc'})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader('Content-Type'), codec.content_type, '未按Accept协商msgpack响应')
+        self.assertEqual(codec.loads(resp.read())['result'][0], u'中文', 'msgpack响应内容错误')
+        conn.close()
+
+    def test_blob(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        token = driver.demo.blob_handle('binary data')
+        fd = io.BytesIO()
+        self.assertEqual(driver.fetch_blob(token, fd), 11)
+        self.assertEqual(fd.getvalue(), b'binary data', '二进制通道下载内容错误')
+        self.assertRaises(DriverApiError, driver.fetch_blob, token, io.BytesIO()) # token只能使用一次
+
+        src_path = tempfile.mktemp()
+        dst_path = tempfile.mktemp()
+        with open(src_path, 'wb') as fd:
+            fd.write(os.urandom(200000))
+        try:
+            with open(src_path, 'rb') as fd:
+                driver.send_blob(driver.demo.upload_handle(dst_path), fd)
+            with open(src_path, 'rb') as fd1, open(dst_path, 'rb') as fd2:
+                self.assertEqual(fd1.read(), fd2.read(), '二进制通道上传内容错误')
+        finally:
+            for path in [src_path, dst_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_blob_expire(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        blobs = self.server.blobs
+        with mock.patch('qt4i.driver.rpc.BLOB_EXPIRE_TIME', -1):
+            token = driver.demo.blob_handle('expired')
+            path = tempfile.mktemp()
+            with open(path, 'wb') as fd:
+                fd.write(b'expired')
+            blobs.add_file(path, delete=True)
+        six.assertRegex(self, token, '^[0-9a-f]{32}$')
+        self.assertRaises(DriverApiError, driver.fetch_blob, token, io.BytesIO()) # 过期的token不能使用
+        self.assertFalse(os.path.exists(path), '过期的文件未删除')
+
+    def test_metrics(self):
+        driver = RPCClientProxy('%s/device/metrics1/' % self.driver_url)
+        for i in range(3):
+            driver.demo.echo(i)
+        self.assertRaises(DriverApiError, driver.demo.echo, 1, 2)
+        stats = self.server.get_metrics()['rpc']['metrics1']['demo.echo']
+        self.assertEqual((stats['count'], stats['errors']), (4, 1), '调用次数统计错误')
+        self.assertTrue(stats['bytes_in'] > 0 and stats['bytes_out'] > 0, '流量统计错误')
+        self.assertTrue(stats['p50_ms'] <= stats['p99_ms'] <= stats['max_ms'], '耗时分位数错误')
+        conn = http_client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        conn.request('GET', '/metrics')
+        text = conn.getresponse().read().decode('utf-8')
+        conn.close()
+        self.assertIn('qt4i_rpc_request_duration_seconds_count{device="metrics1",method="demo.echo"} 4', text)
+        self.assertIn('qt4i_rpc_request_errors_total{device="metrics1",method="demo.echo"} 1', text)
+
+    def test_device_queue(self):
+        def call(device_id):
+            RPCClientProxy('%s/device/%s/' % (self.driver_url, device_id)).demo.delay_echo(1, 0.3)
+        threads = [threading.Thread(target=call, args=(it,)) for it in ['queue1', 'queue1', 'queue2']]
+        time0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.time() - time0, 0.6, '同一设备的请求未串行执行')
+        self.assertLess(time.time() - time0, 0.9, '不同设备的请求未并行执行')
+        stats = self.server.get_server_stats()
+        self.assertEqual(stats['queues']['queue1']['requests'], 2)
+        self.assertGreaterEqual(stats['queues']['queue1']['max_queue_depth'], 1)
+        self.assertGreater(stats['queues']['queue1']['max_wait_ms'], 200)
+
+    def test_stale_connection_retry(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        driver.demo.echo()
+        pool = ConnectionPool.get_pool('http', '127.0.0.1:%d' % self.server.server_address[1])
+        for conn, _ in pool._idle:
+            conn.sock.shutdown(socket.SHUT_RDWR) # 模拟连接被服务端关闭
+        self.assertTrue(driver.demo.echo(), '失效连接未自动重连')
+
+    def test_timeout_not_retried(self):
+        ConnectionPool.clear_all()
+        socket.setdefaulttimeout(0.3)
+        try:
+            driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+            driver.demo.echo() # 连接池中保留一个复用的连接
+            calls = DemoEndpoint.slow_calls
+            self.assertRaises(socket.timeout, driver.demo.slow_count, 0.6)
+            time.sleep(0.8)
+            self.assertEqual(DemoEndpoint.slow_calls, calls + 1, '超时的请求被重试')
+        finally:
+            socket.setdefaulttimeout(None)
+            ConnectionPool.clear_all()
+
+    def test_max_connections(self):
+        server = start_demo_server(max_connections=2)
+        port = server.server_address[1]
+        body = json.dumps({"jsonrpc": "2.0", "id": "1", "method": "demo.echo", "params": [1]})
+        def request(timeout=None):
+            conn = http_client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            conn.request('POST', '/device/demo/', body, {'Content-Type': 'application/json-rpc'})
+            conn.getresponse().read()
+            return conn
+        try:
+            conns = [request(), request()] # 保持keep-alive连接
+            self.assertRaises(socket.timeout, request, 0.3)
+            conns.pop().close()
+            conns.append(request(2))
+            for conn in conns:
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_pool_params(self):
+        host = '127.0.0.1:%d' % self.server.server_address[1]
+        pool = ConnectionPool.get_pool('http', host)
+        self.assertTrue(ConnectionPool.get_pool('http', host) is pool)
+        other = ConnectionPool.get_pool('http', host, max_size=1, idle_timeout=5)
+        self.assertFalse(other is pool, '不同参数的连接池被共享')
+        self.assertEqual((other.max_size, other.idle_timeout), (1, 5))
+
+
+class WebSocketChannelTest(unittest.TestCase):
+    '''WebSocketChannel test
+    '''
+    max_concurrent_requests = 'qt4i.driver.rpc.WS_MAX_CONCURRENT_REQUESTS'
+
+    @classmethod
+    def start_server(cls):
+        return start_demo_server()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = cls.start_server()
+        cls.port = cls.server.server_address[1]
+        cls.ws_uri = 'ws://127.0.0.1:%d/ws' % cls.port
+
+    @classmethod
+    def tearDownClass(cls):
+        WebSocketChannel.close_all()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _get_driver(self, device_id='demo'):
+        return RPCClientProxy('http://127.0.0.1:%d/device/%s/' % (self.port, device_id), ws_uri=self.ws_uri)
+
+    def test_echo(self):
+        driver = self._get_driver()
+        self.assertEqual(driver.demo.echo({'a': [1, 2]}), {'a': [1, 2]}, 'RPC调用返回值错误')
+        self.assertTrue(WebSocketChannel.get_channel(self.ws_uri).supported, '子协议协商失败')
+
+    def test_error(self):
+        driver = self._get_driver()
+        self.assertRaises(DriverApiError, driver.demo.not_exist)
+
+    def test_batch(self):
+        driver = self._get_driver()
+        with driver.batch() as batch:
+            results = [batch.demo.echo(i) for i in range(3)]
+        self.assertEqual([it.result() for it in results], [0, 1, 2], 'RPC调用返回值错误')
+
+    def test_concurrent_calls(self):
+        results = {}
+        def call(driver, value):
+            results[value] = driver.demo.delay_echo(value, 0.5)
+        threads = [threading.Thread(target=call, args=(self._get_driver('demo%d' % i), i)) for i in range(8)]
+        time0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, dict((i, i) for i in range(8)), '响应与请求关联错误')
+        self.assertLess(time.time() - time0, 2, '在途调用未并发执行')
+
+    def test_reconnect(self):
+        driver = self._get_driver()
+        driver.demo.echo()
+        WebSocketChannel.get_channel(self.ws_uri)._conn.ws.sock.close() # 模拟连接断开
+        time.sleep(0.1)
+        self.assertTrue(driver.demo.echo(), '连接断开后未自动重连')
+
+    def test_timeout(self):
+        driver = self._get_driver()
+        driver.demo.echo()
+        socket.setdefaulttimeout(0.3)
+        try:
+            self.assertRaises(socket.timeout, driver.demo.delay_echo, 1, 0.6)
+        finally:
+            socket.setdefaulttimeout(None)
+        self.assertTrue(driver.demo.echo(), '超时后通道不可用')
+
+    def test_bounded_concurrency(self):
+        WebSocketChannel.close_all() # 新连接按修改后的上限执行
+        with mock.patch(self.max_concurrent_requests, 2):
+            threads = [threading.Thread(target=self._get_driver('demo%d' % i).demo.delay_echo, args=(i, 0.3)) for i in range(4)]
+            time0 = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertGreaterEqual(time.time() - time0, 0.6, '同时执行的请求数超过上限')
+        WebSocketChannel.close_all()
+
+
+@unittest.skipIf(six.PY2, 'asyncio server requires python3')
+class AsyncWebSocketChannelTest(WebSocketChannelTest):
+    '''AsyncJSONRPCServer的WebSocketChannel test
+    '''
+    max_concurrent_requests = 'qt4i.driver.aiorpc.WS_MAX_CONCURRENT_REQUESTS'
+
+    @classmethod
+    def start_server(cls):
+        from qt4i.driver.aiorpc import AsyncJSONRPCServer
+        return start_demo_server(AsyncJSONRPCServer, max_workers=4)
+
+    def test_large_message(self):
+        driver = self._get_driver()
+        self.assertEqual(driver.demo.echo('x' * 100000), 'x' * 100000, '大消息收发错误')
+
+
+@unittest.skipIf(six.PY2, 'asyncio server requires python3')
+class AsyncJSONRPCServerTest(unittest.TestCase):
+    '''AsyncJSONRPCServer test
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        from qt4i.driver.aiorpc import AsyncJSONRPCServer
+        cls.server = start_demo_server(AsyncJSONRPCServer, max_workers=4)
+        cls.driver_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        ConnectionPool.clear_all()
+        cls.server.shutdown()
+        time.sleep(0.1)
+        cls.server.server_close()
+
+    def test_echo(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        self.assertEqual(driver.demo.echo('hello'), 'hello', 'RPC调用返回值错误')
+        self.assertEqual(driver.demo.echo('x' * 5000), 'x' * 5000, 'gzip响应解析错误')
+        self.assertRaises(DriverApiError, driver.demo.not_exist)
+
+    def test_echo_without_keep_alive(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url, keep_alive=False)
+        self.assertEqual(driver.demo.echo([1, 2]), [1, 2], 'RPC调用返回值错误')
+
+    def test_bounded_executor(self):
+        threads = [threading.Thread(target=RPCClientProxy('%s/device/bounded%d/' % (self.driver_url, i)).demo.delay_echo,
+                                    args=(i, 0.3)) for i in range(8)]
+        time0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 4个工作线程执行8个请求，至少需要两轮
+        self.assertGreaterEqual(time.time() - time0, 0.6, '线程池未限制并发数')
+
+    def test_device_queue(self):
+        def call(device_id):
+            RPCClientProxy('%s/device/%s/' % (self.driver_url, device_id)).demo.delay_echo(1, 0.3)
+        threads = [threading.Thread(target=call, args=(it,)) for it in ['aqueue1', 'aqueue1', 'aqueue2']]
+        time0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.time() - time0, 0.6, '同一设备的请求未串行执行')
+        self.assertLess(time.time() - time0, 0.9, '不同设备的请求未并行执行')
+        self.assertEqual(self.server.get_server_stats()['queues']['aqueue1']['requests'], 2, '队列统计错误')
+
+    def test_device_queue_not_blocking(self):
+        busy = RPCClientProxy('%s/device/abusy/' % self.driver_url)
+        threads = [threading.Thread(target=busy.demo.delay_echo, args=(i, 0.5)) for i in range(6)]
+        for t in threads:
+            t.start()
+        time.sleep(0.2) # 等待请求进入abusy的设备队列
+        time0 = time.time()
+        self.assertEqual(RPCClientProxy('%s/device/aidle/' % self.driver_url).demo.echo(1), 1)
+        self.assertLess(time.time() - time0, 0.3, '设备队列中等待的请求占用了线程池')
+        for t in threads:
+            t.join()
+
+    def test_streamed_response(self):
+        tree = {'children': [{'name': 'n%d' % i, 'rect': [i, i, 10, 10]} for i in range(20000)]}
+        conn = http_client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        body = json.dumps({"jsonrpc": "2.0", "id": "1", "method": "demo.echo", "params": [tree]})
+        conn.request('POST', '/device/demo/', body, {STREAM_HEADER: 'chunked', 'Content-Type': 'application/json-rpc'})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked', '大响应未使用chunked编码')
+        self.assertEqual(json.loads(resp.read())['result'][0], tree, '流式响应内容错误')
+        conn.close()
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        self.assertEqual(driver.demo.echo(tree), tree, 'gzip流式响应解码错误')
+        self.assertEqual(driver.demo.echo('after stream'), 'after stream')
+
+    @unittest.skipIf(get_msgpack_codec() is None, 'msgpack is not installed')
+    def test_msgpack_response(self):
+        codec = get_msgpack_codec()
+        conn = http_client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        body = json.dumps({"jsonrpc": "2.0", "id": "1", "method": "demo.echo", "params": [u'中文']})
+        conn.request('POST', '/device/demo/', body, {'Accept': codec.content_type, 'Content-Type': 'application/json-rpc'})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader('Content-Type'), codec.content_type, '未按Accept协商msgpack响应')
+        self.assertEqual(codec.loads(resp.read())['result'][0], u'中文', 'msgpack响应内容错误')
+        conn.close()
+
+    def test_blob(self):
+        driver = RPCClientProxy('%s/device/demo/' % self.driver_url)
+        token = driver.demo.blob_handle('binary data')
+        fd = io.BytesIO()
+        self.assertEqual(driver.fetch_blob(token, fd), 11)
+        self.assertEqual(fd.getvalue(), b'binary data', '二进制通道下载内容错误')
+        self.assertRaises(DriverApiError, driver.fetch_blob, token, io.BytesIO()) # token只能使用一次
+
+        src_path = tempfile.mktemp()
+        dst_path = tempfile.mktemp()
+        with open(src_path, 'wb') as fd:
+            fd.write(os.urandom(200000))
+        try:
+            with open(src_path, 'rb') as fd:
+                driver.send_blob(driver.demo.upload_handle(dst_path), fd)
+            with open(src_path, 'rb') as fd1, open(dst_path, 'rb') as fd2:
+                self.assertEqual(fd1.read(), fd2.read(), '二进制通道上传内容错误')
+            fd = io.BytesIO()
+            self.assertEqual(driver.fetch_blob(driver.demo.file_handle(dst_path), fd), 200000)
+            with open(src_path, 'rb') as fd1:
+                self.assertEqual(fd1.read(), fd.getvalue(), '二进制通道下载文件内容错误')
+            self.assertEqual(driver.demo.echo('after blob'), 'after blob')
+        finally:
+            for path in [src_path, dst_path]:
+                if os.path.exists(path):
+                    os.remove(path)
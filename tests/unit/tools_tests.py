@@ -16,8 +16,30 @@
 '''
 
 
+import io
+import mock
+import os
+import shutil
+import socket
+import sys
+import threading
+import tempfile
+import time
 import unittest
+from qt4i.driver.tools.recorder import ScreenRecorder
+from qt4i.driver.tools.recorder import SegmentWriter
+from qt4i.driver.tools.recorder import read_frames
 from qt4i.driver.tools.sched import PortManager
+from qt4i.driver.tools.screencapture import FrameBroadcaster
+from qt4i.driver.tools.screencapture import FrameSource
+from qt4i.driver.tools.screencapture import JpegStreamParser
+from qt4i.driver.tools.screencapture import MJpegClient
+from qt4i.driver.tools.screencapture import ProcessFrameSource
+from qt4i.driver.tools.screencapture import ScreenConsumer
+from qt4i.driver.tools.screencapture import ScreenProducer
+from qt4i.driver.tools.screencapture import ThreadedTCPServer
+from qt4i.driver.tools.screencapture import get_screen_stats
+from qt4i.driver.tools.screencapture import StreamProfile
 
 class SchedTest(unittest.TestCase):
     '''sched test
@@ -33,4 +55,239 @@ class SchedTest(unittest.TestCase):
         self.assertEqual(port1, 8100, 'PortManager分配端口错误')
         self.assertNotEqual(port1, port2, 'PortManager分配端口重复')
         PortManager.del_port(port_type, udid1)
-        self.assertTrue(udid1 not in PortManager.ports(port_type), 'PortManager清理端口失败')
\ No newline at end of file
+        self.assertTrue(udid1 not in PortManager.ports(port_type), 'PortManager清理端口失败')
+
+
+def make_jpeg(payload):
+    '''构造结构完整的JPEG数据，APP1段中包含缩略图，熵编码数据中包含填充字节和RST标记
+    '''
+    thumbnail = b'\xff\xd8\xff\xd9'
+    app1 = b'\xff\xe1' + bytearray([0, len(thumbnail) + 2]) + thumbnail
+    sos = b'\xff\xda\x00\x04\x01\x00'
+    return b'\xff\xd8' + bytes(app1) + sos + payload + b'\xff\x00\xff\xd0' + payload + b'\xff\xd9'
+
+
+class FakeFrameSource(FrameSource):
+
+    def __init__(self, frames):
+        self._frames = list(frames)
+
+    def read_frame(self):
+        if not self._frames:
+            raise EOFError('no more frames')
+        time.sleep(0.01)
+        return self._frames.pop(0)
+
+
+class MJpegClientTest(unittest.TestCase):
+    '''MJpegClient test
+    '''
+
+    def test_read_frame(self):
+        frames = [b'\xff\xd8' + b'a' * 300000 + b'\xff\xd9', b'\xff\xd8' + b'b' * 10 + b'\xff\xd9']
+        data = b''.join(b'--BoundaryString\r\nContent-type: image/jpg\r\nContent-Length: %d\r\n\r\n' % len(frame)
+                        + frame + b'\r\n\r\n' for frame in frames)
+        client = MJpegClient(stream=io.BytesIO(data), boundary='BoundaryString')
+        for frame in frames:
+            self.assertEqual(client.read_mjpeg_frame(), frame)
+        self.assertRaises(EOFError, client.read_frame)
+
+
+class FrameBroadcasterTest(unittest.TestCase):
+    '''FrameBroadcaster test
+    '''
+
+    def test_subscribers(self):
+        broadcaster = FrameBroadcaster(capacity=4)
+        fast = broadcaster.subscribe('fast')
+        slow = broadcaster.subscribe('slow')
+        ordered = broadcaster.subscribe('ordered', latest=False)
+        broadcaster.publish(b'0')
+        self.assertEqual(fast.next_frame(), b'0')
+        for i in range(1, 7):
+            broadcaster.publish(str(i).encode('ascii'))
+        self.assertEqual(fast.next_frame(), b'6')
+        self.assertEqual(slow.next_frame(), b'6')
+        self.assertEqual([ordered.next_frame() for _ in range(4)], [b'3', b'4', b'5', b'6'])
+        self.assertEqual(fast.next_frame(timeout=0.01), None)
+        stats = slow.get_stats()
+        self.assertEqual((stats['delivered'], stats['dropped']), (1, 6))
+        self.assertEqual(ordered.get_stats()['dropped'], 3)
+        broadcaster.close()
+        self.assertEqual(fast.next_frame(), None)
+
+    def test_profile(self):
+        broadcaster = FrameBroadcaster()
+        profile = StreamProfile.from_dict({'fps': 20, 'max_size': 320, 'quality': 50})
+        subscribers = [broadcaster.subscribe(profile=profile) for _ in range(2)]
+        broadcaster.publish(b'frame')
+        frames = [subscriber.next_frame() for subscriber in subscribers]
+        self.assertTrue(frames[0] is frames[1], '相同推流参数的帧未共享')
+        broadcaster.publish(b'frame')
+        subscribers[0].next_frame()
+        self.assertTrue(subscribers[0].get_stats()['fps'] <= 20)
+
+    def test_suppress_unchanged_frames(self):
+        producer = ScreenProducer('aaaaaaaaaaaa', 8100)
+        subscriber = producer.broadcaster.subscribe()
+        producer._publish_frame(b'frame')
+        producer._publish_frame(b'frame')
+        self.assertEqual(producer.suppressed_frames, 1)
+        self.assertEqual(subscriber.next_frame(), b'frame')
+        self.assertEqual(subscriber.next_frame(timeout=0.01), None)
+
+
+class FrameSourceTest(unittest.TestCase):
+    '''FrameSource test
+    '''
+
+    def test_jpeg_stream_parser(self):
+        frames = [make_jpeg(b'frame%d' % i) for i in range(3)]
+        data = b'garbage' + b''.join(frames)
+        parser = JpegStreamParser()
+        result = []
+        for i in range(0, len(data), 5):
+            result.extend(parser.feed(data[i:i + 5]))
+        self.assertEqual(result, frames)
+
+    def test_process_frame_source(self):
+        frames = [make_jpeg(b'frame%d' % i) for i in range(3)]
+        script = 'import sys; out = getattr(sys.stdout, "buffer", sys.stdout); out.write(%r); out.flush()' % b''.join(frames)
+        source = ProcessFrameSource([sys.executable, '-c', script])
+        source.open()
+        self.assertEqual([source.read_frame() for _ in range(3)], frames)
+        self.assertRaises(EOFError, source.read_frame)
+        source.close()
+
+    def test_fallback(self):
+        frames = [make_jpeg(b'frame%d' % i) for i in range(3)]
+        silent_process = lambda: ProcessFrameSource([sys.executable, '-c', 'import time; time.sleep(10)'], 0.1)
+        producer = ScreenProducer('simulator-udid', 8100, [silent_process, lambda: FakeFrameSource(frames)])
+        subscriber = producer.broadcaster.subscribe(latest=False)
+        producer.add_client(subscriber)
+        producer.daemon = True
+        producer.start()
+        self.assertEqual([subscriber.next_frame(timeout=5) for _ in range(3)], frames)
+        producer.stop()
+
+    def test_default_sim_frame_sources(self):
+        producer = ScreenProducer('simulator-udid', 8100)
+        self.assertEqual(len(producer._frame_sources), 1, '未配置常驻截屏命令时应只逐帧截屏')
+
+    def test_retry_preferred_source(self):
+        fallback_frames = [make_jpeg(b'fallback%d' % i) for i in range(200)]
+        preferred_frames = [make_jpeg(b'preferred')]
+        attempts = []
+        def preferred():
+            attempts.append(time.time())
+            return FakeFrameSource(preferred_frames if len(attempts) > 1 else [])
+        producer = ScreenProducer('simulator-udid', 8100, [preferred, lambda: FakeFrameSource(fallback_frames)])
+        subscriber = producer.broadcaster.subscribe(latest=False)
+        producer.add_client(subscriber)
+        producer.daemon = True
+        with mock.patch('qt4i.driver.tools.screencapture.SOURCE_RETRY_INTERVAL', 0.2):
+            producer.start()
+            received = []
+            while preferred_frames[0] not in received:
+                frame = subscriber.next_frame(timeout=5)
+                self.assertIsNotNone(frame, '未重新尝试优先的帧来源')
+                received.append(frame)
+        producer.stop()
+        self.assertEqual(received[0], fallback_frames[0], '优先的帧来源失败后应使用备用帧来源')
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.2, '重新尝试的间隔错误')
+
+
+    def test_restart_backoff(self):
+        attempts = []
+        def source():
+            attempts.append(time.time())
+            return FakeFrameSource([make_jpeg(b'frame')]) # 输出一帧后结束
+        producer = ScreenProducer('simulator-udid', 8100, [source])
+        producer.add_client(producer.broadcaster.subscribe())
+        producer.daemon = True
+        with mock.patch('qt4i.driver.tools.screencapture.SOURCE_RESTART_INTERVAL', 0.1):
+            producer.start()
+            time.sleep(1)
+            producer.stop()
+        intervals = [b - a for a, b in zip(attempts, attempts[1:])]
+        self.assertTrue(3 <= len(attempts) <= 5, '意外结束的帧来源未退避重启: %d' % len(attempts))
+        self.assertGreaterEqual(intervals[1], intervals[0] * 1.5, '重启间隔未增长')
+
+
+class ScreenConsumerTest(unittest.TestCase):
+    '''ScreenConsumer test
+    '''
+
+    def test_screen_stats(self):
+        producer = ScreenProducer('simulator-udid', 8100)
+        server = ThreadedTCPServer(('localhost', 0), ScreenConsumer)
+        server.screen_producer = producer
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        port = server.server_address[1]
+        client = socket.create_connection(('localhost', port))
+        try:
+            client.sendall(b'screenshot')
+            for _ in range(50):
+                if producer.get_client_stats():
+                    break
+                time.sleep(0.02)
+            producer.broadcaster.publish(make_jpeg(b'frame'))
+            stats = get_screen_stats(port)
+            self.assertEqual(len(stats['clients']), 1, '推流过程中应能获取客户端统计')
+            self.assertEqual(stats['suppressed_frames'], 0)
+        finally:
+            client.close()
+            producer.stop()
+            server.shutdown()
+            server.server_close()
+
+
+class RecorderTest(unittest.TestCase):
+    '''recorder test
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rolling_segments(self):
+        writer = SegmentWriter(self.directory, segment_duration=10, max_size=250)
+        for i in range(6):
+            writer.write(b'%d' % i * 100, 1000 + i * 10)
+        writer.close()
+        self.assertEqual(len(os.listdir(self.directory)), 6, '超出大小上限的分段未删除')
+        frames = list(read_frames(self.directory, 1035, 1100))
+        self.assertEqual([t for t, _ in frames], [1040, 1050])
+        self.assertEqual(frames[0][1], b'4' * 100)
+
+    def test_screen_recorder(self):
+        broadcaster = FrameBroadcaster()
+        recorder = ScreenRecorder(broadcaster, self.directory)
+        recorder.start()
+        for i in range(3):
+            broadcaster.publish(b'frame%d' % i, 1000 + i)
+        broadcaster.close()
+        recorder.join(5)
+        self.assertEqual([f for _, f in read_frames(self.directory, 1001, 1002)], [b'frame1', b'frame2'])
+
+    def test_screen_recorder_retry(self):
+        broadcaster = FrameBroadcaster()
+        recorder = ScreenRecorder(broadcaster, self.directory)
+        shutil.rmtree(self.directory)
+        open(self.directory, 'w').close() # 录制目录不可用
+        with mock.patch('qt4i.driver.tools.recorder.RETRY_INTERVAL', 0.05):
+            recorder.start()
+            broadcaster.publish(b'frame0', 1000)
+            time.sleep(0.2)
+            os.remove(self.directory)
+            for i in range(1, 3):
+                broadcaster.publish(b'frame%d' % i, 1000 + i)
+                time.sleep(0.1)
+            broadcaster.close()
+            recorder.join(5)
+        self.assertFalse(recorder.is_alive())
+        self.assertEqual([f for _, f in read_frames(self.directory, 1000, 1002)], [b'frame1', b'frame2'], '出错后未继续录制')
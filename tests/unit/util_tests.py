@@ -0,0 +1,176 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''qt4i.driver.util的单元测试用例
+'''
+
+
+import time
+import unittest
+from qt4i.driver.util import find_elements_in_rounds
+from qt4i.driver.util.uimap import QPathCache
+from qt4i.driver.util.uimap import instruments2xctest
+from qt4i.driver.util.uimap import xctest2instruments
+from qt4i.driver.util.uiquery import UITreeSnapshot
+from qt4i.driver.util.uitree import UITreeCache
+from qt4i.driver.util.uitree import UITreeMirror
+
+class UIMapTest(unittest.TestCase):
+    '''uimap test
+    '''
+
+    def test_qpath_translate(self):
+        qpath_array, _ = instruments2xctest("/classname='UIAWindow' && visible=true /name='abc'")
+        self.assertEqual(qpath_array[0]['classname'][1], 'Window', 'UIAutomation控件类型转换错误')
+        self.assertEqual(xctest2instruments("/classname='Window'"), "/classname='UIAWindow'", 'XCTest控件类型转换错误')
+
+    def test_qpath_cache(self):
+        cache = QPathCache(max_size=2)
+        for key in ['a', 'b', 'a', 'c', 'b']:
+            cache.get(key, lambda k: k.upper())
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 4, 2), 'LRU缓存统计错误')
+
+
+class UITreeTest(unittest.TestCase):
+    '''uitree test
+    '''
+
+    def _build_tree(self, label):
+        return {'classname': 'Application', 'label': 'demo', 'children': [
+                    {'classname': 'Table', 'label': None, 'children': [
+                        {'classname': 'Cell', 'label': label, 'children': []},
+                        {'classname': 'Cell', 'label': 'b', 'children': []}]},
+                    {'classname': 'Button', 'label': 'ok', 'children': []}]}
+
+    def test_tree_diff(self):
+        cache, mirror = UITreeCache(), UITreeMirror()
+        key = (None, 0)
+        result = cache.get_diff(key, self._build_tree('a'), mirror.get_base_hash(key))
+        self.assertIn('tree', result, '首次获取应返回完整UI树')
+        mirror.update(key, result)
+        result = cache.get_diff(key, self._build_tree('a'), mirror.get_base_hash(key))
+        self.assertEqual(result['patches'], [], 'UI树未变化时不应返回补丁')
+        mirror.update(key, result)
+        result = cache.get_diff(key, self._build_tree('c'), mirror.get_base_hash(key))
+        self.assertEqual([patch['path'] for patch in result['patches']], [[0, 0]], '只应返回变化的子树')
+        self.assertEqual(mirror.update(key, result), self._build_tree('c'), '补丁应用错误')
+
+    def test_tree_diff_copy_on_write(self):
+        cache, mirror = UITreeCache(), UITreeMirror()
+        key = (None, 0)
+        old_tree = mirror.update(key, cache.get_diff(key, self._build_tree('a')))
+        new_tree = self._build_tree('c')
+        new_tree['children'][0]['label'] = 'table'
+        result = cache.get_diff(key, new_tree, mirror.get_base_hash(key))
+        self.assertTrue(any('attrs' in patch for patch in result['patches']), '应包含只更新属性的补丁')
+        tree = mirror.update(key, result)
+        self.assertEqual(tree, new_tree, '补丁应用错误')
+        self.assertEqual(old_tree, self._build_tree('a'), '之前返回的UI树不应被修改')
+        self.assertIs(tree['children'][1], old_tree['children'][1], '未变化的子树应共享')
+
+    def test_tree_diff_sibling_changes(self):
+        cache, mirror = UITreeCache(), UITreeMirror()
+        key = (None, 0)
+        old_tree = mirror.update(key, cache.get_diff(key, self._build_tree('a')))
+        new_tree = self._build_tree('a')
+        cells = new_tree['children'][0]['children']
+        cells.insert(0, {'classname': 'Cell', 'label': 'new', 'children': []})
+        new_tree['children'].reverse()
+        result = cache.get_diff(key, new_tree, mirror.get_base_hash(key))
+        self.assertEqual(result['patches'], [{'path': [], 'children': [1, 0]},
+                                             {'path': [1], 'children': [cells[0], 0, 1]}], '未按哈希匹配子节点')
+        tree = mirror.update(key, result)
+        self.assertEqual(tree, new_tree, '补丁应用错误')
+        self.assertIs(tree['children'][0], old_tree['children'][1], '移动的子树应共享')
+        self.assertIs(tree['children'][1]['children'][2], old_tree['children'][0]['children'][1], '移动的子树应共享')
+
+        del cells[1]
+        cells[0]['label'] = 'changed'
+        result = cache.get_diff(key, new_tree, mirror.get_base_hash(key))
+        self.assertEqual(result['patches'], [{'path': [1], 'children': [0, 2]},
+                                             {'path': [1, 0], 'attrs': {'classname': 'Cell', 'label': 'changed'}}])
+        self.assertEqual(mirror.update(key, result), new_tree, '补丁应用错误')
+
+
+class UIQueryTest(unittest.TestCase):
+    '''uiquery test
+    '''
+
+    tree_json = '''{"classname": "Application", "name": "demo", "label": "demo", "value": null, "visible": true, "enabled": true,
+    "children": [{"classname": "Window", "name": null, "label": null, "value": null, "visible": true, "enabled": true,
+    "children": [{"classname": "Table", "name": null, "label": null, "value": null, "visible": true, "enabled": true,
+    "children": [{"classname": "Cell", "name": "c1", "label": "a", "value": null, "visible": true, "enabled": true, "children": []},
+                 {"classname": "Cell", "name": "c2", "label": "b", "value": null, "visible": false, "enabled": true, "children": []}]}]}]}'''
+
+    def test_query(self):
+        snapshot = UITreeSnapshot.from_json(self.tree_json)
+        labels = lambda locator: [node['label'] for node in snapshot.query(locator)]
+        self.assertEqual(labels("/classname='UIAWindow'/classname='Cell' & maxdepth=2"), ['a', 'b'], 'QPath查询错误')
+        self.assertEqual(labels("/classname='Window'/classname='Cell'"), [], 'MaxDepth默认应为1')
+        self.assertEqual(labels("/classname='Cell' & label~='a|b' & visible=true & maxdepth=3"), ['a'], 'QPath属性匹配错误')
+        self.assertEqual(labels("/classname='Cell' & maxdepth=3 & instance=2"), ['b'], 'Instance错误')
+        self.assertEqual(labels("c2"), ['b'], 'name查询错误')
+        self.assertEqual(labels("//Cell[@visible='false']"), ['b'], 'XPath查询错误')
+
+
+class FindElementsInRoundsTest(unittest.TestCase):
+    '''find_elements_in_rounds test
+    '''
+
+    def setUp(self):
+        self.calls = []
+
+    def find(self, elements):
+        def _find(item, parent_id):
+            self.calls.append((item['locator'], parent_id))
+            found = elements.get((item['locator'], parent_id), [])
+            return {'elements': [{'element': e} for e in found], 'find_count': 1}
+        return _find
+
+    def test_parent_chain(self):
+        locators = [{'locator': 'c', 'parent': 1},
+                    {'locator': 'b', 'parent': 2},
+                    {'locator': 'a', 'parent_id': 1}]
+        find = self.find({('a', 1): [10], ('b', 10): [20], ('c', 20): [30, 31]})
+        results = find_elements_in_rounds(find, locators, 0, 0.01, 2, 0.5)
+        self.assertEqual(self.calls, [('a', 1), ('b', 10), ('c', 20)], '父element应先于子element查找')
+        self.assertEqual([len(r['elements']) for r in results], [2, 1, 1])
+        self.assertEqual(results[0]['find_count'], 1)
+
+    def test_missing_parent(self):
+        locators = [{'locator': 'a'}, {'locator': 'b', 'parent': 0}]
+        results = find_elements_in_rounds(self.find({}), locators, 0, 0.01, 2, 0.5)
+        self.assertEqual(self.calls, [('a', None)], '父element未找到时不应查找子element')
+        self.assertEqual(results[1], {'elements': [], 'find_count': 0, 'find_time': results[1]['find_time']})
+
+    def test_concurrent(self):
+        elements = {('a', None): [1], ('b', None): [2], ('c', None): [3], ('d', 1): [4]}
+        find = self.find(elements)
+        def slow_find(item, parent_id):
+            time.sleep(0.2)
+            return find(item, parent_id)
+        locators = [{'locator': 'a'}, {'locator': 'b'}, {'locator': 'c'}, {'locator': 'd', 'parent': 0}]
+        time0 = time.time()
+        results = find_elements_in_rounds(slow_find, locators, 0, 0.01, 2, 0.5, max_concurrency=3)
+        self.assertLess(time.time() - time0, 0.6, '互不依赖的locator未并发查找')
+        self.assertEqual(self.calls[-1], ('d', 1), '父element应先于子element查找')
+        self.assertEqual([r['elements'][0]['element'] for r in results], [1, 2, 3, 4])
+
+    def test_backoff(self):
+        results = find_elements_in_rounds(self.find({}), [{'locator': 'a'}], 0.3, 0.01, 2, 0.1)
+        # 间隔依次为0.01、0.02、0.04、0.08、0.1、0.05(剩余时间)
+        self.assertTrue(len(self.calls) <= 8, '查找间隔未按指数增长: %d' % len(self.calls))
+        self.assertEqual(results[0]['find_count'], len(self.calls))
+        self.assertTrue(results[0]['find_time'] >= 300)